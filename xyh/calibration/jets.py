@@ -15,6 +15,8 @@ from xyh.util import lv_xyzt, lv_mass
 
 ak = maybe_import("awkward")
 np = maybe_import("numpy")
+coffea = maybe_import("coffea")
+maybe_import("coffea.nanoevents.methods.nanoaod")
 
 
 # custom jec calibrator that only runs nominal correction
@@ -50,27 +52,11 @@ def jet_energy_init(self: Calibrator) -> None:
     self.produces |= {jec_nominal}
 
 
-@calibrator(
-  uses={
-    "Electron.{pt,eta,phi,mass}",
-    "Muon.{pt,eta,phi,mass}",
-    "Jet.{pt,eta,phi,mass}",
-    # index of electrons/muons matched to jets
-    "Jet.{muonIdx1,muonIdx2,electronIdx1,electronIdx2}",
-    # PF energy fractions
-    "Jet.{chEmEF,muEF}",
-    attach_coffea_behavior,
-  },
-  produces={
-    "Jet.{pt,eta,phi,mass,rawFactor}",
-    "Jet.{chEmEF,muEF}"
-  },
-)
-def jet_lepton_cleaner(self: Calibrator, events: ak.Array, **kwargs) -> ak.Array:
+def clean_jets_jagged(events: ak.Array, tolerance: float = 0.1) -> ak.Array:
   """
-  Calibrator to clean jet four-vectors from contributions from nearby leptons
+  Reference implementation of the jet lepton cleaning on jagged arrays, looping over the four
+  matched lepton slots of each jet. Kept for validation and benchmarking of `clean_jets_flat`.
   """
-
   # load coffea behaviors for simplified arithmetic with vectors
   events["Electron"] = ak.with_name(events.Electron, "PtEtaPhiMLorentzVector")
   events["Muon"] = ak.with_name(events.Muon, "PtEtaPhiMLorentzVector")
@@ -106,7 +92,6 @@ def jet_lepton_cleaner(self: Calibrator, events: ak.Array, **kwargs) -> ak.Array
     "e": jet_lv.energy * events.Jet.chEmEF,
   }
   # subtract lepton contributions from jets
-  tolerance = 0.1
   for jet_lepton, jet_lepton_type in jet_leptons_types:
     jet_lepton_lv = lv_xyzt(jet_lepton)
     jet_lv_cleaned = lv_xyzt(jet_lv - jet_lepton_lv)
@@ -191,4 +176,132 @@ def jet_lepton_cleaner(self: Calibrator, events: ak.Array, **kwargs) -> ak.Array
     value = ak.where(np.isfinite(value), value, 0)
     events = set_ak_column(events, f"Jet.{var}", value)
 
-  return events
\ No newline at end of file
+  return events
+
+
+# jet fields holding the indices of matched leptons, the matched collection and the type
+# of the PF energy fraction the lepton contributes to, in the order of the cleaning steps
+_jet_lepton_slots = [
+  ("electronIdx1", "Electron", "e"),
+  ("electronIdx2", "Electron", "e"),
+  ("muonIdx1", "Muon", "mu"),
+  ("muonIdx2", "Muon", "mu"),
+]
+
+
+def _flat_lv(with_name: str, **fields: np.ndarray) -> ak.Array:
+  """
+  Build a flat (non-jagged) array of lorentz vectors with nanoaod behavior from numpy buffers.
+  """
+  return ak.zip(fields, with_name=with_name, behavior=coffea.nanoevents.methods.nanoaod.behavior)
+
+
+def clean_jets_flat(events: ak.Array, tolerance: float = 0.1) -> ak.Array:
+  """
+  Fused jet lepton cleaning on the flat Jet, Electron and Muon buffers. Jet four-vectors are kept
+  as flat x/y/z/t numpy arrays that are updated in place, and each of the four cleaning steps
+  only evaluates the jets that actually have a lepton in the respective slot. The vector
+  arithmetic uses the same coffea behaviors as `clean_jets_jagged` element by element, so that
+  the output is bit-identical, without any intermediate jagged arrays.
+  """
+  flat = lambda arr: ak.to_numpy(ak.flatten(arr, axis=1))
+  jet_counts = ak.to_numpy(ak.num(events.Jet, axis=1))
+  jet_event = np.repeat(np.arange(len(jet_counts)), jet_counts)
+
+  # revert JEC for jet pt and jet mass
+  raw_factor = flat(events.Jet.rawFactor)
+  jet_lv = lv_xyzt(_flat_lv(
+    "PtEtaPhiMLorentzVector",
+    pt=flat(events.Jet.pt) * (1 - raw_factor),
+    eta=flat(events.Jet.eta),
+    phi=flat(events.Jet.phi),
+    mass=flat(events.Jet.mass) * (1 - raw_factor),
+  ))
+  jet_xyzt = {c: np.array(ak.to_numpy(jet_lv[c])) for c in "xyzt"}
+
+  # total energy from clustered leptonic PF candidates
+  jet_energy = ak.to_numpy(jet_lv.energy)
+  jet_pf_energies = {
+    "mu": jet_energy * flat(events.Jet.muEF),
+    "e": jet_energy * flat(events.Jet.chEmEF),
+  }
+
+  # flat lepton buffers and offsets, read once per collection
+  leptons = {}
+  for name in {coll for _, coll, _ in _jet_lepton_slots}:
+    counts = ak.to_numpy(ak.num(events[name], axis=1))
+    offsets = np.zeros(len(counts), dtype=np.int64)
+    np.cumsum(counts[:-1], out=offsets[1:])
+    fields = {f: flat(events[name][f]) for f in ["pt", "eta", "phi", "mass"]}
+    leptons[name] = (offsets, fields)
+
+  for idx_field, coll, lepton_type in _jet_lepton_slots:
+    idx = flat(events.Jet[idx_field])
+    sel = np.flatnonzero(idx >= 0)
+    if not len(sel):
+      continue
+
+    # matched leptons and jets of this slot only
+    offsets, fields = leptons[coll]
+    lep_idx = offsets[jet_event[sel]] + idx[sel]
+    jet_lepton_lv = lv_xyzt(_flat_lv("PtEtaPhiMLorentzVector", **{f: v[lep_idx] for f, v in fields.items()}))
+    jet_sel_lv = _flat_lv("LorentzVector", **{c: v[sel] for c, v in jet_xyzt.items()})
+    jet_lv_cleaned = lv_xyzt(jet_sel_lv - jet_lepton_lv)
+    jet_pf_energy = jet_pf_energies[lepton_type][sel]
+
+    # same cleaning conditions as in clean_jets_jagged
+    lep_energy_pf_compatible = jet_lepton_lv.energy < (1 + tolerance) * jet_pf_energy
+    jet_lv_cleaned_mass_sq = jet_lv_cleaned.energy**2 - jet_lv_cleaned.rho**2
+    mass_stays_positive = jet_lv_cleaned_mass_sq >= -tolerance
+    angle_change_small = (
+      (jet_sel_lv.delta_r(jet_lv_cleaned) <= np.pi / 2) |
+      (jet_lv_cleaned.pt < 10)
+    )
+    do_clean = ak.to_numpy(mass_stays_positive & angle_change_small & lep_energy_pf_compatible)
+
+    # update jet LVs and PF energies in place
+    clean_idx = sel[do_clean]
+    for c in "xyzt":
+      jet_xyzt[c][clean_idx] = ak.to_numpy(jet_lv_cleaned[c])[do_clean]
+    jet_pf_energies[lepton_type][clean_idx] = (
+      jet_pf_energy - ak.to_numpy(jet_lepton_lv.energy)
+    )[do_clean]
+
+  # save updated jet variables
+  events = set_ak_column(events, "Jet.rawFactor", 0)
+  jet_lv = lv_mass(_flat_lv("LorentzVector", **jet_xyzt))
+  for var in ["pt", "eta", "phi", "mass"]:
+    # ensure no missing values
+    value = ak.fill_none(ak.nan_to_none(getattr(jet_lv, var)), 0.0)
+    value = ak.where(np.isfinite(value), value, 0)
+    events = set_ak_column(events, f"Jet.{var}", ak.unflatten(ak.to_numpy(value), jet_counts))
+
+  return events
+
+
+@calibrator(
+  uses={
+    "Electron.{pt,eta,phi,mass}",
+    "Muon.{pt,eta,phi,mass}",
+    "Jet.{pt,eta,phi,mass}",
+    # index of electrons/muons matched to jets
+    "Jet.{muonIdx1,muonIdx2,electronIdx1,electronIdx2}",
+    # PF energy fractions
+    "Jet.{chEmEF,muEF}",
+    attach_coffea_behavior,
+  },
+  produces={
+    "Jet.{pt,eta,phi,mass,rawFactor}",
+    "Jet.{chEmEF,muEF}"
+  },
+  # whether to use the fused implementation on flat buffers
+  fused=True,
+  # tolerance of the energy and mass checks
+  tolerance=0.1,
+)
+def jet_lepton_cleaner(self: Calibrator, events: ak.Array, **kwargs) -> ak.Array:
+  """
+  Calibrator to clean jet four-vectors from contributions from nearby leptons
+  """
+  clean_jets = clean_jets_flat if self.fused else clean_jets_jagged
+  return clean_jets(events, tolerance=self.tolerance)
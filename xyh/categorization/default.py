@@ -20,13 +20,13 @@ def catid_incl(self: Categorizer, events: ak.Array, **kwargs) -> tuple[ak.Array,
   return events, ak.ones_like(events.event) == 1
 
 
-@categorizer(uses={"event"}, call_force=True)
+@categorizer(uses={"Electron", "Muon"}, call_force=True)
 def catid_1e(self: Categorizer, events: ak.Array, **kwargs) -> tuple[ak.Array, ak.Array]:
   mask = (ak.num(events.Electron, axis=-1) == 1) & (ak.num(events.Muon, axis=-1) == 0)
   return events, mask
 
 
-@categorizer(uses={"event"}, call_force=True)
+@categorizer(uses={"Electron", "Muon"}, call_force=True)
 def catid_1mu(self: Categorizer, events: ak.Array, **kwargs) -> tuple[ak.Array, ak.Array]:
   mask = (ak.num(events.Electron, axis=-1) == 0) & (ak.num(events.Muon, axis=-1) == 1)
   return events, mask
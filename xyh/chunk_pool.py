@@ -0,0 +1,297 @@
+# coding: utf-8
+
+"""
+Processing of event chunks of a single task branch in a pool of worker processes.
+"""
+
+from __future__ import annotations
+
+import os
+import signal
+import traceback
+from collections import defaultdict
+from multiprocessing import Pipe
+from multiprocessing.connection import wait
+
+from columnflow.util import maybe_import, DotDict
+
+ak = maybe_import("awkward")
+
+
+# attributes of the array functions run by task families that support chunk workers
+chunk_function_attrs = {
+  "cf.CalibrateEvents": "calibrator_inst",
+  "cf.SelectEvents": "selector_inst",
+  "cf.ProduceColumns": "producer_inst",
+}
+
+# connection to the task process, only set in worker processes
+_worker_conn = None
+
+
+def exit_worker_on_failure() -> None:
+  """
+  When called in a worker process of a :py:class:`ChunkPool` while an exception is handled, sends
+  its traceback to the task process and exits the worker. Does nothing in the task process.
+  """
+  if _worker_conn is None:
+    return
+  try:
+    _worker_conn.send(("error", traceback.format_exc()))
+  finally:
+    os._exit(1)
+
+
+def merge_chunk_results(dst: dict, src: dict) -> dict:
+  """
+  Merges the selection statistics or histograms *src* of a single chunk into *dst* in place and
+  returns it. Nested dictionaries are merged recursively, all other values are added.
+  """
+  for key, value in src.items():
+    if key not in dst:
+      dst[key] = value
+    elif isinstance(value, dict):
+      merge_chunk_results(dst[key], value)
+    else:
+      dst[key] = dst[key] + value
+  return dst
+
+
+class ChunkSelectionResult(object):
+  """
+  Selection result of a chunk processed in a worker, reduced to what is required for writing it.
+  """
+
+  def __init__(self, event, array):
+    super().__init__()
+
+    self.event = event
+    self.array = array
+
+  def to_ak(self) -> ak.Array:
+    return self.array
+
+
+class ChunkWriteCapture(object):
+  """
+  Stand-in for the chunked io handler of a task in a worker process, recording the arrays queued
+  for writing by the task instead of writing them.
+  """
+
+  def __init__(self):
+    super().__init__()
+
+    self.arrays = []
+
+  def queue(self, func, args=(), *_args, **_kwargs) -> None:
+    self.arrays.append(args[0])
+
+
+class ChunkFunctionRecorder(object):
+  """
+  Wrapper of the array function *inst* of a task in a worker process, passing empty selection
+  statistics and histograms per call to record the contributions of a chunk, as well as the event
+  mask of selection results. All other attributes are forwarded to *inst*.
+  """
+
+  def __init__(self, inst):
+    super().__init__()
+
+    self.inst = inst
+    self.reset()
+
+  def __getattr__(self, attr):
+    return getattr(self.inst, attr)
+
+  def reset(self) -> None:
+    self.stats = self.hists = self.event = None
+
+  def __call__(self, events, *args, **kwargs):
+    if "stats" in kwargs:
+      self.stats = kwargs["stats"] = defaultdict(float)
+    if "hists" in kwargs:
+      self.hists = kwargs["hists"] = DotDict()
+    output = self.inst(events, *args, **kwargs)
+    if isinstance(output, tuple) and len(output) == 2:
+      self.event = getattr(output[1], "event", None)
+    return output
+
+
+class ChunkFunctionProxy(object):
+  """
+  Stand-in for the array function *inst* of a task in the task process while its chunks are
+  processed by a :py:class:`ChunkPool`. Calls return the arrays written by a worker for the current
+  chunk and merge the selection statistics and histograms of the chunk into those passed to the
+  call. All other attributes are forwarded to *inst*.
+  """
+
+  def __init__(self, inst, task_family: str):
+    super().__init__()
+
+    self.inst = inst
+    self.task_family = task_family
+    self.set_chunk()
+
+  def __getattr__(self, attr):
+    return getattr(self.inst, attr)
+
+  def set_chunk(self, arrays=None, event=None, stats=None, hists=None) -> None:
+    self.arrays = arrays
+    self.event = event
+    self.stats = stats
+    self.hists = hists
+
+  def __call__(self, events, *args, stats=None, hists=None, **kwargs):
+    if stats is not None and self.stats is not None:
+      merge_chunk_results(stats, self.stats)
+    if hists is not None and self.hists is not None:
+      merge_chunk_results(hists, self.hists)
+
+    if self.task_family == "cf.SelectEvents":
+      # results are written first, followed by the columns if there are any
+      columns = self.arrays[1] if len(self.arrays) > 1 else events
+      return columns, ChunkSelectionResult(self.event, self.arrays[0])
+    return self.arrays[0]
+
+
+class ChunkPool(object):
+  """
+  Pool of *workers* processes that run the chunk loop of *task* on the chunks read in the task
+  process. :py:meth:`iter_chunks` is invoked by the ``iter_chunked_io`` method of the task and
+  forks the workers before the first chunk is read, so that each of them continues the run method
+  of the task with its set up array function and processes all chunks it receives with the
+  original code of the loop. Arrays queued for writing are sent back instead of being written.
+
+  Chunks are yielded to the loop in the task process in the order of their indices once their
+  output is available, while the array function is replaced by a :py:class:`ChunkFunctionProxy`
+  returning that output. Writing as well as the merging of statistics and histograms therefore
+  happens in the task process in a deterministic order. Values of task attributes in *chunk_attrs*
+  are sent along with each chunk, as they are updated per chunk by the reader. Each worker
+  processes one chunk at a time.
+  """
+
+  def __init__(self, task, workers: int, chunk_attrs: list[str] | None = None):
+    super().__init__()
+
+    if task.task_family not in chunk_function_attrs:
+      raise ValueError(f"chunk processing in worker processes not supported for {task.task_family}")
+
+    self.task = task
+    self.workers = workers
+    self.chunk_attrs = list(chunk_attrs or [])
+    self.inst_attr = chunk_function_attrs[task.task_family]
+
+  def _iter_worker(self, conn):
+    global _worker_conn
+    _worker_conn = conn
+
+    capture = ChunkWriteCapture()
+    recorder = ChunkFunctionRecorder(getattr(self.task, self.inst_attr))
+    setattr(self.task, self.inst_attr, recorder)
+    self.task.chunked_io = capture
+
+    from columnflow.columnar_util import ChunkedIOHandler
+
+    while True:
+      msg = conn.recv()
+      if msg is None:
+        break
+      chunk, pos, chunk_attrs = msg
+      for attr, value in chunk_attrs.items():
+        setattr(self.task, attr, value)
+      capture.arrays = []
+      recorder.reset()
+
+      pos = ChunkedIOHandler.ChunkPosition(*pos)
+      yield chunk, pos
+
+      conn.send(("done", pos.index, capture.arrays, recorder.event, recorder.stats, recorder.hists))
+
+    # leave without returning to the run method, which would write outputs
+    conn.close()
+    os._exit(0)
+
+  def iter_chunks(self, chunks):
+    # fork workers before reading starts, when no reader threads are running
+    conns, pids = [], []
+    for _ in range(self.workers):
+      conn, worker_conn = Pipe()
+      pid = os.fork()
+      if pid == 0:
+        conn.close()
+        for _conn in conns:
+          _conn.close()
+        yield from self._iter_worker(worker_conn)
+        os._exit(0)
+      worker_conn.close()
+      conns.append(conn)
+      pids.append(pid)
+
+    inst = getattr(self.task, self.inst_attr)
+    proxy = ChunkFunctionProxy(inst, self.task.task_family)
+    setattr(self.task, self.inst_attr, proxy)
+
+    # chunks sent to workers and outputs received from them, mapped to chunk indices
+    busy = {}
+    pending = {}
+    outputs = {}
+    next_index = 0
+
+    def receive(block):
+      for conn in wait(list(busy), timeout=None if block else 0):
+        try:
+          msg = conn.recv()
+        except EOFError:
+          raise Exception(f"chunk worker of {self.task.task_family} died unexpectedly")
+        if msg[0] == "error":
+          raise Exception(f"chunk worker of {self.task.task_family} failed:\n{msg[1]}")
+        outputs[msg[1]] = msg[2:]
+        del busy[conn]
+
+    def flush(drain):
+      nonlocal next_index
+      while True:
+        if next_index in outputs:
+          chunk, pos = pending.pop(next_index)
+          proxy.set_chunk(*outputs.pop(next_index))
+          yield chunk, pos
+          next_index += 1
+        elif drain and busy:
+          receive(True)
+        else:
+          break
+
+    try:
+      n_read = 0
+      for chunk, pos in chunks:
+        n_read += 1
+        pending[pos.index] = (chunk, pos)
+
+        # send the chunk to the next idle worker
+        while len(busy) == len(conns):
+          receive(True)
+          yield from flush(False)
+        conn = next(conn for conn in conns if conn not in busy)
+        chunk_attrs = {attr: getattr(self.task, attr, None) for attr in self.chunk_attrs}
+        conn.send((chunk, tuple(pos), chunk_attrs))
+        busy[conn] = pos.index
+
+        # the reader stops queueing writes after the last chunk it yields, so once all chunks
+        # are read, yield all of them before continuing it
+        receive(False)
+        yield from flush(n_read >= pos.n_chunks)
+      yield from flush(True)
+
+      for conn in conns:
+        conn.send(None)
+    except BaseException:
+      for pid in pids:
+        os.kill(pid, signal.SIGKILL)
+      raise
+    finally:
+      for conn in conns:
+        conn.close()
+      for pid in pids:
+        os.waitpid(pid, 0)
+      setattr(self.task, self.inst_attr, inst)
+      proxy.set_chunk()
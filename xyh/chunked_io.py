@@ -0,0 +1,224 @@
+# coding: utf-8
+
+"""
+Chunked reading with chunk sizes adapted to a memory budget.
+"""
+
+from __future__ import annotations
+
+import os
+import time
+import math
+import resource
+import threading
+
+import law
+
+from columnflow.columnar_util import ChunkedIOHandler, ChunkedParquetReader
+from columnflow.util import maybe_import
+
+ak = maybe_import("awkward")
+
+logger = law.logger.get_logger(__name__)
+
+
+def current_rss() -> int:
+  """
+  Return the current resident set size of this process in bytes, falling back to the peak resident
+  set size on systems without procfs.
+  """
+  try:
+    with open("/proc/self/statm", "r") as f:
+      return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except (OSError, ValueError, IndexError):
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RSSMonitor(object):
+  """
+  Background thread sampling the resident set size of this process every *interval* seconds and
+  recording its peak since the last :py:meth:`reset`. Short peaks between samples are covered by
+  the peak resident set size reported by the kernel, as long as it is exceeded.
+  """
+
+  def __init__(self, interval: float = 0.02):
+    super().__init__()
+
+    self.interval = interval
+    self.peak = current_rss()
+    self._maxrss = self._get_maxrss()
+
+    self._stop = threading.Event()
+    self._thread = None
+
+  @classmethod
+  def _get_maxrss(cls) -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+  def reset(self) -> int:
+    self.peak = current_rss()
+    self._maxrss = self._get_maxrss()
+    return self.peak
+
+  def get_peak(self) -> int:
+    maxrss = self._get_maxrss()
+    if maxrss > self._maxrss:
+      self.peak = max(self.peak, maxrss)
+    return self.peak
+
+  def _run(self):
+    while not self._stop.wait(self.interval):
+      self.peak = max(self.peak, current_rss())
+
+  def start(self) -> None:
+    self._stop.clear()
+    self._thread = threading.Thread(target=self._run, daemon=True)
+    self._thread.start()
+
+  def stop(self) -> int:
+    self._stop.set()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+    self.peak = max(self.peak, current_rss())
+    return self.get_peak()
+
+
+class AdaptiveChunkedIOHandler(ChunkedIOHandler):
+  """
+  Chunked IO handler that reads a first chunk of *probe_chunk_size* entries, measures its
+  decompressed size and the peak resident set size while it is processed, and reads all remaining
+  entries in chunks whose size is chosen such that the peak stays within *memory_budget* bytes.
+  The memory per entry is extrapolated linearly from the first chunk, also accounting for chunks
+  that are read ahead by the pool. Chunk sizes are bounded by *min_chunk_size* and
+  *max_chunk_size*. All other arguments are forwarded to :py:class:`ChunkedIOHandler`.
+
+  Chunk indices are consecutive, but the number of chunks is only known after the first chunk.
+  """
+
+  def __init__(
+    self,
+    *args,
+    memory_budget: int,
+    probe_chunk_size: int = 10_000,
+    min_chunk_size: int = 1_000,
+    max_chunk_size: int = 1_000_000,
+    name: str = "",
+    **kwargs,
+  ):
+    super().__init__(*args, **kwargs)
+
+    self.memory_budget = memory_budget
+    self.probe_chunk_size = max(probe_chunk_size, 1)
+    self.min_chunk_size = max(min_chunk_size, 1)
+    self.max_chunk_size = max(max_chunk_size, self.min_chunk_size)
+    self.name = name or self.__class__.__name__
+
+    # chunk positions of the current phase of the iteration
+    self._positions = None
+
+    # measurements, set during iteration
+    self.probe_entries = 0
+    self.probe_bytes = 0
+    self.baseline_rss = None
+    self.probe_peak_rss = None
+    self.peak_rss = None
+    self.adapted_chunk_size = None
+
+  @property
+  def n_chunks(self) -> int:
+    if self._positions is not None:
+      return len(self._positions)
+    return super().n_chunks
+
+  def create_chunk_position(self, n_entries: int, chunk_size: int, chunk_index: int):
+    if self._positions is not None:
+      return self._positions[chunk_index]
+    return super().create_chunk_position(n_entries, chunk_size, chunk_index)
+
+  def _make_positions(self, entry_start: int, chunk_size: int, index_start: int) -> list:
+    n_chunks = index_start + int(math.ceil((self.n_entries - entry_start) / chunk_size))
+    return [
+      self.ChunkPosition(index, start, min(start + chunk_size, self.n_entries), chunk_size, n_chunks)
+      for index, start in enumerate(range(entry_start, self.n_entries, chunk_size), index_start)
+    ]
+
+  def _map_parquet_groups(self, positions: list) -> None:
+    # parquet readers map chunks to row groups assuming equally sized chunks, so register the
+    # row groups of the given positions instead
+    for obj in self.source_objects:
+      if not isinstance(obj, ChunkedParquetReader):
+        continue
+      divisions = obj.group_divisions
+      with obj.chunk_to_groups_lock:
+        for pos in positions:
+          groups = [
+            g for g, (g_start, g_stop) in enumerate(zip(divisions[:-1], divisions[1:]))
+            if g_start < pos.entry_stop and g_stop > pos.entry_start
+          ]
+          obj.chunk_to_groups[pos.index] = groups
+          for g in groups:
+            obj.group_cache[g].chunks.add(pos.index)
+
+  def adapt_chunk_size(self) -> int:
+    """
+    Return the chunk size for the remaining entries given the measurements of the first chunk.
+    """
+    n = max(self.probe_entries, 1)
+    per_entry = max(self.probe_peak_rss - self.baseline_rss, self.probe_bytes, 1) / n
+    per_entry_read = self.probe_bytes / n
+    available = self.memory_budget - self.baseline_rss
+    if available <= 0:
+      logger.warning(
+        f"{self.name}: resident set size of {law.util.human_bytes(self.baseline_rss, fmt=True)} "
+        f"before reading already exceeds the memory budget of "
+        f"{law.util.human_bytes(self.memory_budget, fmt=True)}, using the minimum chunk size",
+      )
+      return self.min_chunk_size
+    chunk_size = int(available / (per_entry + self.pool_size * per_entry_read))
+    return min(max(chunk_size, self.min_chunk_size), self.max_chunk_size)
+
+  def _iter_impl(self):
+    if self.n_entries <= self.probe_chunk_size:
+      yield from super()._iter_impl()
+      return
+
+    monitor = RSSMonitor()
+    self.baseline_rss = monitor.reset()
+    monitor.start()
+    try:
+      # first phase, reading and processing a single chunk
+      self._positions = self._make_positions(0, self.probe_chunk_size, 0)[:1]
+      self._map_parquet_groups(self._positions)
+      for chunk, pos in super()._iter_impl():
+        chunks = chunk if self.is_multi else [chunk]
+        self.probe_entries = pos.entry_stop - pos.entry_start
+        self.probe_bytes = sum(c.nbytes for c in chunks if isinstance(c, ak.Array))
+        t1 = time.perf_counter()
+        yield chunk, pos
+        probe_duration = time.perf_counter() - t1
+      self.probe_peak_rss = monitor.get_peak()
+
+      # second phase, reading all remaining entries in adapted chunks
+      self.adapted_chunk_size = self.adapt_chunk_size()
+      self._positions = self._make_positions(self.probe_entries, self.adapted_chunk_size, 1)
+      self._map_parquet_groups(self._positions)
+      logger.info(
+        f"{self.name}: first chunk of {self.probe_entries:_} entries is "
+        f"{law.util.human_bytes(self.probe_bytes, fmt=True)} decompressed and raised the resident "
+        f"set size from {law.util.human_bytes(self.baseline_rss, fmt=True)} to "
+        f"{law.util.human_bytes(self.probe_peak_rss, fmt=True)} within "
+        f"{law.util.human_duration(seconds=probe_duration)}, reading the remaining "
+        f"{self.n_entries - self.probe_entries:_} entries in {len(self._positions)} chunks of "
+        f"{self.adapted_chunk_size:_} entries for a budget of "
+        f"{law.util.human_bytes(self.memory_budget, fmt=True)}",
+      )
+      yield from super()._iter_impl()
+    finally:
+      self._positions = None
+      self.peak_rss = monitor.stop()
+
+    logger.info(
+      f"{self.name}: observed peak resident set size of {law.util.human_bytes(self.peak_rss, fmt=True)} "
+      f"for a budget of {law.util.human_bytes(self.memory_budget, fmt=True)}",
+    )
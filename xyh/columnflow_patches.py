@@ -5,9 +5,13 @@ Collection of patches of underlying columnflow tasks.
 """
 
 import os
+import shutil
 
 import law
-from columnflow.util import memoize
+from columnflow.util import memoize, maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
 
 
 logger = law.logger.get_logger(__name__)
@@ -34,6 +38,706 @@ def patch_bundle_repo_exclude_files():
     logger.debug("patched exclude_files of cf.BundleRepo")
 
 
+class DeferredColumnReader(object):
+    """
+    Reads the *read_columns* of the nano *source_object* in a second phase for a subset of the
+    entries of the chunk at *chunk_pos*. Selected entries are grouped into contiguous entry ranges,
+    joining ranges that are separated by at most *max_gap* entries, so that baskets without any
+    selected entry are neither read nor decompressed. When the chunk refers to sampled entries, the
+    callable *entry_map* translates them to entries of the source object.
+
+    Pickled readers drop the source object, which is reopened from *source_path* once per process
+    when called.
+    """
+
+    # source objects reopened per process, mapped to their paths
+    _sources = {}
+
+    def __init__(
+        self,
+        source_object,
+        chunk_pos,
+        read_columns,
+        read_options=None,
+        max_gap=100,
+        entry_map=None,
+        source_path=None,
+    ):
+        super().__init__()
+
+        self.source_object = source_object
+        self.chunk_pos = chunk_pos
+        self.read_columns = read_columns
+        self.read_options = read_options
+        self.max_gap = max_gap
+        self.entry_map = entry_map
+        self.source_path = source_path
+
+    def __getstate__(self):
+        # chunk positions are namedtuples that cannot be pickled by reference
+        return dict(self.__dict__, source_object=None, chunk_pos=tuple(self.chunk_pos))
+
+    def __setstate__(self, state):
+        from columnflow.columnar_util import ChunkedIOHandler
+
+        self.__dict__.update(state, chunk_pos=ChunkedIOHandler.ChunkPosition(*state["chunk_pos"]))
+
+    def __call__(self, mask: np.ndarray) -> ak.Array:
+        from columnflow.columnar_util import (
+            ChunkedIOHandler, Route, attach_nano_schema, mandatory_coffea_columns,
+        )
+
+        if self.source_object is None:
+            if self.source_path not in self._sources:
+                self._sources[self.source_path] = ChunkedIOHandler.open_coffea_root(self.source_path)[0]
+            self.source_object = self._sources[self.source_path]
+
+        # build entry ranges in the source object
+        entries = self.chunk_pos.entry_start + np.flatnonzero(mask)
+        if self.entry_map is not None:
+            entries = self.entry_map(entries)
+        if len(entries):
+            breaks = np.flatnonzero(np.diff(entries) > self.max_gap + 1) + 1
+            starts = entries[np.concatenate([[0], breaks])]
+            stops = entries[np.concatenate([breaks - 1, [len(entries) - 1]])] + 1
+        else:
+            starts = stops = np.array([0])
+
+        # coffea requires the event id columns to build the nano schema
+        read_columns = set(self.read_columns) | set(map(Route, mandatory_coffea_columns))
+
+        parts = []
+        for start, stop in zip(starts, stops):
+            pos = self.chunk_pos._replace(entry_start=int(start), entry_stop=int(stop))
+            part = ChunkedIOHandler.read_uproot_root(
+                self.source_object,
+                pos,
+                read_options=self.read_options,
+                read_columns=read_columns,
+            )
+            selected = np.zeros(stop - start, dtype=bool)
+            selected[entries[(entries >= start) & (entries < stop)] - start] = True
+            parts.append(part[selected])
+
+        # the nano schema requires packed, non-indexed arrays
+        return attach_nano_schema(ak.to_packed(parts[0] if len(parts) == 1 else ak.concatenate(parts)))
+
+
+class SampledNanoSource(object):
+    """
+    Source handler for nano files of which only a deterministic random subset of entry blocks
+    covering the *fraction* of entries is read (see :py:func:`xyh.util.sample_entry_ranges`). The
+    handler exposes the sampled entries only, so that outputs of tasks reading nano files contain
+    the sampled events and stay aligned with each other.
+    """
+
+    def __init__(self, fraction, block_size=1000, seed=0, key=""):
+        super().__init__()
+
+        self.fraction = fraction
+        self.block_size = block_size
+        self.seed = seed
+        self.key = key
+
+        # sampled entry ranges and their offsets in the sampled entries, set in open()
+        self.starts = self.stops = self.offsets = None
+
+    def source_handler(self):
+        from columnflow.columnar_util import ChunkedIOHandler
+        return ChunkedIOHandler.SourceHandler("coffea_root", self.open, self.close, self.read)
+
+    def open(self, source, **kwargs):
+        from columnflow.columnar_util import ChunkedIOHandler
+        from xyh.util import sample_entry_ranges
+
+        source_object, n_entries = ChunkedIOHandler.open_coffea_root(source, **kwargs)
+        self.starts, self.stops = sample_entry_ranges(
+            n_entries,
+            self.fraction,
+            block_size=self.block_size,
+            seed=self.seed,
+            key=self.key,
+        )
+        self.offsets = np.concatenate([[0], np.cumsum(self.stops - self.starts)])
+
+        n_sampled = int(self.offsets[-1])
+        logger.debug(f"sampling {n_sampled} of {n_entries} entries in {len(self.starts)} ranges of {source}")
+
+        return source_object, n_sampled
+
+    def close(self, source_object):
+        from columnflow.columnar_util import ChunkedIOHandler
+        return ChunkedIOHandler.close_coffea_root(source_object)
+
+    def to_original(self, entries: np.ndarray) -> np.ndarray:
+        """
+        Translates sampled *entries* to entries of the nano file.
+        """
+        ranges = np.searchsorted(self.offsets, entries, side="right") - 1
+        return self.starts[ranges] + (entries - self.offsets[ranges])
+
+    def read(self, source_object, chunk_pos, read_options=None, read_columns=None):
+        from columnflow.columnar_util import ChunkedIOHandler, attach_nano_schema
+
+        # translate the chunk into entry ranges of the nano file
+        ranges = []
+        if chunk_pos.entry_stop > chunk_pos.entry_start:
+            bounds = [chunk_pos.entry_start, chunk_pos.entry_stop - 1]
+            first, last = np.searchsorted(self.offsets, bounds, side="right") - 1
+            for i in range(first, last + 1):
+                ranges.append((
+                    int(self.starts[i] + max(chunk_pos.entry_start - self.offsets[i], 0)),
+                    int(self.starts[i] + min(chunk_pos.entry_stop, self.offsets[i + 1]) - self.offsets[i]),
+                ))
+        else:
+            ranges.append((0, 0))
+
+        parts = [
+            ChunkedIOHandler.read_uproot_root(
+                source_object,
+                chunk_pos._replace(entry_start=start, entry_stop=stop),
+                read_options=read_options,
+                read_columns=read_columns,
+            )
+            for start, stop in ranges
+        ]
+
+        # the nano schema requires packed, non-indexed arrays
+        return attach_nano_schema(ak.to_packed(parts[0] if len(parts) == 1 else ak.concatenate(parts)))
+
+
+@memoize
+def patch_adaptive_chunking():
+    """
+    Enables chunk sizes adapted to a memory budget in all tasks reading chunks, when the
+    *chunked_io_adaptive* option in the analysis section of the law config is set. Budgets are
+    configured per task family in the *adaptive_chunking* auxiliary entry of the config, with fields
+    *memory_budget*, *probe_chunk_size*, *min_chunk_size* and *max_chunk_size* (see
+    :py:class:`xyh.chunked_io.AdaptiveChunkedIOHandler`).
+    """
+    from columnflow.tasks.framework.mixins import ChunkedIOMixin
+    from columnflow.columnar_util import ChunkedIOHandler
+
+    iter_chunked_io_orig = ChunkedIOMixin.iter_chunked_io
+
+    def iter_chunked_io(self, *args, **kwargs):
+        from xyh.chunked_io import AdaptiveChunkedIOHandler
+
+        chunking = self.config_inst.x("adaptive_chunking", None)
+        budget = (chunking or {}).get("memory_budget", {}).get(self.task_family)
+        if (
+            not law.config.get_expanded_bool("analysis", "chunked_io_adaptive", False) or
+            not budget or
+            (len(args) == 1 and isinstance(args[0], ChunkedIOHandler))
+        ):
+            yield from iter_chunked_io_orig(self, *args, **kwargs)
+            return
+
+        # default pool size as in columnflow, the chunk size of the first chunk is configured
+        if kwargs.get("pool_size") is None:
+            kwargs["pool_size"] = law.config.get_expanded_int(
+                "analysis",
+                f"{self.task_family}__chunked_io_pool_size",
+                self.default_pool_size,
+            )
+        kwargs.pop("chunk_size", None)
+        handler = AdaptiveChunkedIOHandler(
+            *args,
+            memory_budget=law.util.parse_bytes(budget, unit="bytes"),
+            probe_chunk_size=chunking.get("probe_chunk_size", 10_000),
+            min_chunk_size=chunking.get("min_chunk_size", 1_000),
+            max_chunk_size=chunking.get("max_chunk_size", 1_000_000),
+            name=self.task_family,
+            **{key: value for key, value in kwargs.items() if value is not None},
+        )
+
+        yield from iter_chunked_io_orig(self, handler)
+
+        if handler.adapted_chunk_size is not None:
+            self.publish_message(
+                f"adapted chunk size: {handler.adapted_chunk_size:_}, observed peak resident set size: "
+                f"{law.util.human_bytes(handler.peak_rss, fmt=True)} for a budget of "
+                f"{law.util.human_bytes(handler.memory_budget, fmt=True)}",
+            )
+
+    ChunkedIOMixin.iter_chunked_io = iter_chunked_io
+
+    logger.debug("patched iter_chunked_io of ChunkedIOMixin for adaptive chunking")
+
+
+@memoize
+def patch_event_sampling():
+    """
+    Enables deterministic event sampling in all tasks reading nano files, configured through the
+    *event_sampling* auxiliary entry of the config with fields *fraction*, *block_size* and *seed*.
+    Nano files are read through a :py:class:`SampledNanoSource`, keyed by the dataset and the file
+    indices of the branch, and the translation of sampled to nano entries is set as
+    *sampled_entry_map* on the task.
+
+    Normalization weights are computed from the sums of weights in the selection statistics, which
+    only contain sampled events, so that simulated yields are preserved.
+    """
+    from columnflow.tasks.calibration import CalibrateEvents
+    from columnflow.tasks.selection import SelectEvents
+    from columnflow.tasks.reduction import ReduceEvents
+    from columnflow.columnar_util import ChunkedIOHandler
+
+    # allow passing source handlers directly as source types
+    get_source_handler_orig = ChunkedIOHandler.get_source_handler
+
+    def get_source_handler(cls, source_type, source):
+        if isinstance(source_type, cls.SourceHandler):
+            return source_type
+        return get_source_handler_orig(source_type, source)
+
+    ChunkedIOHandler.get_source_handler = classmethod(get_source_handler)
+
+    def patch(task_cls):
+        iter_chunked_io_orig = task_cls.iter_chunked_io
+
+        def iter_chunked_io(self, paths, *args, **kwargs):
+            sampling = self.config_inst.x("event_sampling", None)
+            source_type = kwargs.get("source_type")
+            if not sampling or not source_type or source_type[0] != "coffea_root":
+                yield from iter_chunked_io_orig(self, paths, *args, **kwargs)
+                return
+
+            source = SampledNanoSource(
+                sampling["fraction"],
+                block_size=sampling.get("block_size", 1000),
+                seed=sampling.get("seed", 0),
+                key=f"{self.dataset}/{','.join(map(str, self.branch_data))}",
+            )
+            kwargs["source_type"] = [source.source_handler(), *source_type[1:]]
+
+            self.sampled_entry_map = source.to_original
+            try:
+                yield from iter_chunked_io_orig(self, paths, *args, **kwargs)
+            finally:
+                self.sampled_entry_map = None
+
+        task_cls.iter_chunked_io = iter_chunked_io
+
+        logger.debug(f"patched iter_chunked_io of {task_cls.task_family} for event sampling")
+
+    for task_cls in [CalibrateEvents, SelectEvents, ReduceEvents]:
+        patch(task_cls)
+
+
+@memoize
+def patch_select_events_deferred_columns():
+    """
+    Enables two-phase reading in cf.SelectEvents for selectors that define a set of
+    *deferred_columns*. These columns are not read from the nano input for all events, but a
+    :py:class:`DeferredColumnReader` for the current chunk is set as *deferred_column_reader* on the
+    task, which the selector can invoke after its preselection.
+    """
+    from columnflow.tasks.selection import SelectEvents
+    from columnflow.columnar_util import ChunkedIOHandler, Route
+
+    iter_chunked_io_orig = SelectEvents.iter_chunked_io
+
+    def iter_chunked_io(self, paths, *args, **kwargs):
+        deferred_columns = set(getattr(self.selector_inst, "deferred_columns", None) or [])
+
+        # columns produced by calibrators and aliased columns must be present for all events
+        for calibrator_inst in getattr(self, "calibrator_insts", []):
+            deferred_columns -= calibrator_inst.produced_columns
+        for src, dst in self.local_shift_inst.x("column_aliases", {}).items():
+            deferred_columns -= {Route(src), Route(dst)}
+
+        source_type = kwargs.get("source_type")
+        if not deferred_columns or not source_type or source_type[0] != "coffea_root":
+            yield from iter_chunked_io_orig(self, paths, *args, **kwargs)
+            return
+
+        # remove deferred columns from the first phase
+        read_columns = list(kwargs["read_columns"])
+        read_columns[0] = {Route(c) for c in read_columns[0]} - deferred_columns
+        kwargs["read_columns"] = read_columns
+        nano_read_options = (kwargs.get("read_options") or [None])[0]
+
+        nano_source, _ = ChunkedIOHandler.open_coffea_root(paths[0])
+        try:
+            for obj in iter_chunked_io_orig(self, paths, *args, **kwargs):
+                self.deferred_column_reader = DeferredColumnReader(
+                    nano_source,
+                    obj[1],
+                    deferred_columns,
+                    read_options=nano_read_options,
+                    entry_map=getattr(self, "sampled_entry_map", None),
+                    source_path=paths[0],
+                )
+                yield obj
+        finally:
+            self.deferred_column_reader = None
+            ChunkedIOHandler.close_coffea_root(nano_source)
+
+    SelectEvents.iter_chunked_io = iter_chunked_io
+
+    logger.debug("patched iter_chunked_io of cf.SelectEvents")
+
+
+@memoize
+def patch_reduce_events_shift_selection_columns():
+    """
+    Makes cf.ReduceEvents load columns starting with "shifts." from the selection result data, next
+    to the "steps." and "objects." columns, so that reducers can consume per-shift selection results
+    (see xyh.reduction.default.multi_shift). They are skipped when the selection results contain no
+    such field.
+    """
+    from columnflow.tasks.reduction import ReduceEvents
+    from columnflow.columnar_util import Route
+
+    iter_chunked_io_orig = ReduceEvents.iter_chunked_io
+
+    def iter_chunked_io(self, paths, *args, **kwargs):
+        read_columns = kwargs.get("read_columns")
+        if not read_columns or len(read_columns) < 2:
+            yield from iter_chunked_io_orig(self, paths, *args, **kwargs)
+            return
+
+        # the second input is the selection result data, all others read the same columns
+        is_shift_column = lambda r: Route(r).column.startswith("shifts.")
+        shift_columns = set(filter(is_shift_column, read_columns[0]))
+        if shift_columns:
+            import pyarrow.parquet as pq
+            read_columns = [
+                {r for r in columns if not is_shift_column(r)}
+                for columns in read_columns
+            ]
+            if "shifts" in pq.read_schema(paths[1]).names:
+                read_columns[1] |= shift_columns
+            kwargs["read_columns"] = read_columns
+
+        yield from iter_chunked_io_orig(self, paths, *args, **kwargs)
+
+    ReduceEvents.iter_chunked_io = iter_chunked_io
+
+    logger.debug("patched iter_chunked_io of cf.ReduceEvents")
+
+
+@memoize
+def patch_precision_policy():
+    """
+    Applies the precision policy defined in the *precision_policy* auxiliary entry of the config
+    for the task family of cf.ReduceEvents and cf.ProduceColumns to all event chunks right before
+    they are written (see xyh.reduction.precision).
+    """
+    from columnflow.tasks.reduction import ReduceEvents
+    from columnflow.tasks.production import ProduceColumns
+    from columnflow.columnar_util import sorted_ak_to_parquet
+    from xyh.reduction.precision import (
+        PrecisionValidation, get_precision_policy, apply_precision_policy,
+    )
+
+    def patch(task_cls):
+        iter_chunked_io_orig = task_cls.iter_chunked_io
+
+        def iter_chunked_io(self, *args, **kwargs):
+            policy = get_precision_policy(self.config_inst, self.task_family)
+            if not policy:
+                yield from iter_chunked_io_orig(self, *args, **kwargs)
+                return
+
+            # optional validation of deviations in all variables, evaluated on the written columns
+            validation = None
+            if self.config_inst.x("validate_precision_policy", False):
+                validation = PrecisionValidation(policy, self.config_inst.variables)
+
+            def queue(func, args=(), *_args, **_kwargs):
+                if func is sorted_ak_to_parquet and args:
+                    if validation is not None:
+                        validation.add(args[0])
+                    args = (apply_precision_policy(args[0], policy), *args[1:])
+                return queue_orig(func, args, *_args, **_kwargs)
+
+            for obj in iter_chunked_io_orig(self, *args, **kwargs):
+                # wrap the queue of the chunked io handler once to intercept writes
+                if self.chunked_io.queue is not queue:
+                    queue_orig = self.chunked_io.queue
+                    self.chunked_io.queue = queue
+
+                yield obj
+
+            if validation is not None:
+                self.publish_message("deviations induced by the precision policy per variable:")
+                for name, dev in validation.report().items():
+                    self.publish_message(
+                        f"  {name}: max abs {dev['max_abs_deviation']:.3g}, "
+                        f"max rel {dev['max_rel_deviation']:.3g}, "
+                        f"{dev['n_bin_migrations']} bin migrations, "
+                        f"max rel bin deviation {dev['max_rel_bin_deviation']:.3g}",
+                    )
+                if validation.skipped:
+                    self.publish_message(
+                        f"  not evaluable on written columns: {', '.join(sorted(validation.skipped))}",
+                    )
+
+        task_cls.iter_chunked_io = iter_chunked_io
+
+        logger.debug(f"patched iter_chunked_io of {task_cls.task_family}")
+
+    patch(ReduceEvents)
+    patch(ProduceColumns)
+
+
+@memoize
+def patch_index_view_rehydration():
+    """
+    Makes tasks that read reduced events rehydrate derived collections that were stored as index
+    views into their source collection (see xyh.reduction.index_views). Requested columns of such
+    collections are read from the source collection, so that producers, categorizers and variables
+    can access them unchanged.
+    """
+    from columnflow.tasks.production import ProduceColumns
+    from columnflow.tasks.histograms import CreateHistograms
+    from columnflow.tasks.ml import PrepareMLEvents, MLEvaluation
+    from columnflow.tasks.union import UniteColumns
+    from xyh.reduction.index_views import expand_index_view_columns, rehydrate_index_views
+
+    def patch(task_cls):
+        iter_chunked_io_orig = task_cls.iter_chunked_io
+
+        def iter_chunked_io(self, *args, **kwargs):
+            views = self.config_inst.x("index_view_collections", {})
+            if not views or not kwargs.get("read_columns"):
+                yield from iter_chunked_io_orig(self, *args, **kwargs)
+                return
+
+            # the reduced events are the first input, all others read the same columns
+            kwargs["read_columns"] = [
+                expand_index_view_columns(columns, views)
+                for columns in kwargs["read_columns"]
+            ]
+
+            for (events, *columns), pos in iter_chunked_io_orig(self, *args, **kwargs):
+                yield (rehydrate_index_views(events, views), *columns), pos
+
+        task_cls.iter_chunked_io = iter_chunked_io
+
+        logger.debug(f"patched iter_chunked_io of {task_cls.task_family}")
+
+    for task_cls in [ProduceColumns, CreateHistograms, PrepareMLEvents, MLEvaluation, UniteColumns]:
+        patch(task_cls)
+
+
+@memoize
+def patch_bundle_external_files_store():
+    """
+    Makes cf.BundleExternalFiles create its bundle from the content-addressed store configured in
+    the *external_file_store* auxiliary entry of the config (see xyh.external_store), fetching
+    missing files into the store in parallel first. The original run method creates the bundle,
+    with downloads served from the store. In offline mode, files are resolved from the store only.
+    Bundle and file names are unchanged.
+    """
+    from columnflow import env_is_local
+    import columnflow.tasks.external as cf_external
+    from xyh.external_store import ExternalFileStore, flatten_external_files
+
+    run_orig = cf_external.BundleExternalFiles.run
+
+    def run(self):
+        store = ExternalFileStore.from_config(self.config_inst)
+        bundle = self.output()["bundle"]
+        if store is None or not env_is_local or (bundle.exists() and not self.recreate):
+            return run_orig(self)
+
+        # prefetch in parallel and map locations to stored paths
+        paths = store.prefetch(self.config_inst.x.external_files)
+        stored = {
+            ext_file.location: paths[key]
+            for key, ext_file in flatten_external_files(self.config_inst.x.external_files).items()
+        }
+
+        def wget(src, dst):
+            path = stored.get(src) or store.get(src)
+            if os.path.isdir(path):
+                shutil.copytree(path, dst)
+            else:
+                shutil.copy2(path, dst)
+
+        # let the original run create the bundle, downloading from the store
+        wget_orig = cf_external.wget
+        cf_external.wget = wget
+        try:
+            return run_orig(self)
+        finally:
+            cf_external.wget = wget_orig
+
+    cf_external.BundleExternalFiles.run = run
+
+    logger.debug("patched run of cf.BundleExternalFiles")
+
+
+@memoize
+def patch_correction_luts():
+    """
+    Replaces the correctionlib correctors of the cf.jet_veto_map selector and the cf.muon_weights
+    producer by dense lookup tables (see xyh.production.correction_luts) after their setup, when
+    enabled in the *correction_luts* auxiliary entry of the config. Corrections that are not purely
+    binned keep their correctionlib corrector.
+    """
+    from columnflow.selection.cms.jets import jet_veto_map
+    from columnflow.production.cms.muon import muon_weights
+    from xyh.production.correction_luts import correction_lut_or
+
+    def patch(func_cls, attr, get_file):
+        setup_func_orig = func_cls.setup_func
+
+        def setup_func(self, task, reqs, **kwargs):
+            setup_func_orig(self, task=task, reqs=reqs, **kwargs)
+
+            luts = self.config_inst.x("correction_luts", None)
+            if not luts or not luts.get("enabled", True):
+                return
+            corrector = correction_lut_or(
+                getattr(self, attr),
+                get_file(self, reqs["external_files"].files),
+                cache_dir=luts.get("cache_dir"),
+            )
+            setattr(self, attr, corrector)
+
+        func_cls.setup_func = setup_func
+
+        logger.debug(f"patched setup of {func_cls.cls_name} to use correction lookup tables")
+
+    patch(jet_veto_map, "veto_map", lambda self, files: self.get_veto_map_file(files))
+    patch(muon_weights, "muon_sf_corrector", lambda self, files: self.get_muon_file(files))
+
+
+@memoize
+def patch_chunk_workers():
+    """
+    Adds a *chunk_workers* parameter to cf.CalibrateEvents, cf.SelectEvents and cf.ProduceColumns,
+    defaulting to the *chunked_io_workers* option in the analysis section of the law config. With
+    more than one worker, chunks of a branch are processed in a pool of forked worker processes that
+    continue the chunk loop of the run method with the set up calibrator, selector or producer,
+    while reading and writing stay in the task process and outputs are written in chunk order (see
+    :py:class:`xyh.chunk_pool.ChunkPool`). Selection statistics and histograms of all chunks are
+    merged in the task process. Failures in worker processes are reported to the task process.
+    """
+    import luigi
+    from columnflow.tasks.calibration import CalibrateEvents
+    from columnflow.tasks.selection import SelectEvents
+    from columnflow.tasks.production import ProduceColumns
+    from xyh.chunk_pool import ChunkPool, exit_worker_on_failure
+
+    default_workers = law.config.get_expanded_int("analysis", "chunked_io_workers", 1)
+
+    def patch(task_cls):
+        iter_chunked_io_orig = task_cls.iter_chunked_io
+
+        def iter_chunked_io(self, *args, **kwargs):
+            chunks = iter_chunked_io_orig(self, *args, **kwargs)
+            if self.chunk_workers <= 1:
+                yield from chunks
+                return
+
+            pool = ChunkPool(self, self.chunk_workers, chunk_attrs=["deferred_column_reader"])
+            yield from pool.iter_chunks(chunks)
+
+        task_cls.iter_chunked_io = iter_chunked_io
+
+        run_orig = task_cls.run
+
+        def run(self, *args, **kwargs):
+            try:
+                return run_orig(self, *args, **kwargs)
+            except BaseException:
+                # exceptions raised in worker processes must not reach the task scheduling
+                exit_worker_on_failure()
+                raise
+
+        task_cls.run = run
+        task_cls.chunk_workers = luigi.IntParameter(
+            default=default_workers,
+            significant=False,
+            description="number of worker processes for processing chunks of a branch; chunks are "
+            f"processed in the task process when 1 or less; default: {default_workers}",
+        )
+
+        logger.debug(f"patched iter_chunked_io of {task_cls.task_family} for chunk workers")
+
+    for task_cls in [CalibrateEvents, SelectEvents, ProduceColumns]:
+        patch(task_cls)
+
+
+@memoize
+def patch_merge_shifted_histograms_overlap_check():
+    """
+    Makes cf.MergeShiftedHistograms verify that each bin of the shift axis is populated by the input
+    of at most one shift, so that shifts filled in more than one task, such as weight shifts filled
+    in the nominal task (see xyh.histogramming.default.all_weights_sparse), are never counted twice
+    in the merged histogram.
+    """
+    from columnflow.tasks.histograms import MergeShiftedHistograms
+
+    modify_input_hist_orig = MergeShiftedHistograms.modify_input_hist
+
+    def modify_input_hist(self, shift, variable, h):
+        h = modify_input_hist_orig(self, shift, variable, h)
+
+        if "shift" not in h.axes.name:
+            return h
+        shift_axis = h.axes.name.index("shift")
+        values = h.values()
+        populated = np.any(values != 0, axis=tuple(i for i in range(values.ndim) if i != shift_axis))
+
+        # shift bins mapped to the shift whose input populated them, per variable
+        shifts = self.__dict__.setdefault("_populated_shifts", {}).setdefault(variable, {})
+        for shift_bin, is_populated in zip(h.axes["shift"], populated):
+            if is_populated and shifts.setdefault(shift_bin, shift) != shift:
+                raise Exception(
+                    f"shift bin '{shift_bin}' of histogram '{variable}' is populated in the inputs "
+                    f"of both shifts '{shifts[shift_bin]}' and '{shift}', merging would count it twice",
+                )
+
+        return h
+
+    MergeShiftedHistograms.modify_input_hist = modify_input_hist
+
+    logger.debug("patched modify_input_hist of cf.MergeShiftedHistograms")
+
+
+@memoize
+def patch_sparse_histogram_merge():
+    """
+    Makes cf.MergeHistograms merge :py:class:`xyh.histogramming.default.SparseHistogram` inputs in
+    a single vectorized step. columnflow's sum_hists adds histograms pair by pair, which allocates
+    the union of all slices again for each input, so that merging sparse histograms would be as
+    slow as merging dense ones.
+    """
+    import columnflow.tasks.histograms
+    from xyh.histogramming.default import SparseHistogram
+
+    sum_hists_orig = columnflow.tasks.histograms.sum_hists
+
+    def sum_hists(hists):
+        hists = list(hists)
+        if hists and all(isinstance(h, SparseHistogram) for h in hists):
+            return SparseHistogram.merge(hists)
+        return sum_hists_orig(hists)
+
+    columnflow.tasks.histograms.sum_hists = sum_hists
+
+    logger.debug("patched sum_hists of cf.MergeHistograms for sparse histograms")
+
+
 @memoize
 def patch_all():
     patch_bundle_repo_exclude_files()
+    patch_bundle_external_files_store()
+    # applied first, as patches of tasks wrap the iter_chunked_io of the mixin
+    patch_adaptive_chunking()
+    # applied next, as other patches adjust the arguments of iter_chunked_io
+    patch_event_sampling()
+    patch_select_events_deferred_columns()
+    patch_reduce_events_shift_selection_columns()
+    patch_precision_policy()
+    patch_index_view_rehydration()
+    patch_correction_luts()
+    patch_sparse_histogram_merge()
+    patch_merge_shifted_histograms_overlap_check()
+    # process chunks in workers last, to receive chunks from all other patches
+    patch_chunk_workers()
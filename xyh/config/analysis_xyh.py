@@ -82,3 +82,10 @@ config_2022pre_limited = add_config(
   config_id=12,
   limit_dataset_files=1,
 )
+config_2022pre_sampled = add_config(
+  analysis_xyh,
+  campaign_run3_2022_preEE_nano_v12.copy(),
+  config_name="config_2022pre_sampled",
+  config_id=13,
+  event_fraction=0.01,
+)
@@ -23,6 +23,10 @@ from cmsdb.util import add_decay_process
 from xyh.config.analysis_xyh import analysis_xyh
 from xyh.config.categories import add_all_categories
 from xyh.config.variables import add_variables
+from xyh.config.versioning import ContentHashVersions
+from xyh.production.weight_matrix import (
+  register_weight_matrix, add_weight_matrix_aliases, pdf_variations, murf_variations,
+)
 from columnflow.config_util import (
     get_root_processes_from_campaign, add_shift_aliases,
 )
@@ -36,6 +40,11 @@ def add_config(
   config_name: str | None = None,
   config_id: int | None = None,
   limit_dataset_files: int | None = None,
+  event_fraction: float | None = None,
+  event_sampling_seed: int = 0,
+  weight_matrices: bool = False,
+  precision_policy: bool = False,
+  validate_precision_policy: bool = False,
 ) -> od.Config:
   assert campaign.x.year in [2022, 2023]
   if campaign.x.year == 2022:
@@ -183,8 +192,10 @@ def add_config(
   # default calibrator, selector, producer, ml model and inference model
   cfg.x.default_calibrator = "default" # "skip_jecunc" TODO: use this one?
   cfg.x.default_selector = "default"
+  cfg.x.default_reducer = "default"
   cfg.x.default_producer = "default"
   cfg.x.default_weight_producer = "all_weights"
+  cfg.x.default_hist_producer = "sparse"
   cfg.x.default_ml_model = None
   cfg.x.default_inference_model = "example"
   cfg.x.default_categories = ["cat_incl"]
@@ -257,6 +268,10 @@ def add_config(
   else:
     raise NotImplementedError(f"Luminosity for year {year} is not defined.")
 
+  if event_fraction:
+    # data events are sampled as well, so simulation is normalized to the sampled luminosity
+    cfg.x.luminosity = cfg.x.luminosity * event_fraction
+
   # MET filters
   # TODO: Different Met filters for different years
   # https://twiki.cern.ch/twiki/bin/view/CMS/MissingETOptionalFiltersRun2?rev=158#2018_2017_data_and_MC_UL
@@ -279,6 +294,15 @@ def add_config(
   # whether to validate the number of obtained LFNs in GetDatasetLFNs
   cfg.x.validate_dataset_lfns = limit_dataset_files is None
 
+  # optional deterministic sampling of the fraction of events in all files of each dataset, reading
+  # random blocks of consecutive entries (see xyh.columnflow_patches.patch_event_sampling)
+  if event_fraction:
+    cfg.x.event_sampling = DotDict({
+      "fraction": event_fraction,
+      "block_size": 1000,
+      "seed": event_sampling_seed,
+    })
+
   # jec configuration
   # https://twiki.cern.ch/twiki/bin/view/CMS/JECDataMC?rev=201
   jerc_postfix = ""
@@ -443,6 +467,19 @@ def add_config(
       # extend existing or register new column aliases
       shift.set_aux(alias_type, shift.get_aux(alias_type, {})).update(_aliases)
 
+  # per-event variation matrices of weight families, replacing their scalar variation columns
+  # (see xyh.production.weight_matrix)
+  cfg.x.weight_matrices = DotDict(enabled=weight_matrices, families=DotDict())
+  register_weight_matrix(cfg, "btag_weight", [
+    f"{unc}_{direction}"
+    for unc in ["hf", "lf", "hfstats1", "hfstats2", "lfstats1", "lfstats2", "cferr1", "cferr2"] + [
+      f"jec_{source or 'Total'}" for source in cfg.x.btag_sf_jec_sources
+    ]
+    for direction in ["up", "down"]
+  ])
+  register_weight_matrix(cfg, "pdf_weight", pdf_variations)
+  register_weight_matrix(cfg, "murf_weight", murf_variations)
+
   # register shifts
   # TODO: make shifts year-dependent
   cfg.add_shift(name="nominal", id=0)
@@ -467,10 +504,18 @@ def add_config(
   cfg.add_shift(name="muon_down", id=52, type="shape")
   add_shift_aliases(cfg, "muon", {"muon_weight": "muon_weight_{direction}"})  
 
-  btag_uncs = []
+  # b-tag uncertainties are only available through the btag weight matrix, except for jec sources
+  # whose variations are only produced in tasks of jec shifts
+  btag_uncs = [
+    unc[:-len("_up")]
+    for unc in cfg.x.weight_matrices.families.btag_weight
+    if unc.endswith("_up") and not unc.startswith("jec_")
+  ] if weight_matrices else []
   for i, unc in enumerate(btag_uncs):
     cfg.add_shift(name=f"btag_{unc}_up", id=100 + 2 * i, type="shape")
     cfg.add_shift(name=f"btag_{unc}_down", id=101 + 2 * i, type="shape")
+    if weight_matrices:
+      add_weight_matrix_aliases(cfg, f"btag_{unc}", {"btag_weight": ("btag_weight", f"{unc}_{{direction}}")})
 
   cfg.add_shift(name="mur_up", id=201, type="shape")
   cfg.add_shift(name="mur_down", id=202, type="shape")
@@ -482,6 +527,11 @@ def add_config(
   cfg.add_shift(name="pdf_down", id=208, type="shape")
 
   for unc in ["mur", "muf", "murf_envelope", "pdf"]:
+    if weight_matrices:
+      family = "pdf_weight" if unc == "pdf" else "murf_weight"
+      variation = "{direction}" if unc == "pdf" else f"{unc}_{{direction}}"
+      add_weight_matrix_aliases(cfg, unc, {f"{unc}_weight": (family, variation)})
+      continue
     add_aliases(
       unc,
       {f"normalized_{unc}_weight": f"normalized_{unc}_weight_" + "{direction}"},
@@ -574,6 +624,41 @@ def add_config(
   else:
     raise NotImplementedError(f"No lumi and pu files provided for year {year}")
 
+  # optional content-addressed local store at XYH_EXTERNAL_FILE_STORE that external files are
+  # fetched into once and bundled from, resolving them exclusively from the store when
+  # XYH_EXTERNAL_FILES_OFFLINE is set (see xyh.external_store)
+  if os.getenv("XYH_EXTERNAL_FILE_STORE"):
+    cfg.x.external_file_store = DotDict({
+      "path": os.environ["XYH_EXTERNAL_FILE_STORE"],
+      "offline": law.util.flag_to_bool(os.getenv("XYH_EXTERNAL_FILES_OFFLINE", "false")),
+    })
+
+  # evaluate purely binned corrections through dense lookup tables, cached per correction file
+  # (see xyh.production.correction_luts)
+  cfg.x.correction_luts = DotDict({
+    "enabled": True,
+    "cache_dir": os.path.join(os.getenv("CF_DATA", os.path.join(thisdir, "..", "..", "data")), "correction_luts"),
+  })
+
+  # memory budgets per task family for adaptive chunk sizes, enabled with chunked_io_adaptive in the
+  # law config (see xyh.chunked_io)
+  cfg.x.adaptive_chunking = DotDict({
+    "memory_budget": {
+      "cf.CalibrateEvents": "2GB",
+      "cf.SelectEvents": "3GB",
+      "cf.ReduceEvents": "3GB",
+      "cf.ProduceColumns": "2GB",
+    },
+    "probe_chunk_size": 10_000,
+    "min_chunk_size": 1_000,
+    "max_chunk_size": 500_000,
+  })
+
+  # derived jet collections that are stored as index views into the reduced Jet collection instead
+  # of copies, mapped to their source collection (see xyh.reduction.index_views); ForwardJet is not
+  # a subset of the selected Jet collection and can therefore not be stored as a view
+  cfg.x.index_view_collections = {"Bjet": "Jet"}
+
   # columns to keep after certain steps
   cfg.x.keep_columns = DotDict.wrap({
     "cf.SelectEvents": {"mc_weight"},
@@ -599,10 +684,10 @@ def add_config(
       for jet_obj in ["Jet"]
       # NOTE: if we run into storage troubles, skip Bjet and Lightjet
       for field in ["pt", "eta", "phi", "mass", "genJetIdx", "btagDeepFlavB", "hadronFlavour", "rawFactor"]
-    ) | set(  # BJets
+    ) | set(  # BJets, unless stored as index views
       f"{jet_obj}.{field}"
       for jet_obj in ["Bjet"]
-      # NOTE: if we run into storage troubles, skip Bjet and Lightjet
+      if jet_obj not in cfg.x.index_view_collections
       for field in ["pt", "eta", "phi", "mass", "btagDeepFlavB", "hadronFlavour"]
     ) | set(  # Muons
       f"{mu_obj}.{field}"
@@ -626,6 +711,28 @@ def add_config(
       for field in ["pt", "eta", "phi", "mass","hadronFlavour"]
     )
   )
+  # weight matrices not covered by the patterns above
+  if weight_matrices:
+    cfg.x.keep_columns["cf.ReduceEvents"].add("murf_weight_matrix")
+
+  # lossy precision of columns written by certain tasks, see xyh.reduction.precision for the specs,
+  # only applied when enabled for this config; the induced deviations in all variables are only
+  # reported when validation is enabled separately, as it evaluates all variables per chunk
+  cfg.x.precision_policy = DotDict()
+  cfg.x.validate_precision_policy = validate_precision_policy
+  if precision_policy:
+    cfg.x.precision_policy["cf.ReduceEvents"] = {
+      # angles with a relative precision of ~1e-4
+      "{Jet,Bjet,Muon,Electron,GenJet,GenPart}.{eta,phi}": ("mantissa", 12),
+      "{MET,GenMET}.phi": ("mantissa", 12),
+      # momenta in steps of 10 MeV, masses with a relative precision of ~5e-4
+      "{Jet,Bjet,Muon,Electron,GenJet,GenPart,MET,GenMET}.pt": ("fixed", 0.01),
+      "{Jet,Bjet,Muon,Electron,GenJet,GenPart}.mass": ("mantissa", 10),
+      # small integers
+      "{Jet,Bjet,GenJet}.hadronFlavour": "int8",
+      "{Muon,Electron}.pdgId": "int8",
+      "Jet.genJetIdx": "int16",
+    }
 
   # event weight columns as keys in an ordered dict, mapped to shift instances they depend on
   # get_shifts = lambda *keys: sum(([cfg.get_shift(f"{k}_up"), cfg.get_shift(f"{k}_down")] for k in keys), [])
@@ -641,25 +748,52 @@ def add_config(
     "btag_weight": [],
   })
 
+  # weights varied through weight matrices, only produced when enabled
+  if weight_matrices:
+    get_shifts = lambda *keys: sum(([cfg.get_shift(f"{k}_up"), cfg.get_shift(f"{k}_down")] for k in keys), [])
+    cfg.x.event_weights["btag_weight"] = get_shifts(*(f"btag_{unc}" for unc in btag_uncs))
+    for unc in ["mur", "muf", "murf_envelope", "pdf"]:
+      cfg.x.event_weights[f"{unc}_weight"] = get_shifts(unc)
+
   for dataset in cfg.datasets:
     if dataset.x("is_ttbar", False):
       dataset.x.event_weights = {"top_pt_weight": []}
 
   prod_version = "v1"
 
-  # Version of required tasks
-  cfg.x.versions = {
-      "cf.CalibrateEvents": prod_version, # "v0",
-      "cf.SelectEvents": prod_version,
-      "cf.MergeSelectionStats": prod_version,
-      "cf.MergeSelectionMasks": prod_version,
-      "cf.ReduceEvents": prod_version,
-      "cf.MergeReductionStats": prod_version,
-      "cf.MergeReduceEvents": prod_version,
-      "cf.ProvideReducedEvents": prod_version,
-      "cf.ProduceColumns": prod_version,
+  # optionally derive versions of required tasks from a hash of their inputs, prefixed with
+  # prod_version, so that outputs are reused as long as the code and config entries they depend on
+  # are unchanged (outputs of plain prod_version versions are not reused)
+  cfg.x.auto_versions = False
+
+  # config entries that enter the version hash, per task family
+  cfg.x.version_hash_aux = {
+    "cf.CalibrateEvents": ["event_sampling", "external_files", "jec", "jer"],
+    "cf.SelectEvents": [
+      "jet_pt", "b_tagger", "btag_column", "btag_wp", "btag_wp_score", "external_files",
+      "met_filters", "weight_matrices",
+    ],
+    "cf.MergeSelectionMasks": [("keep_columns", "cf.MergeSelectionMasks")],
+    "cf.ReduceEvents": [("keep_columns", "cf.ReduceEvents"), "precision_policy", "index_view_collections"],
+    "cf.ProduceColumns": ["external_files", "precision_policy", "weight_matrices"],
   }
 
+  # Version of required tasks
+  if cfg.x.auto_versions:
+    cfg.x.versions = ContentHashVersions(cfg, prod_version, cfg.x.version_hash_aux).versions()
+  else:
+    cfg.x.versions = {
+        "cf.CalibrateEvents": prod_version, # "v0",
+        "cf.SelectEvents": prod_version,
+        "cf.MergeSelectionStats": prod_version,
+        "cf.MergeSelectionMasks": prod_version,
+        "cf.ReduceEvents": prod_version,
+        "cf.MergeReductionStats": prod_version,
+        "cf.MergeReducedEvents": prod_version,
+        "cf.ProvideReducedEvents": prod_version,
+        "cf.ProduceColumns": prod_version,
+    }
+
   # add categories
 
   add_variables(cfg)
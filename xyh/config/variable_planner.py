@@ -0,0 +1,192 @@
+# coding: utf-8
+
+"""
+Shared evaluation of variable expressions during histogramming.
+"""
+
+from __future__ import annotations
+
+import weakref
+from collections import defaultdict
+
+import law
+import order as od
+
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+logger = law.logger.get_logger(__name__)
+
+
+class PlannedExpression(object):
+  """
+  Base class of variable expressions reading the *field* of an object *collection*, whose
+  intermediate results can be shared with other planned expressions of the same chunk of events.
+
+  When *events* carry a :py:class:`VariableChunk` attached by a :py:class:`VariableEvaluationPlanner`,
+  evaluation is forwarded to it, and otherwise done directly. Expressions are stateless, so that
+  variables can be evaluated in any context.
+  """
+
+  def __init__(self, collection: str, field: str = "pt"):
+    super().__init__()
+
+    self.collection = collection
+    self.field = field
+
+  def evaluate(self, events: ak.Array) -> ak.Array:
+    raise NotImplementedError
+
+  def __call__(self, events: ak.Array) -> ak.Array:
+    chunk = VariableChunk.get(events)
+    if chunk is None:
+      return self.evaluate(events)
+    return chunk.evaluate(events, self)
+
+
+class ObjectCount(PlannedExpression):
+  """
+  Variable expression counting the objects of a *collection*, equivalent to
+  ``lambda events: ak.num(events[collection][field], axis=1)``, sharing counts with other
+  variables of the same collection.
+  """
+
+  def evaluate(self, events: ak.Array) -> ak.Array:
+    return ak.num(events[self.collection][self.field], axis=1)
+
+
+class ObjectField(PlannedExpression):
+  """
+  Variable expression looking up the *field* of the object at *index* in a *collection*,
+  equivalent to the route ``"<collection>.<field>[:,<index>]"`` evaluated with *null_value*.
+  Missing objects are masked when *null_value* is *None*. Lookups of the same collection share a
+  single padding to the maximum requested index.
+  """
+
+  def __init__(self, collection: str, field: str, index: int, null_value: float | None = None):
+    super().__init__(collection, field)
+
+    self.index = index
+    self.null_value = null_value
+
+  def evaluate(self, events: ak.Array) -> ak.Array:
+    values = ak.pad_none(events[self.collection][self.field], self.index + 1, axis=1)[:, self.index]
+    return values if self.null_value is None else ak.fill_none(values, self.null_value)
+
+
+class VariableEvaluationPlanner(object):
+  """
+  Planner of the :py:class:`PlannedExpression` objects of *variable_insts*, evaluating shared
+  sub-expressions once per chunk of events instead of once per variable.
+
+  - :py:class:`ObjectField` lookups of the same collection share a single padding of the
+    collection to the maximum requested index, from which each field is extracted once as a dense
+    2-D array. Variables are then plain column lookups in that array.
+  - :py:class:`ObjectCount` expressions share the object counts that are also used for padding.
+
+  Planners are owned by the hist producer of a task, which starts a new :py:class:`VariableChunk`
+  for each chunk of events through :py:meth:`start_chunk`.
+  """
+
+  def __init__(self, variable_insts: list[od.Variable]):
+    super().__init__()
+
+    # number of objects to pad each collection to
+    self.collection_sizes = defaultdict(int)
+    for variable_inst in variable_insts:
+      expr = variable_inst.expression
+      if isinstance(expr, ObjectField):
+        self.collection_sizes[expr.collection] = max(self.collection_sizes[expr.collection], expr.index + 1)
+
+  def start_chunk(self, events: ak.Array) -> VariableChunk:
+    """
+    Create a :py:class:`VariableChunk` caching intermediate results of *events* and attach it to
+    them, so that planned expressions evaluated on *events* share these results.
+    """
+    chunk = VariableChunk(self, events)
+    events.attrs[VariableChunk.attr] = chunk
+    return chunk
+
+
+class VariableChunk(object):
+  """
+  Cache of the intermediate results of planned expressions evaluated on a single chunk of *events*.
+  It is attached to the event array as a transient attribute and only used for that very array,
+  while other arrays that inherited the attribute, e.g. through masking, are evaluated directly.
+  """
+
+  # transient attribute of awkward arrays, not propagated when pickling
+  attr = "@xyh_variable_chunk"
+
+  def __init__(self, planner: VariableEvaluationPlanner, events: ak.Array):
+    super().__init__()
+
+    self.planner = planner
+    self.events = weakref.ref(events)
+    self.cache = {}
+    self.stats = defaultdict(int)
+    self.stats["n_events"] = len(events)
+
+  @classmethod
+  def get(cls, events: ak.Array) -> VariableChunk | None:
+    """
+    Return the chunk attached to *events*, or *None* if there is no chunk of this event array.
+    """
+    chunk = events.attrs.get(cls.attr) if isinstance(events, ak.Array) else None
+    if chunk is None or chunk.events() is not events:
+      return None
+    return chunk
+
+  def log_stats(self) -> None:
+    stats = self.stats
+    n_evaluated = stats["n_paddings"] + stats["n_extractions"] + stats["n_evaluations"]
+    logger.debug(
+      f"evaluated {stats['n_requests']} variables for {stats['n_events']} events with "
+      f"{stats['n_paddings']} collection paddings, {stats['n_extractions']} field extractions and "
+      f"{stats['n_evaluations']} other evaluations ({stats['n_requests'] - n_evaluated} saved)",
+    )
+
+  def _cached(self, key: tuple, func, counter: str):
+    if key not in self.cache:
+      self.cache[key] = func()
+      self.stats[counter] += 1
+    return self.cache[key]
+
+  def evaluate(self, events: ak.Array, expr: PlannedExpression) -> ak.Array:
+    """
+    Evaluate *expr* on the *events* of this chunk, reusing all shared intermediate results.
+    """
+    self.stats["n_requests"] += 1
+
+    collection = expr.collection
+    counts = self._cached(
+      ("num", collection),
+      lambda: ak.to_numpy(ak.num(events[collection], axis=1)),
+      "n_evaluations",
+    )
+    if isinstance(expr, ObjectCount):
+      return ak.Array(counts)
+
+    # indexed field lookup in the padded collection
+    index = expr.index
+    size = max(self.planner.collection_sizes[collection], index + 1)
+    padded = self._cached(
+      ("pad", collection, size),
+      lambda: ak.pad_none(events[collection], size, axis=1, clip=True),
+      "n_paddings",
+    )
+    present = self._cached(
+      ("present", collection, size),
+      lambda: np.arange(size)[None, :] < counts[:, None],
+      "n_evaluations",
+    )
+    values = self._cached(
+      ("field", collection, expr.field, size),
+      lambda: ak.to_numpy(ak.fill_none(padded[expr.field], 0)).reshape(len(events), size),
+      "n_extractions",
+    )
+    if expr.null_value is None:
+      return ak.mask(values[:, index], present[:, index])
+    return ak.Array(np.where(present[:, index], values[:, index], expr.null_value))
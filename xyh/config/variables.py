@@ -9,6 +9,8 @@ import order as od
 from columnflow.util import maybe_import
 from columnflow.columnar_util import EMPTY_FLOAT
 
+from xyh.config.variable_planner import ObjectCount, ObjectField
+
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
@@ -70,7 +72,7 @@ def add_variables(config: od.Config) -> None:
 
   config.add_variable(
     name="n_jets",
-    expression=lambda events: ak.num(events.Jet["pt"], axis=1),
+    expression=ObjectCount("Jet"),
     aux={"inputs": {"Jet.pt"}},
     binning=(12, -0.5, 11.5),
     discrete_x=True,
@@ -79,7 +81,7 @@ def add_variables(config: od.Config) -> None:
 
   config.add_variable(
     name="n_bjets",
-    expression=lambda events: ak.num(events.Bjet["pt"], axis=1),
+    expression=ObjectCount("Bjet"),
     aux={"inputs": {"Bjet.pt"}},
     binning=(5, -0.5, 4.5),
     discrete_x=True,
@@ -88,7 +90,7 @@ def add_variables(config: od.Config) -> None:
 
   config.add_variable(
     name="n_leps",
-    expression=lambda events: ak.num(events.Leptons["pt"], axis=1),
+    expression=ObjectCount("Leptons"),
     aux={"inputs": {"Leptons.pt"}},
     binning=(5, -0.5, 4.5),
     discrete_x=True,
@@ -115,7 +117,8 @@ def add_variables(config: od.Config) -> None:
   for i in range(6):
     config.add_variable(
       name=f"jet{i+1}_pt",
-      expression=f"Jet.pt[:,{i}]",
+      expression=ObjectField("Jet", "pt", i, null_value=EMPTY_FLOAT),
+      aux={"inputs": {"Jet.pt"}},
       null_value=EMPTY_FLOAT,
       binning=(40, 0., 400.),
       unit="GeV",
@@ -123,21 +126,24 @@ def add_variables(config: od.Config) -> None:
     )
     config.add_variable(
       name=f"jet{i+1}_eta",
-      expression=f"Jet.eta[:,{i}]",
+      expression=ObjectField("Jet", "eta", i, null_value=EMPTY_FLOAT),
+      aux={"inputs": {"Jet.eta"}},
       null_value=EMPTY_FLOAT,
       binning=(50, -2.5, 2.5),
       x_title=r"Jet %i $\eta$" % (i + 1),
     )
     config.add_variable(
       name=f"jet{i+1}_phi",
-      expression=f"Jet.phi[:,{i}]",
+      expression=ObjectField("Jet", "phi", i, null_value=EMPTY_FLOAT),
+      aux={"inputs": {"Jet.phi"}},
       null_value=EMPTY_FLOAT,
       binning=(40, -3.2, 3.2),
       x_title=r"Jet %i $\phi$" % (i + 1),
     )
     config.add_variable(
       name=f"jet{i+1}_mass",
-      expression=f"Jet.mass[:,{i}]",
+      expression=ObjectField("Jet", "mass", i, null_value=EMPTY_FLOAT),
+      aux={"inputs": {"Jet.mass"}},
       null_value=EMPTY_FLOAT,
       binning=(40, 0, 200),
       unit="GeV",
@@ -147,7 +153,8 @@ def add_variables(config: od.Config) -> None:
   for i in range(2):
     config.add_variable(
       name=f"Lepton{i+1}_pt",
-      expression=f"Leptons.pt[:,{i}]",
+      expression=ObjectField("Leptons", "pt", i, null_value=EMPTY_FLOAT),
+      aux={"inputs": {"Leptons.pt"}},
       null_value=EMPTY_FLOAT,
       binning=(40, 0., 400.),
       unit="GeV",
@@ -155,14 +162,16 @@ def add_variables(config: od.Config) -> None:
     )
     config.add_variable(
       name=f"Lepton{i+1}_eta",
-      expression=f"Leptons.eta[:,{i}]",
+      expression=ObjectField("Leptons", "eta", i, null_value=EMPTY_FLOAT),
+      aux={"inputs": {"Leptons.eta"}},
       null_value=EMPTY_FLOAT,
       binning=(50, -2.5, 2.5),
       x_title=r"Lepton %i $\eta$" % (i + 1),
     )
     config.add_variable(
       name=f"Lepton{i+1}_phi",
-      expression=f"Leptons.phi[:,{i}]",
+      expression=ObjectField("Leptons", "phi", i, null_value=EMPTY_FLOAT),
+      aux={"inputs": {"Leptons.phi"}},
       null_value=EMPTY_FLOAT,
       binning=(40, -3.2, 3.2),
       x_title=r"Lepton %i $\phi$" % (i + 1),
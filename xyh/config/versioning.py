@@ -0,0 +1,251 @@
+# coding: utf-8
+
+"""
+Automatic task versions derived from a hash of the effective inputs of a task.
+"""
+
+from __future__ import annotations
+
+import sys
+import hashlib
+import inspect
+
+import law
+import order as od
+
+import columnflow
+from columnflow.columnar_util import ArrayFunction, TaskArrayFunction
+from columnflow.calibration import Calibrator
+from columnflow.selection import Selector
+from columnflow.reduction import Reducer
+from columnflow.production import Producer
+
+logger = law.logger.get_logger(__name__)
+
+
+# per task family, the parameter and base class of the array functions it runs, and the task
+# families whose versions it depends on
+task_inputs = {
+  "cf.CalibrateEvents": ("calibrators", Calibrator, []),
+  "cf.SelectEvents": ("selector", Selector, ["cf.CalibrateEvents"]),
+  "cf.MergeSelectionStats": (None, None, ["cf.SelectEvents"]),
+  "cf.MergeSelectionMasks": (None, None, ["cf.SelectEvents"]),
+  "cf.ReduceEvents": ("reducer", Reducer, ["cf.SelectEvents"]),
+  "cf.MergeReductionStats": (None, None, ["cf.ReduceEvents"]),
+  "cf.MergeReducedEvents": (None, None, ["cf.ReduceEvents"]),
+  "cf.ProvideReducedEvents": (None, None, ["cf.ReduceEvents"]),
+  "cf.ProduceColumns": ("producer", Producer, ["cf.ProvideReducedEvents"]),
+}
+
+# classes whose attributes are not part of the hash
+_base_classes = {ArrayFunction, TaskArrayFunction, Calibrator, Selector, Reducer, Producer}
+
+
+def stable_repr(obj) -> str:
+  """
+  Return a representation of *obj* that does not depend on the order of sets and dictionaries,
+  nor on memory addresses.
+  """
+  if isinstance(obj, dict):
+    return "{" + ", ".join(sorted(f"{stable_repr(k)}: {stable_repr(v)}" for k, v in obj.items())) + "}"
+  if isinstance(obj, (set, frozenset)):
+    return "{" + ", ".join(sorted(map(stable_repr, obj))) + "}"
+  if isinstance(obj, (list, tuple)):
+    return "[" + ", ".join(map(stable_repr, obj)) + "]"
+  if isinstance(obj, od.UniqueObject):
+    return f"{obj.__class__.__name__}({obj.name})"
+  if isinstance(obj, type):
+    return getattr(obj, "cls_name", obj.__name__)
+  if callable(obj) and hasattr(obj, "__code__"):
+    return _source(obj)
+  r = repr(obj)
+  return obj.__class__.__name__ if " at 0x" in r else r
+
+
+def _source(func) -> str:
+  try:
+    return inspect.getsource(func)
+  except (OSError, TypeError):
+    return func.__code__.co_code.hex()
+
+
+def _class_fingerprint(cls: type) -> list[str]:
+  # sources of functions and plain values of attributes defined by cls and its custom bases
+  parts = []
+  for c in cls.__mro__:
+    if c in _base_classes or not issubclass(c, ArrayFunction):
+      break
+    for attr, value in sorted(vars(c).items()):
+      # skip private attributes such as instance caches
+      if attr.startswith("_") or isinstance(value, (property, classmethod, staticmethod)):
+        continue
+      if callable(value) and hasattr(value, "__code__"):
+        parts.append(f"{attr}={_source(value)}")
+      elif isinstance(value, (str, int, float, bool, tuple, list, dict, set, frozenset, type(None))):
+        parts.append(f"{attr}={stable_repr(value)}")
+  return parts
+
+
+def _class_modules(cls: type) -> set[str]:
+  # names of the modules defining cls, its custom bases and their functions
+  modules = set()
+  for c in cls.__mro__:
+    if c in _base_classes or not issubclass(c, ArrayFunction):
+      break
+    modules.add(c.__module__)
+    for value in vars(c).values():
+      if callable(value) and hasattr(value, "__code__"):
+        modules.add(value.__module__)
+  return modules
+
+
+# hashes of module sources, which do not change during the lifetime of the process
+_module_digests = {}
+
+
+def module_digest(name: str) -> str:
+  """
+  Return a hash of the source of the module *name*.
+  """
+  if name not in _module_digests:
+    try:
+      source = inspect.getsource(sys.modules[name])
+    except (OSError, TypeError):
+      source = name
+    _module_digests[name] = hashlib.sha256(source.encode()).hexdigest()
+  return _module_digests[name]
+
+
+def _walk_classes(cls: type, seen: set | None = None):
+  # static traversal of the classes in uses and produces, used when no instance can be created
+  seen = set() if seen is None else seen
+  if cls in seen:
+    return
+  seen.add(cls)
+  yield cls
+  for obj in set(law.util.make_list(cls.uses)) | set(law.util.make_list(cls.produces)):
+    obj = getattr(obj, "wrapped", obj)
+    if isinstance(obj, type) and issubclass(obj, ArrayFunction):
+      yield from _walk_classes(obj, seen)
+
+
+def array_function_fingerprint(func_cls: type, inst_dict: dict) -> str:
+  """
+  Return a hash of the sources and attributes of the array function *func_cls* and all its
+  transitive dependencies. Dependencies added at initialization (e.g. categorizers) are covered
+  by instantiating it with *inst_dict*, falling back to its static dependencies otherwise. The
+  sources of the xyh modules defining these classes are hashed as well, covering module-level
+  helpers next to the array functions.
+  """
+  try:
+    inst = func_cls(inst_dict=inst_dict)
+    classes = {dep.__class__ for dep in inst.walk_deps(include_self=True)}
+    columns = {
+      dep.cls_name: sorted(str(obj) for obj in dep.uses | dep.produces if isinstance(obj, str))
+      for dep in inst.walk_deps(include_self=True)
+    }
+  except Exception as e:
+    logger.debug(f"cannot instantiate {func_cls.cls_name} for versioning, using static dependencies: {e}")
+    classes = set(_walk_classes(func_cls))
+    columns = {}
+
+  # hash classes separately and combine them in sorted order, as class names are not unique
+  digests = []
+  for cls in classes:
+    h = hashlib.sha256(cls.cls_name.encode())
+    for part in _class_fingerprint(cls):
+      h.update(part.encode())
+    h.update(stable_repr(columns.get(cls.cls_name, [])).encode())
+    digests.append(h.hexdigest())
+
+  # sources of the xyh modules defining the classes, including module-level helpers
+  modules = set().union(*map(_class_modules, classes))
+  digests.extend(module_digest(name) for name in modules if name.split(".", 1)[0] == "xyh")
+
+  return hashlib.sha256("".join(sorted(digests)).encode()).hexdigest()
+
+
+class ContentHashVersions(object):
+  """
+  Provider of task versions that are derived from a hash of the effective inputs of a task, to be
+  used as values in the ``versions`` auxiliary entry of a config. The inputs of a task family are
+
+  - the sources of its array functions, their transitive dependencies and the xyh modules
+    defining them,
+  - the columnflow version,
+  - the config auxiliary entries listed for it in *aux_keys*, given as names or tuples of nested
+    keys, and
+  - the versions of its upstream task families.
+
+  Versions are composed of the *prefix*, which can still be bumped manually to enforce a
+  recomputation, and the first *length* characters of the hash. Tasks whose inputs did not change
+  keep their version and their existing outputs are reused.
+  """
+
+  def __init__(self, config_inst: od.Config, prefix: str = "v1", aux_keys: dict | None = None, length: int = 10):
+    super().__init__()
+
+    self.config_inst = config_inst
+    self.prefix = prefix
+    self.aux_keys = dict(aux_keys or {})
+    self.length = length
+
+    # cache of hashes per task family and relevant parameters
+    self._hashes = {}
+
+  def __call__(self, cls, inst, params: dict) -> str:
+    # signature of callable versions of cf.AnalysisTask.get_default_version
+    return f"{self.prefix}_{self.get_hash(cls.task_family, params, inst)[:self.length]}"
+
+  def versions(self) -> dict[str, ContentHashVersions]:
+    """
+    Return a dictionary mapping all supported task families to this instance.
+    """
+    return dict.fromkeys(task_inputs, self)
+
+  def _aux_value(self, key):
+    value = self.config_inst.aux
+    for k in law.util.make_tuple(key):
+      value = value.get(k) if isinstance(value, dict) else None
+    return value
+
+  def get_hash(self, task_family: str, params: dict, inst=None) -> str:
+    """
+    Return the full hash of the inputs of *task_family* with task parameters *params*.
+    """
+    param_name, base_cls, upstream = task_inputs[task_family]
+    func_names = tuple(law.util.make_list(params.get(param_name) or [])) if param_name else ()
+    dataset = params.get("dataset")
+    cache_key = (task_family, func_names, dataset, tuple(
+      law.util.make_tuple(params.get(name) or ())
+      for name, _, _ in task_inputs.values()
+      if name
+    ))
+    if cache_key in self._hashes:
+      return self._hashes[cache_key]
+
+    h = hashlib.sha256(task_family.encode())
+    h.update(f"columnflow={columnflow.__version__}".encode())
+
+    # array functions
+    if func_names:
+      inst_dict = {"config_inst": self.config_inst}
+      if inst is not None and getattr(inst, "analysis_inst", None):
+        inst_dict["analysis_inst"] = inst.analysis_inst
+      if dataset and self.config_inst.has_dataset(dataset):
+        inst_dict["dataset_inst"] = self.config_inst.get_dataset(dataset)
+      for name in func_names:
+        h.update(array_function_fingerprint(base_cls.get_cls(name), inst_dict).encode())
+
+    # config auxiliary data
+    for key in self.aux_keys.get(task_family, []):
+      h.update(f"{key}={stable_repr(self._aux_value(key))}".encode())
+
+    # upstream versions
+    for upstream_family in upstream:
+      h.update(self.get_hash(upstream_family, params, inst).encode())
+
+    digest = self._hashes[cache_key] = h.hexdigest()
+    logger.debug(f"content hash of {task_family} for {func_names or 'no array functions'}: {digest}")
+
+    return digest
@@ -0,0 +1,213 @@
+# coding: utf-8
+
+"""
+Content-addressed local store of external files.
+"""
+
+from __future__ import annotations
+
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import threading
+import multiprocessing.pool
+
+import law
+
+from columnflow.tasks.external import ExternalFile
+from columnflow.util import wget
+
+
+logger = law.logger.get_logger(__name__)
+
+
+def flatten_external_files(external_files: dict, prefix: str = "") -> dict[str, ExternalFile]:
+  """
+  Flattens the nested dictionary *external_files* into a dictionary mapping dot-joined keys to
+  :py:class:`ExternalFile` instances.
+  """
+  flat = {}
+  for key, value in external_files.items():
+    key = f"{prefix}{key}"
+    if isinstance(value, dict):
+      flat.update(flatten_external_files(value, prefix=f"{key}."))
+    else:
+      flat[key] = ExternalFile.new(value)
+  return flat
+
+
+def hash_path(path: str) -> str:
+  """
+  Returns the sha256 hash of the content of the file or directory at *path*. Directories are
+  hashed through the relative paths and contents of all contained files.
+  """
+  h = hashlib.sha256()
+
+  def update(file_path):
+    with open(file_path, "rb") as f:
+      for block in iter(lambda: f.read(1 << 20), b""):
+        h.update(block)
+
+  if os.path.isdir(path):
+    for root, dirs, files in os.walk(path):
+      dirs.sort()
+      for name in sorted(files):
+        file_path = os.path.join(root, name)
+        h.update(os.path.relpath(file_path, path).encode())
+        update(file_path)
+  else:
+    update(path)
+
+  return h.hexdigest()
+
+
+class ExternalFileStore(object):
+  """
+  Content-addressed store of external files in the local directory *path*. Files are fetched or
+  copied once from their location, hashed, and stored as ``objects/<hash>/<basename>``, keeping
+  their basename for readers that depend on file extensions. An index maps locations and versions
+  of :py:class:`ExternalFile` instances to hashes. In *offline* mode, files are exclusively
+  resolved through the index.
+  """
+
+  def __init__(self, path: str, offline: bool = False):
+    super().__init__()
+
+    self.path = os.path.abspath(os.path.expandvars(os.path.expanduser(path)))
+    self.offline = offline
+
+    # lock for index updates by multiple threads
+    self._lock = threading.Lock()
+
+  @classmethod
+  def from_config(cls, config_inst) -> ExternalFileStore | None:
+    """
+    Returns the store configured in the *external_file_store* auxiliary entry of *config_inst*,
+    or *None* when not configured.
+    """
+    store = config_inst.x("external_file_store", None)
+    if not store:
+      return None
+    return cls(store["path"], offline=store.get("offline", False))
+
+  @property
+  def index_path(self) -> str:
+    return os.path.join(self.path, "index.json")
+
+  def object_path(self, sha: str, name: str) -> str:
+    return os.path.join(self.path, "objects", sha, name)
+
+  @classmethod
+  def index_key(cls, ext_file: ExternalFile) -> str:
+    return f"{ext_file.location}@{ext_file.version}"
+
+  def load_index(self) -> dict[str, dict[str, str]]:
+    if not os.path.exists(self.index_path):
+      return {}
+    with open(self.index_path, "r") as f:
+      return json.load(f)
+
+  def _update_index(self, key: str, entry: dict[str, str]) -> None:
+    # the read-modify-write is guarded against other threads by the lock and against other
+    # processes by an exclusive lock on a separate file, as the index itself is replaced
+    os.makedirs(self.path, exist_ok=True)
+    with self._lock, open(f"{self.index_path}.lock", "a") as lock_file:
+      fcntl.flock(lock_file, fcntl.LOCK_EX)
+      try:
+        index = self.load_index()
+        index[key] = entry
+        # write atomically so that concurrent readers never see partial content
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+          json.dump(index, f, indent=4, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
+      finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+  def lookup(self, ext_file: ExternalFile, verify: bool = False) -> str | None:
+    """
+    Returns the path of the stored file for *ext_file*, or *None* when it is not stored or, with
+    *verify*, when its content does not match the indexed hash.
+    """
+    entry = self.load_index().get(self.index_key(ext_file))
+    if not entry:
+      return None
+    path = self.object_path(entry["sha256"], entry["name"])
+    if not os.path.exists(path):
+      return None
+    if verify and hash_path(path) != entry["sha256"]:
+      logger.warning(f"stored file {path} for {ext_file} is corrupted")
+      return None
+    return path
+
+  def fetch(self, ext_file: ExternalFile) -> str:
+    """
+    Fetches the location of *ext_file* into the store and returns the path of the stored file.
+    """
+    if self.offline:
+      raise FileNotFoundError(f"cannot fetch {ext_file} in offline mode, it is not in {self.path}")
+
+    src = ext_file.location
+    name = os.path.basename(src.rstrip("/")) or "file"
+    tmp_dir = os.path.join(self.path, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, f"{law.util.create_hash(src)}_{os.getpid()}_{threading.get_ident()}")
+
+    try:
+      if src.startswith(("http://", "https://")):
+        wget(src, tmp_path)
+      elif os.path.isfile(src):
+        shutil.copy2(src, tmp_path)
+      elif os.path.isdir(src):
+        shutil.copytree(src, tmp_path)
+      else:
+        raise NotImplementedError(f"cannot fetch {src}, file or directory does not exist")
+
+      # move to the content address, keeping an existing object with the same content
+      sha = hash_path(tmp_path)
+      path = self.object_path(sha, name)
+      if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+    finally:
+      if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+      elif os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    self._update_index(self.index_key(ext_file), {"sha256": sha, "name": name})
+    logger.debug(f"stored {ext_file} as {path}")
+
+    return path
+
+  def get(self, ext_file: ExternalFile | str | tuple, verify: bool = False) -> str:
+    """
+    Returns the path of the stored file for *ext_file*, fetching it first if needed.
+    """
+    ext_file = ExternalFile.new(ext_file)
+    return self.lookup(ext_file, verify=verify) or self.fetch(ext_file)
+
+  def prefetch(
+    self,
+    external_files: dict,
+    workers: int = 8,
+    verify: bool = False,
+    callback=None,
+  ) -> dict[str, str]:
+    """
+    Stores all entries of the possibly nested dictionary *external_files* using *workers*
+    parallel threads and returns a dictionary mapping their flat keys to stored paths. The
+    optional *callback* is invoked with the key and path of each stored file.
+    """
+    flat = flatten_external_files(external_files)
+
+    def get(key):
+      path = self.get(flat[key], verify=verify)
+      if callback:
+        callback(key, path)
+      return key, path
+
+    with multiprocessing.pool.ThreadPool(max(min(workers, len(flat)), 1)) as pool:
+      return dict(pool.map(get, sorted(flat)))
@@ -0,0 +1,745 @@
+# coding: utf-8
+
+"""
+Histogram producers for XY(bb)H(tt).
+"""
+
+from __future__ import annotations
+
+import weakref
+
+import law
+import order as od
+
+from columnflow.histogramming import HistProducer
+from columnflow.histogramming.default import cf_default
+from columnflow.hist_util import create_hist_from_variables, fill_hist
+from columnflow.columnar_util import Route, has_ak_column
+from columnflow.util import maybe_import
+
+from xyh.config.variable_planner import VariableEvaluationPlanner
+from xyh.production.weight_matrix import (
+  weight_matrix_slices, weight_matrix_enabled, weight_matrix_slice_column,
+)
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+hist = maybe_import("hist")
+
+logger = law.logger.get_logger(__name__)
+
+
+class DenseHistogram(object):
+  """
+  Histogram accumulating sums of weights and squared weights in a preallocated dense array with
+  the same axes as columnflow's default histograms, i.e., category, process and shift axes followed
+  by one axis per variable, including flow bins.
+
+  Each entry is assigned a single flat bin index over all axes, so that filling all categories and
+  weight variations of a chunk requires one weighted bincount over the populated bins per
+  accumulated quantity, independent of the size of the array. Category
+  ids are mapped to axis indices through a lookup table of all leaf categories. Processes are added
+  to the array when first seen. :py:meth:`to_hist` converts to a ``hist.Hist`` that only contains
+  categories and processes that received entries, as when filling a growing histogram.
+  """
+
+  # axis types of variables, as in columnflow's add_hist_axis, excluding categorical ones
+  supported_axis_types = {"variable", "var", "integer", "int", "boolean", "bool", "regular", "reg"}
+
+  def __init__(
+    self,
+    variable_insts: list[od.Variable],
+    category_ids: list[int],
+    shift_ids: list[int],
+    last_edge_inclusive: bool | None = None,
+  ):
+    super().__init__()
+
+    if not self.supports(variable_insts):
+      names = ", ".join(variable_inst.name for variable_inst in variable_insts)
+      raise ValueError(f"axis types of variables {names} not supported")
+
+    self.variable_insts = list(variable_insts)
+    self.last_edge_inclusive = last_edge_inclusive
+
+    # template histogram defining the variable axes
+    self.template = create_hist_from_variables(*self.variable_insts, weight=True)
+
+    # lookup tables of categorical axes
+    self.category_ids = np.array(sorted(category_ids), dtype=np.int64)
+    self.shift_ids = list(shift_ids)
+    self.process_ids = []
+
+    # flat variable binning, including flow bins
+    self.var_shape = tuple(ax.extent for ax in self.template.axes)
+    self.n_var_bins = int(np.prod(self.var_shape, dtype=np.int64))
+
+    # sums of weights and squared weights, and categories that received entries
+    self.values = np.zeros((len(self.category_ids), 0, len(self.shift_ids), self.n_var_bins))
+    self.variances = np.zeros_like(self.values)
+    self.filled_categories = np.zeros(len(self.category_ids), dtype=bool)
+
+  @classmethod
+  def supports(cls, variable_insts: list[od.Variable]) -> bool:
+    return all(
+      variable_inst.x("axis_type", "integer" if variable_inst.discrete_x else "variable").lower()
+      in cls.supported_axis_types
+      for variable_inst in variable_insts
+    )
+
+  def category_index(self, category_ids: np.ndarray) -> np.ndarray:
+    """
+    Map *category_ids* to indices on the category axis.
+    """
+    index = np.searchsorted(self.category_ids, category_ids)
+    if np.any(index >= len(self.category_ids)) or np.any(self.category_ids[index] != category_ids):
+      unknown = set(np.asarray(category_ids).tolist()) - set(self.category_ids.tolist())
+      raise ValueError(f"category ids {', '.join(map(str, sorted(unknown)))} are not known to the histogram")
+    return index
+
+  def process_lut(self, process_ids: np.ndarray) -> np.ndarray:
+    """
+    Return the indices of the unique *process_ids* on the process axis, adding new processes.
+    """
+    new_ids = [int(process_id) for process_id in process_ids if process_id not in self.process_ids]
+    if new_ids:
+      self.process_ids.extend(new_ids)
+      pad = ((0, 0), (0, len(new_ids)), (0, 0), (0, 0))
+      self.values = np.pad(self.values, pad)
+      self.variances = np.pad(self.variances, pad)
+    return np.array([self.process_ids.index(int(process_id)) for process_id in process_ids], dtype=np.int64)
+
+  def variable_index(self, values: dict[str, np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Return the flat bin index over all variable axes for flat arrays of *values* per axis, and a
+    mask of entries within the axis extents.
+    """
+    flat_index = 0
+    valid = True
+    for ax in self.template.axes:
+      axis_values = np.asarray(values[ax.name])
+
+      # move values on the last edge of continuous axes into the last bin, as done by fill_hist
+      if isinstance(ax, hist.axis.Variable) and len(ax.widths) and (
+        self.last_edge_inclusive or
+        (self.last_edge_inclusive is None and ax.traits.continuous and not ax.traits.circular)
+      ):
+        axis_values = np.where(axis_values == ax.edges[-1], axis_values - ax.widths[-1] * 1e-5, axis_values)
+
+      index = np.asarray(ax.index(axis_values), dtype=np.int64) + int(ax.traits.underflow)
+      valid = valid & (index >= 0) & (index < ax.extent)
+      flat_index = flat_index * ax.extent + index
+
+    return flat_index, valid
+
+  def fill(
+    self,
+    var_index: np.ndarray,
+    category_index: np.ndarray,
+    process_index: np.ndarray,
+    weights: np.ndarray,
+  ) -> None:
+    """
+    Accumulate entries given by their flat variable bin index *var_index*, category and process
+    axis indices, and *weights* with one column per shift.
+    """
+    n_shifts = len(self.shift_ids)
+    n_processes = len(self.process_ids)
+    weights = np.asarray(weights, dtype=np.float64).reshape(len(var_index), n_shifts)
+
+    base = ((category_index * n_processes + process_index) * n_shifts) * self.n_var_bins + var_index
+    index = (base[:, None] + np.arange(n_shifts, dtype=np.int64)[None, :] * self.n_var_bins).reshape(-1)
+    weights = weights.reshape(-1)
+
+    self.filled_categories[np.unique(category_index)] = True
+
+    # sum weights per populated bin only
+    bins, inverse = np.unique(index, return_inverse=True)
+    self.values.flat[bins] += np.bincount(inverse, weights=weights, minlength=len(bins))
+    self.variances.flat[bins] += np.bincount(inverse, weights=weights**2, minlength=len(bins))
+
+  def to_hist(self) -> hist.Hist:
+    """
+    Convert to a ``hist.Hist`` with integer category, process and shift axes. As in columnflow's
+    default histograms, the shift axis always contains the nominal shift id 0.
+    """
+    filled = self.filled_categories
+    category_ids = self.category_ids[filled].tolist()
+    shift_ids = list(dict.fromkeys([0, *self.shift_ids]))
+    shift_index = [shift_ids.index(shift_id) for shift_id in self.shift_ids]
+
+    h = create_hist_from_variables(
+      *self.variable_insts,
+      categorical_axes=[
+        ("category", "intcat", category_ids),
+        ("process", "intcat", list(self.process_ids)),
+        ("shift", "intcat", shift_ids),
+      ],
+      weight=True,
+    )
+    shape = (len(category_ids), len(self.process_ids), len(self.shift_ids)) + self.var_shape
+    view = h.view(flow=True)
+    view.value[:, :, shift_index] = self.values[filled].reshape(shape)
+    view.variance[:, :, shift_index] = self.variances[filled].reshape(shape)
+
+    return h
+
+
+class SparseHistogram(object):
+  """
+  Histogram container that only stores populated slices of the categorical axes of columnflow
+  histograms, i.e., of category, process and shift. Slices are identified by *keys* of their
+  categorical values, and stored in *data*, holding sums of weights and squared weights over the
+  variable axes, including flow bins, with shape ``(len(keys), 2, *extents)``. The variable axes
+  are described by an empty *template* histogram, and the values of the categorical axes, including
+  empty ones, by *categories*.
+
+  Storage size and the time to merge scale with the number of populated slices. Merging adds the
+  data of each histogram with a single vectorized operation, which cf.MergeHistograms uses for
+  sparse inputs (see xyh.columnflow_patches.patch_sparse_histogram_merge), :py:meth:`project` sums
+  over axes without creating the full cube, and :py:meth:`to_hist` converts to a ``hist.Hist`` with
+  the same axes as the original histogram.
+  """
+
+  categorical_axes = ("category", "process", "shift")
+
+  def __init__(
+    self,
+    template: hist.Hist,
+    categories: dict[str, list],
+    keys: list[tuple],
+    data: np.ndarray,
+  ):
+    super().__init__()
+
+    self.template = template
+    self.categories = {name: list(categories[name]) for name in self.categorical_axes}
+    self.keys = list(keys)
+    self.data = data
+
+  @classmethod
+  def from_hist(cls, h: hist.Hist) -> SparseHistogram:
+    """
+    Create a sparse histogram from *h*, keeping only slices with entries.
+    """
+    n_cat = len(cls.categorical_axes)
+    axis_names = tuple(ax.name for ax in h.axes)
+    if axis_names[:n_cat] != cls.categorical_axes:
+      raise ValueError(f"histogram axes must start with {', '.join(cls.categorical_axes)}, found {axis_names}")
+
+    cat_axes = h.axes[:n_cat]
+    template = hist.Hist(*h.axes[n_cat:], storage=h.storage_type())
+
+    # flow bins of categorical axes are not filled by columnflow and dropped
+    view = h.view(flow=True)[tuple(slice(0, len(ax)) for ax in cat_axes)]
+    data = np.stack([view.value, view.variance], axis=n_cat)
+    populated = np.any(data != 0, axis=tuple(range(n_cat, data.ndim)))
+    keys = [
+      tuple(ax.value(i) for ax, i in zip(cat_axes, index))
+      for index in np.argwhere(populated)
+    ]
+
+    return cls(
+      template,
+      {ax.name: list(ax) for ax in cat_axes},
+      keys,
+      data[populated],
+    )
+
+  @property
+  def axes(self):
+    # variable axes, for compatibility with columnflow's axis label updates
+    return self.template.axes
+
+  def copy(self) -> SparseHistogram:
+    return self.__class__(self.template.copy(), self.categories, self.keys, self.data.copy())
+
+  def __add__(self, other: SparseHistogram) -> SparseHistogram:
+    if not isinstance(other, SparseHistogram):
+      return NotImplemented
+    return self.merge([self, other])
+
+  def __radd__(self, other: SparseHistogram | int) -> SparseHistogram:
+    # support sum() starting with 0
+    if isinstance(other, int) and other == 0:
+      return self
+    return self.__add__(other)
+
+  @classmethod
+  def merge(cls, hists: list[SparseHistogram]) -> SparseHistogram:
+    """
+    Merge *hists* by adding their slices per key.
+    """
+    hists = list(hists)
+    if not hists:
+      raise ValueError("no histograms given for merging")
+
+    var_axes = [(ax.name, ax.extent) for ax in hists[0].template.axes]
+    if any([(ax.name, ax.extent) for ax in h.template.axes] != var_axes for h in hists[1:]):
+      raise ValueError("cannot merge sparse histograms with different variable axes")
+
+    # union of keys and categories, keeping the order of appearance
+    key_index = {}
+    for h in hists:
+      for key in h.keys:
+        key_index.setdefault(key, len(key_index))
+    categories = {
+      name: list(dict.fromkeys(value for h in hists for value in h.categories[name]))
+      for name in cls.categorical_axes
+    }
+
+    # add data, using that keys are unique within each histogram
+    data = np.zeros((len(key_index),) + hists[0].data.shape[1:], dtype=hists[0].data.dtype)
+    for h in hists:
+      data[[key_index[key] for key in h.keys]] += h.data
+
+    return cls(hists[0].template.copy(), categories, list(key_index), data)
+
+  def project(self, *axis_names: str) -> hist.Hist:
+    """
+    Return a ``hist.Hist`` with only the axes *axis_names*, summing over all other axes. Slices are
+    summed per projected key before the histogram is created.
+    """
+    cat_names = [name for name in self.categorical_axes if name in axis_names]
+    var_names = [ax.name for ax in self.template.axes if ax.name in axis_names]
+    unknown = set(axis_names) - set(cat_names) - set(var_names)
+    if unknown:
+      raise ValueError(f"unknown axes {', '.join(sorted(unknown))}")
+
+    # create the histogram
+    cat_axes = [
+      hist.axis.StrCategory(self.categories[name], name=name, growth=True)
+      if not self.categories[name] or isinstance(self.categories[name][0], str) else
+      hist.axis.IntCategory(self.categories[name], name=name, growth=True)
+      for name in cat_names
+    ]
+    var_axes = [ax for ax in self.template.axes if ax.name in var_names]
+    h = hist.Hist(*cat_axes, *var_axes, storage=self.template.storage_type())
+
+    # sum over variable axes that are not kept
+    sum_axes = tuple(i + 2 for i, ax in enumerate(self.template.axes) if ax.name not in var_names)
+    data = self.data.sum(axis=sum_axes) if sum_axes else self.data
+
+    # add slices at their position in the projected histogram
+    cat_pos = [self.categorical_axes.index(name) for name in cat_names]
+    lookup = [{value: i for i, value in enumerate(self.categories[name])} for name in cat_names]
+    flat_index = np.zeros(len(self.keys), dtype=np.int64)
+    for pos, values in zip(cat_pos, lookup):
+      flat_index = flat_index * len(values) + np.array([values[key[pos]] for key in self.keys], dtype=np.int64)
+    n_flat = int(np.prod([len(values) for values in lookup], dtype=np.int64))
+    projected = np.zeros((n_flat,) + data.shape[1:], dtype=data.dtype)
+    np.add.at(projected, flat_index, data)
+
+    shape = tuple(len(values) for values in lookup) + data.shape[2:]
+    view = h.view(flow=True)
+    view.value[...] = projected[:, 0].reshape(shape)
+    view.variance[...] = projected[:, 1].reshape(shape)
+
+    return h
+
+  def to_hist(self) -> hist.Hist:
+    """
+    Convert to a ``hist.Hist`` with all axes.
+    """
+    return self.project(*self.categorical_axes, *(ax.name for ax in self.template.axes))
+
+
+dense = cf_default.derive("dense")
+
+
+@dense.call
+def dense_call(self: HistProducer, events: ak.Array, task: law.Task, **kwargs) -> ak.Array:
+  """
+  Default event weights, starting a new chunk of the variable planner.
+  """
+  events, weight = cf_default.call_func(self, events, task=task, **kwargs)
+  return self.start_variable_chunk(events), weight
+
+
+@dense.create_hist
+def dense_create_hist(
+  self: HistProducer,
+  variables: list[od.Variable],
+  task: law.Task,
+) -> DenseHistogram | hist.Hist:
+  """
+  Create a :py:class:`DenseHistogram` for all leaf categories, falling back to the default
+  histogram for unsupported variable axes.
+  """
+  if not DenseHistogram.supports(variables):
+    return cf_default.create_hist_func(self, variables=variables, task=task)
+
+  return DenseHistogram(
+    variables,
+    category_ids=[cat_inst.id for cat_inst in self.config_inst.get_leaf_categories()],
+    shift_ids=[task.global_shift_inst.id],
+    last_edge_inclusive=task.last_edge_inclusive,
+  )
+
+
+@dense.fill_hist
+def dense_fill_hist(
+  self: HistProducer,
+  h: DenseHistogram | hist.Hist,
+  data: dict,
+  variables: list[od.Variable],
+  events: ak.Array,
+  task: law.Task,
+) -> None:
+  """
+  Fill *h* with *data*. The broadcasting of events to their categories and the bin index of each
+  event-level variable are computed once per chunk and shared between all histograms filled from
+  the same *events*.
+  """
+  if not isinstance(h, DenseHistogram):
+    return cf_default.fill_hist_func(self, h=h, data=data, variables=variables, events=events, task=task)
+
+  chunk = self.get_chunk_cache(events, data, h)
+  event_index = chunk["event_index"]
+  category_index = chunk["category_index"]
+
+  # flat values of all variables, and the number of objects per event for object-level data
+  values = {}
+  object_level = set()
+  n_objects = None
+  for variable_inst in variables:
+    value = data[variable_inst.name]
+    if isinstance(value, ak.Array) and value.ndim > 1:
+      counts = ak.to_numpy(ak.num(value, axis=1))
+      if n_objects is not None and not np.array_equal(n_objects, counts):
+        raise ValueError(
+          "detected multiple variables with object-level data that are not broadcasting-compatible: "
+          f"{', '.join(variable_inst.name for variable_inst in variables)}",
+        )
+      n_objects = counts
+      object_level.add(variable_inst.name)
+      values[variable_inst.name] = ak.to_numpy(ak.flatten(value, axis=1))
+    else:
+      values[variable_inst.name] = ak.to_numpy(value)
+
+  if n_objects is None:
+    # event-level variables, one entry per event and category
+    key = tuple(variable_inst.name for variable_inst in variables)
+    if key not in chunk["var_index"]:
+      chunk["var_index"][key] = h.variable_index(values)
+    var_index, valid = chunk["var_index"][key]
+    var_index, valid = var_index[event_index], valid[event_index]
+  else:
+    # object-level variables, one entry per object and category of each event
+    block_sizes = n_objects[event_index]
+    block_starts = np.cumsum(block_sizes) - block_sizes
+    local_index = np.arange(block_sizes.sum()) - np.repeat(block_starts, block_sizes)
+    object_offsets = np.cumsum(n_objects) - n_objects
+    event_index = np.repeat(event_index, block_sizes)
+    category_index = np.repeat(category_index, block_sizes)
+    object_index = object_offsets[event_index] + local_index
+    var_index, valid = h.variable_index({
+      name: value[object_index if name in object_level else event_index]
+      for name, value in values.items()
+    })
+
+  h.fill(
+    var_index[valid],
+    category_index[valid],
+    h.process_lut(chunk["process_ids"])[chunk["process_inverse"]][event_index][valid],
+    chunk["weights"][event_index][valid],
+  )
+
+
+@dense.post_process_hist
+def dense_post_process_hist(self: HistProducer, h: DenseHistogram | hist.Hist, task: law.Task) -> hist.Hist:
+  """
+  Convert :py:class:`DenseHistogram` objects to ``hist.Hist`` and apply the default post-processing.
+  """
+  if isinstance(h, DenseHistogram):
+    h = h.to_hist()
+  return cf_default.post_process_hist_func(self, h=h, task=task)
+
+
+@dense.init
+def dense_init(self: HistProducer, **kwargs) -> None:
+  super(dense, self).init_func(**kwargs)
+
+  # cache of the current chunk, only used for the very event array it was created for
+  self.chunk_cache = None
+
+  def get_chunk_cache(events: ak.Array, data: dict, h: DenseHistogram) -> dict:
+    if self.chunk_cache is None or self.chunk_cache["events"]() is not events:
+      category_ids = data["category"]
+      n_categories = ak.to_numpy(ak.num(category_ids, axis=1))
+      process_ids, process_inverse = np.unique(ak.to_numpy(data["process"]), return_inverse=True)
+      weights = data["weight"]
+      self.chunk_cache = {
+        "events": weakref.ref(events),
+        "event_index": np.repeat(np.arange(len(n_categories)), n_categories),
+        "category_index": h.category_index(ak.to_numpy(ak.flatten(category_ids, axis=1))),
+        "process_ids": process_ids,
+        "process_inverse": process_inverse.reshape(-1),
+        "weights": ak.to_numpy(weights) if isinstance(weights, ak.Array) else np.asarray(weights),
+        "var_index": {},
+      }
+    return self.chunk_cache
+
+  self.get_chunk_cache = get_chunk_cache
+
+  # planner of the variables of the task and the intermediate results of the current chunk
+  self.variable_planner = None
+  self.variable_chunk = None
+
+  def start_variable_chunk(events: ak.Array) -> ak.Array:
+    if self.variable_chunk is not None:
+      self.variable_chunk.log_stats()
+    self.variable_chunk = self.variable_planner.start_chunk(events) if self.variable_planner else None
+    return events
+
+  self.start_variable_chunk = start_variable_chunk
+
+
+@dense.post_init
+def dense_post_init(self: HistProducer, task: law.Task, **kwargs) -> None:
+  super(dense, self).post_init_func(task=task, **kwargs)
+
+  # plan the variables of the task
+  variable_names = law.util.flatten(getattr(task, "variable_tuples", {}).values())
+  self.variable_planner = VariableEvaluationPlanner([
+    self.config_inst.get_variable(variable_name)
+    for variable_name in variable_names
+  ])
+  self.variable_chunk = None
+
+
+@dense.teardown
+def dense_teardown(self: HistProducer, task: law.Task, **kwargs) -> None:
+  super(dense, self).teardown_func(task=task, **kwargs)
+
+  if self.variable_chunk is not None:
+    self.variable_chunk.log_stats()
+  self.variable_chunk = None
+  self.chunk_cache = None
+
+
+sparse = dense.derive("sparse", cls_dict={
+  # the compatibility check requires hist.Hist objects
+  "post_process_compatibility_check": False,
+  "post_process_merged_compatibility_check": True,
+})
+
+
+@sparse.post_process_hist
+def sparse_post_process_hist(self: HistProducer, h: DenseHistogram | hist.Hist, task: law.Task) -> SparseHistogram:
+  """
+  Apply the post-processing of *dense* and store only populated slices.
+  """
+  h = dense.post_process_hist_func(self, h=h, task=task)
+  return SparseHistogram.from_hist(h)
+
+
+@sparse.post_process_merged_hist
+def sparse_post_process_merged_hist(
+  self: HistProducer,
+  h: SparseHistogram | hist.Hist,
+  task: law.Task,
+) -> hist.Hist:
+  """
+  Convert merged histograms to ``hist.Hist``, as expected by plotting and inference tasks. Merges
+  downstream of cf.MergeHistograms, such as in cf.MergeShiftedHistograms, therefore add dense
+  histograms.
+  """
+  return h.to_hist() if isinstance(h, SparseHistogram) else h
+
+
+def weight_shift_matrix(
+  n_events: int,
+  factors: dict[str, np.ndarray],
+  shifted_factors: list[tuple[str, np.ndarray]],
+) -> np.ndarray:
+  """
+  Return the weights of *n_events* events as a matrix of shape events × (1 + shifts), with the
+  product of all nominal *factors* in the first column and one column per entry of
+  *shifted_factors*, given as the name of the nominal factor it replaces and its shifted values.
+  Shifted weights are derived from the nominal one as ``nominal * shifted / factor``. For events
+  where the replaced factor is zero, the product of all other factors is computed explicitly.
+  """
+  weights = np.empty((n_events, 1 + len(shifted_factors)), dtype=np.float32)
+  nominal = weights[:, 0]
+  nominal[...] = 1
+  for values in factors.values():
+    nominal *= values
+
+  for i, (column, values) in enumerate(shifted_factors, 1):
+    factor = factors[column]
+    zero = factor == 0
+    weights[:, i] = nominal * values / np.where(zero, 1, factor)
+    if np.any(zero):
+      others = np.ones(zero.sum(), dtype=np.float32)
+      for other_column, other_values in factors.items():
+        if other_column != column:
+          others *= other_values[zero]
+      weights[zero, i] = others * values[zero]
+
+  return weights
+
+
+def nominal_weight_shift_source(shift_inst: od.Shift, column: str) -> str | None:
+  """
+  Return the source column of the alias of the weight *column* in *shift_inst*, or *None* when the
+  shift defines no such alias or cannot be derived from the nominal selection. Sources of weight
+  matrix aliases are the plain columns produced by *weight_matrix_slices*.
+  """
+  if shift_inst.has_tag({"selection_dependent", "disjoint_from_nominal"}, mode=any):
+    return None
+  matrix_aliases = shift_inst.x("weight_matrix_aliases", {})
+  if column in matrix_aliases:
+    return weight_matrix_slice_column(*matrix_aliases[column])
+  return shift_inst.x("column_aliases", {}).get(column)
+
+
+@sparse.hist_producer(
+  # fill weight shifts as additional columns of the weight matrix in the nominal task, while the
+  # tasks of these shifts fill nothing, so that merged histograms contain each shift once
+  nominal_weight_shifts=True,
+)
+def all_weights_sparse(self: HistProducer, events: ak.Array, task: law.Task, **kwargs) -> ak.Array:
+  """
+  Same event weights as columnflow's *all_weights*, i.e., the product of all columns in the
+  *event_weights* auxiliary entries of the config and dataset, with the storage of *sparse*.
+
+  With *nominal_weight_shifts*, the nominal task additionally derives the weights of all shifts
+  that the event weights depend on from the nominal weight, replacing only the shifted factor,
+  and returns them together as a matrix of shape events × (1 + shifts) that is filled into the
+  shift axis of the same histogram. The shifted factors are read from the sources of the column
+  aliases of each shift. Tasks of these shifts fill no histograms, as merging histograms of all
+  shifts adds their slices.
+  """
+  if self.skip_fill or not self.weight_columns or not len(events):
+    return self.start_variable_chunk(events), np.ones(len(events), dtype=np.float32)
+
+  # resolve weight matrix aliases into plain columns
+  if self.has_dep(weight_matrix_slices):
+    events = self[weight_matrix_slices](events, task=task, **kwargs)
+  events = self.start_variable_chunk(events)
+
+  factors = {
+    column: ak.to_numpy(Route(column).apply(events)).astype(np.float32)
+    for column in self.weight_columns
+    if has_ak_column(events, column)
+  }
+  for column in set(self.weight_columns) - set(factors):
+    self.logger.warning_once(
+      f"missing_weight_{column}",
+      f"weight '{column}' for dataset {self.dataset_inst.name} not found",
+    )
+
+  if not self.weight_shifts:
+    return events, weight_shift_matrix(len(events), factors, [])[:, 0]
+
+  shifted_factors = [
+    (column, ak.to_numpy(Route(src).apply(events)).astype(np.float32))
+    for _, column, src in self.weight_shifts
+  ]
+  return events, weight_shift_matrix(len(events), factors, shifted_factors)
+
+
+@all_weights_sparse.init
+def all_weights_sparse_init(self: HistProducer, **kwargs) -> None:
+  super(all_weights_sparse, self).init_func(**kwargs)
+
+  # shift ids, weight columns and source columns of weight shifts filled in the nominal task
+  self.weight_shifts = []
+  self.skip_fill = False
+
+  # weight columns and the shifts they depend on, per config and dataset
+  self.weight_columns = []
+  self.weight_column_shifts = {}
+  if self.dataset_inst.is_data:
+    return
+  for inst in [self.config_inst, self.dataset_inst]:
+    for column, shift_insts in inst.x("event_weights", {}).items():
+      self.weight_columns.append(column)
+      self.weight_column_shifts.setdefault(column, []).extend(shift_insts)
+      self.shifts |= {shift_inst.name for shift_inst in shift_insts}
+  self.uses |= set(map(Route, self.weight_columns))
+
+  if weight_matrix_enabled(self.config_inst):
+    self.uses.add(weight_matrix_slices)
+
+
+@all_weights_sparse.post_init
+def all_weights_sparse_post_init(self: HistProducer, task: law.Task, **kwargs) -> None:
+  super(all_weights_sparse, self).post_init_func(task=task, **kwargs)
+
+  # reset weight shifts of previous tasks, as instances might be shared
+  self.uses -= {Route(src) for _, _, src in self.weight_shifts}
+  self.weight_shifts = []
+  self.skip_fill = False
+
+  if not self.nominal_weight_shifts:
+    return
+
+  # the task of a shift filled in the nominal task fills nothing
+  global_shift_inst = task.global_shift_inst
+  if not global_shift_inst.is_nominal:
+    self.skip_fill = any(
+      nominal_weight_shift_source(global_shift_inst, column) is not None
+      for column, shift_insts in self.weight_column_shifts.items()
+      if global_shift_inst in shift_insts
+    )
+    if self.skip_fill:
+      logger.debug(f"shift {global_shift_inst.name} is filled in the nominal task, filling nothing")
+    return
+
+  for column, shift_insts in self.weight_column_shifts.items():
+    for shift_inst in shift_insts:
+      src = nominal_weight_shift_source(shift_inst, column)
+      if src is None:
+        logger.debug(f"weight column {column} of shift {shift_inst.name} is not filled in the nominal task")
+        continue
+      self.weight_shifts.append((shift_inst.id, column, src))
+      # slices of weight matrices are not read but produced by weight_matrix_slices
+      if column not in shift_inst.x("weight_matrix_aliases", {}):
+        self.uses.add(Route(src))
+
+
+@all_weights_sparse.create_hist
+def all_weights_sparse_create_hist(
+  self: HistProducer,
+  variables: list[od.Variable],
+  task: law.Task,
+) -> DenseHistogram | hist.Hist:
+  """
+  Create the histogram of *dense*, extending the shift axis by all weight shifts.
+  """
+  if not DenseHistogram.supports(variables):
+    return cf_default.create_hist_func(self, variables=variables, task=task)
+
+  return DenseHistogram(
+    variables,
+    category_ids=[cat_inst.id for cat_inst in self.config_inst.get_leaf_categories()],
+    shift_ids=[task.global_shift_inst.id] + [shift_id for shift_id, _, _ in self.weight_shifts],
+    last_edge_inclusive=task.last_edge_inclusive,
+  )
+
+
+@all_weights_sparse.fill_hist
+def all_weights_sparse_fill_hist(
+  self: HistProducer,
+  h: DenseHistogram | hist.Hist,
+  data: dict,
+  variables: list[od.Variable],
+  events: ak.Array,
+  task: law.Task,
+) -> None:
+  """
+  Fill *h* as in *dense*. Histograms that are not dense are filled once per column of the weight
+  matrix.
+  """
+  if self.skip_fill:
+    return
+
+  if isinstance(h, DenseHistogram) or np.ndim(data["weight"]) == 1:
+    return dense.fill_hist_func(self, h=h, data=data, variables=variables, events=events, task=task)
+
+  weights = np.asarray(data["weight"])
+  shift_ids = [data["shift"]] + [shift_id for shift_id, _, _ in self.weight_shifts]
+  for i, shift_id in enumerate(shift_ids):
+    fill_hist(h, {**data, "shift": shift_id, "weight": weights[:, i]}, last_edge_inclusive=task.last_edge_inclusive)
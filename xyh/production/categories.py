@@ -0,0 +1,190 @@
+# coding: utf-8
+
+"""
+Column producers related to categories.
+"""
+
+from __future__ import annotations
+
+import law
+
+from columnflow.production import Producer, producer
+from columnflow.production.categories import category_ids
+from columnflow.columnar_util import Route, set_ak_column, mandatory_coffea_columns
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+logger = law.logger.get_logger(__name__)
+
+
+# same dependencies and categorizer map as columnflow's category_ids, but a different evaluation
+category_ids_bitfield = category_ids.derive("category_ids_bitfield")
+
+
+@category_ids_bitfield.call
+def category_ids_bitfield_call(
+  self: Producer,
+  events: ak.Array,
+  target_events: ak.Array | None = None,
+  **kwargs,
+) -> ak.Array:
+  """
+  Assigns each event an array of category ids, identical to *category_ids*. Every distinct
+  categorizer is evaluated exactly once and its mask stored as one bit per event. Categories are
+  then resolved per distinct bit pattern instead of per event, and the ids of each pattern are
+  broadcast to all events sharing it.
+  """
+  # evaluate all unique categorizers, storing their masks as bits
+  masks = np.zeros((len(events), len(self.unique_categorizers)), dtype=bool)
+  for i, categorizer in enumerate(self.unique_categorizers):
+    events, mask = self[categorizer](events, **kwargs)
+    masks[:, i] = ak.to_numpy(ak.fill_none(mask, False))
+  patterns, pattern_index = np.unique(np.packbits(masks, axis=1), axis=0, return_inverse=True)
+  patterns = np.unpackbits(patterns, axis=1, count=masks.shape[1]).astype(bool)
+
+  # categories passed per pattern, requiring all bits of the category's categorizers
+  passed = ~(self.category_bits[None, :, :] & ~patterns[:, None, :]).any(axis=2)
+  pattern_ids = ak.unflatten(
+    np.concatenate([self.category_id_array[p] for p in passed] + [np.array([], dtype=np.int64)]),
+    passed.sum(axis=1),
+  )
+
+  # broadcast to events
+  category_ids = pattern_ids[pattern_index.reshape(-1)]
+
+  # instrumentation
+  self.n_calls_saved += self.n_naive_calls - len(self.unique_categorizers)
+  logger.debug(
+    f"evaluated {len(self.unique_categorizers)} instead of {self.n_naive_calls} categorizers for "
+    f"{len(self.category_id_array)} categories and {len(patterns)} distinct patterns; "
+    f"{self.n_calls_saved} calls saved so far",
+  )
+
+  # save, optionally on a target events array
+  if target_events is None:
+    target_events = events
+  target_events = set_ak_column(target_events, "category_ids", category_ids, value_type=np.int64)
+
+  return target_events
+
+
+@category_ids_bitfield.init
+def category_ids_bitfield_init(self: Producer, **kwargs) -> None:
+  super(category_ids_bitfield, self).init_func(**kwargs)
+
+  # category ids and a matrix of the categorizer bits they require
+  self.category_id_array = np.array([cat_inst.id for cat_inst in self.categorizer_map], dtype=np.int64)
+  self.category_bits = np.zeros((len(self.categorizer_map), len(self.unique_categorizers)), dtype=bool)
+  for i, categorizers in enumerate(self.categorizer_map.values()):
+    for categorizer in categorizers:
+      self.category_bits[i, self.unique_categorizers.index(categorizer)] = True
+
+  # number of categorizer calls when evaluating each category separately, and calls saved
+  self.n_naive_calls = int(self.category_bits.sum())
+  self.n_calls_saved = 0
+
+
+#
+# offline recategorization
+#
+
+@producer(
+  # features mapped to collections whose multiplicities are stored
+  feature_collections={
+    "n_electron": "Electron",
+    "n_muon": "Muon",
+    "n_jet": "Jet",
+    "n_bjet": "Bjet",
+  },
+  # features mapped to per-event columns that are stored as they are
+  feature_columns={},
+)
+def category_features(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
+  """
+  Stores the per-event inputs of the categorizers in a compact table below *category_features*,
+  from which *category_ids_from_features* re-derives category ids without reading the full events.
+  """
+  for name, collection in self.feature_collections.items():
+    counts = ak.num(events[collection], axis=1)
+    events = set_ak_column(events, f"category_features.{name}", counts, value_type=np.int32)
+  for name, column in self.feature_columns.items():
+    events = set_ak_column(events, f"category_features.{name}", Route(column).apply(events))
+
+  return events
+
+
+@category_features.init
+def category_features_init(self: Producer) -> None:
+  # counting objects only requires a single field per collection
+  self.uses |= {f"{collection}.pt" for collection in self.feature_collections.values()}
+  self.uses |= set(self.feature_columns.values())
+  self.produces |= {
+    f"category_features.{name}"
+    for name in [*self.feature_collections, *self.feature_columns]
+  }
+
+
+category_ids_from_features = category_ids_bitfield.derive(
+  "category_ids_from_features",
+  cls_dict={"require_producers": ["category_features"]},
+)
+
+
+@category_ids_from_features.call
+def category_ids_from_features_call(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
+  """
+  Re-derives *category_ids* for the categories of the current config from the table written by
+  *category_features*, e.g. after changing category definitions. Collections are rebuilt from their
+  stored multiplicities as lists of placeholders, so categorizers may only count their objects,
+  which is verified against their declared *uses* at initialization.
+  """
+  features = events.category_features
+  feature_events = {
+    column: events[column]
+    for column in mandatory_coffea_columns
+    if column in events.fields
+  }
+  for name, collection in category_features.feature_collections.items():
+    counts = ak.to_numpy(features[name])
+    feature_events[collection] = ak.unflatten(np.zeros(counts.sum(), dtype=bool), counts)
+  for name, column in category_features.feature_columns.items():
+    feature_events[column] = features[name]
+  feature_events = ak.zip(feature_events, depth_limit=1)
+
+  return category_ids_bitfield.call_func(self, feature_events, target_events=events, **kwargs)
+
+
+@category_ids_from_features.init
+def category_ids_from_features_init(self: Producer, **kwargs) -> None:
+  super(category_ids_from_features, self).init_func(**kwargs)
+
+  # categorizers are still called, but must not add their columns to the ones to read
+  self.uses -= set(self.unique_categorizers)
+  self.uses |= {
+    f"category_features.{name}"
+    for name in [*category_features.feature_collections, *category_features.feature_columns]
+  }
+
+  # check that all columns used by categorizers are covered by the stored features
+  covered = set(mandatory_coffea_columns)
+  covered |= set(category_features.feature_collections.values())
+  covered |= set(category_features.feature_columns.values())
+  for categorizer in self.unique_categorizers:
+    uncovered = set()
+    for obj in categorizer.uses:
+      if not isinstance(obj, str):
+        uncovered.add(getattr(obj, "cls_name", str(obj)))
+        continue
+      uncovered |= {
+        column
+        for column in law.util.brace_expand(obj)
+        if Route(column).string_column not in covered
+      }
+    if uncovered:
+      raise Exception(
+        f"categorizer '{categorizer.cls_name}' uses columns not covered by category_features: "
+        f"{', '.join(sorted(uncovered))}; add them to its feature_collections or feature_columns "
+        "and rerun it",
+      )
@@ -0,0 +1,425 @@
+# coding: utf-8
+
+"""
+Compilation of purely binned correctionlib corrections into dense NumPy lookup tables.
+
+A correction is purely binned when its content only consists of binning, multibinning and
+category nodes, and constant values. Its real and integer inputs then map to axes of cells,
+delimited by the union of all edges of the input (plus underflow and overflow cells) or given by the
+keys of integer categories (plus a default cell), and its string inputs select one of several
+tables. The table values are obtained by evaluating the correction with correctionlib in one point
+per cell, so that lookups are exact by construction, which is verified on random points after
+compilation. Lookups are a vectorized ``searchsorted`` per axis, followed by a gather.
+
+Compiled tables are cached on disk per hash of the correction file (see
+:py:func:`load_correction_luts`).
+"""
+
+from __future__ import annotations
+
+import os
+import gzip
+import json
+import pickle
+import hashlib
+import itertools
+from collections import namedtuple
+
+import law
+
+from columnflow.columnar_util import flat_np_view, layout_ak_array
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+correctionlib = maybe_import("correctionlib")
+
+logger = law.logger.get_logger(__name__)
+
+# bumped when the layout of compiled tables changes to invalidate caches
+cache_version = 1
+
+# maximum number of cells per table
+max_cells = 2_000_000
+
+Input = namedtuple("Input", ["name", "type"])
+
+
+class BinAxis(object):
+  """
+  Axis of cells delimited by *edges*, with an underflow cell at index 0 and an overflow cell at
+  index ``len(edges)``, following the ``[low, high)`` convention of correctionlib.
+  """
+
+  def __init__(self, edges: np.ndarray, is_int: bool = False):
+    super().__init__()
+
+    self.edges = np.asarray(edges, dtype=np.float64)
+    self.is_int = is_int
+
+  @property
+  def n_cells(self) -> int:
+    return len(self.edges) + 1
+
+  def points(self) -> tuple[np.ndarray, np.ndarray]:
+    # one point per cell and whether the cell can contain values at all
+    e = self.edges
+    if self.is_int:
+      inner = np.ceil(e[:-1])
+      valid = np.concatenate([[True], inner < e[1:], [True]])
+      points = np.concatenate([[np.ceil(e[0]) - 1], inner, [np.ceil(e[-1])]])
+      return np.where(valid, points, e[0] - 1).astype(np.int64), valid
+    points = np.concatenate([[e[0] - 1], 0.5 * (e[:-1] + e[1:]), [e[-1] + 1]])
+    return points, np.ones(len(points), dtype=bool)
+
+  def index(self, values: np.ndarray) -> np.ndarray:
+    return np.searchsorted(self.edges, values, side="right")
+
+  def random_values(self, rng, n: int) -> np.ndarray:
+    # mix of edges, cell points and uniform values including the flow regions
+    e = self.edges
+    span = max(e[-1] - e[0], 1.0)
+    candidates = np.concatenate([e, self.points()[0], rng.uniform(e[0] - 0.1 * span, e[-1] + 0.1 * span, n)])
+    values = rng.choice(candidates, n)
+    return np.round(values).astype(np.int64) if self.is_int else values
+
+
+class UniformAxis(BinAxis):
+  """
+  Axis of *n* equal cells between *low* and *high*, plus underflow and overflow cells, with cell
+  indices computed arithmetically like correctionlib does for uniform binnings.
+  """
+
+  def __init__(self, n: int, low: float, high: float, is_int: bool = False):
+    super().__init__(np.linspace(low, high, n + 1), is_int=is_int)
+
+    self.n = n
+    self.low = low
+    self.high = high
+
+  def index(self, values: np.ndarray) -> np.ndarray:
+    inner = np.floor((values - self.low) / (self.high - self.low) * self.n)
+    return np.where(
+      values < self.low,
+      0,
+      np.where(values >= self.high, self.n + 1, np.clip(inner, 0, self.n - 1).astype(np.int64) + 1),
+    )
+
+
+class CategoryAxis(object):
+  """
+  Axis of cells given by the integer category *keys*, with a default cell at index ``len(keys)``.
+  """
+
+  def __init__(self, keys):
+    super().__init__()
+
+    self.keys = np.array(sorted(keys), dtype=np.int64)
+
+  @property
+  def n_cells(self) -> int:
+    return len(self.keys) + 1
+
+  def points(self) -> tuple[np.ndarray, np.ndarray]:
+    points = np.concatenate([self.keys, [self.keys.max(initial=0) + 1]])
+    return points, np.ones(len(points), dtype=bool)
+
+  def index(self, values: np.ndarray) -> np.ndarray:
+    pos = np.searchsorted(self.keys, values)
+    clipped = np.minimum(pos, max(len(self.keys) - 1, 0))
+    match = (pos < len(self.keys)) & (self.keys[clipped] == values) if len(self.keys) else False
+    return np.where(match, pos, len(self.keys))
+
+  def random_values(self, rng, n: int) -> np.ndarray:
+    return rng.choice(self.points()[0], n)
+
+
+class ConstantAxis(object):
+  """
+  Axis of a numeric input that the correction does not depend on.
+  """
+
+  n_cells = 1
+
+  def points(self) -> tuple[np.ndarray, np.ndarray]:
+    return np.zeros(1, dtype=np.int64), np.ones(1, dtype=bool)
+
+  def index(self, values: np.ndarray) -> np.ndarray:
+    return np.zeros(np.shape(values), dtype=np.int64)
+
+  def random_values(self, rng, n: int) -> np.ndarray:
+    return rng.integers(-5, 5, n)
+
+
+class CorrectionLUT(object):
+  """
+  Dense lookup table of a purely binned correction, usable in place of a correctionlib correction
+  through :py:meth:`evaluate`. :py:meth:`evaluate_many` evaluates multiple values of string inputs,
+  such as nominal, up and down variations, with a single computation of the cell indices.
+  """
+
+  def __init__(
+    self,
+    name: str,
+    version: int,
+    inputs: list[Input],
+    axes: dict,
+    combos: list[tuple],
+    free_strings: set[str] | None = None,
+  ):
+    super().__init__()
+
+    self.name = name
+    self.version = version
+    self.inputs = inputs
+    self.axes = axes
+    self.combos = {combo: i for i, combo in enumerate(combos)}
+
+    # string inputs the correction does not depend on, represented by empty strings in combos
+    self.free_strings = set(free_strings or [])
+
+    # values and error flags per combination of string inputs and cell, set in compile()
+    self.values = None
+    self.errors = None
+
+  @property
+  def string_inputs(self) -> list[str]:
+    return [inp.name for inp in self.inputs if inp.type == "string"]
+
+  @property
+  def numeric_inputs(self) -> list[str]:
+    return [inp.name for inp in self.inputs if inp.type != "string"]
+
+  def _flat_index(self, values: list) -> np.ndarray:
+    flat = 0
+    for name, v in zip(self.numeric_inputs, values):
+      axis = self.axes[name]
+      flat = flat * axis.n_cells + axis.index(v)
+    return np.asarray(flat, dtype=np.int64)
+
+  def evaluate_many(self, *args) -> list:
+    """
+    Evaluates the correction for inputs *args* in the order of :py:attr:`inputs`, where string
+    inputs can also be sequences of values. Returns a list of results for all combinations of string
+    values, with the structure of the first awkward array among the numeric inputs.
+    """
+    strings, numeric, layout = [], [], None
+    for inp, arg in zip(self.inputs, args):
+      if inp.type == "string":
+        strings.append([""] if inp.name in self.free_strings else [arg] if isinstance(arg, str) else list(arg))
+        continue
+      if layout is None and isinstance(arg, ak.Array):
+        layout = arg
+      numeric.append(arg)
+
+    # flat numpy views of awkward arrays, keeping scalars
+    flat_values = [flat_np_view(v) if isinstance(v, ak.Array) else np.asarray(v) for v in numeric]
+    flat = self._flat_index(flat_values)
+
+    results = []
+    for combo in itertools.product(*strings):
+      if combo not in self.combos:
+        raise ValueError(f"invalid string inputs {combo} for correction {self.name}")
+      row = self.combos[combo]
+      if self.errors is not None and self.errors[row, flat].any():
+        raise ValueError(f"inputs outside of the defined range of correction {self.name}")
+      result = self.values[row, flat]
+      results.append(result if layout is None else layout_ak_array(result, layout))
+
+    return results
+
+  def evaluate(self, *args):
+    """
+    Evaluates the correction like :py:meth:`correctionlib.highlevel.Correction.evaluate`.
+    """
+    return self.evaluate_many(*args)[0]
+
+  __call__ = evaluate
+
+  def compile(self, correction) -> None:
+    """
+    Fills the tables by evaluating the correctionlib *correction* in one point per cell.
+    """
+    points, valid = zip(*(self.axes[name].points() for name in self.numeric_inputs))
+    grids = [g.ravel() for g in np.meshgrid(*points, indexing="ij")]
+    cell_valid = np.logical_and.reduce([g.ravel() for g in np.meshgrid(*valid, indexing="ij")])
+
+    self.values = np.full((len(self.combos), len(cell_valid)), np.nan)
+    self.errors = np.zeros(self.values.shape, dtype=bool)
+    for combo, row in self.combos.items():
+      args = self._arguments(combo, grids)
+      try:
+        self.values[row] = correction.evaluate(*args)
+      except Exception:
+        # evaluate cells one by one to find those raising errors
+        for i in range(len(cell_valid)):
+          try:
+            self.values[row, i] = correction.evaluate(*self._arguments(combo, [g[i] for g in grids]))
+          except Exception:
+            self.errors[row, i] = cell_valid[i]
+
+    if not self.errors.any():
+      self.errors = None
+
+  def _arguments(self, combo: tuple, numeric: list) -> list:
+    strings, numeric = iter(combo), iter(numeric)
+    return [next(strings) if inp.type == "string" else next(numeric) for inp in self.inputs]
+
+  def validate(self, correction, n: int = 10000, seed: int = 0) -> bool:
+    """
+    Returns whether the lookups for *n* random points agree exactly with the correctionlib
+    *correction* for all combinations of string inputs, skipping points raising errors.
+    """
+    rng = np.random.default_rng(seed)
+    values = [self.axes[name].random_values(rng, n) for name in self.numeric_inputs]
+    flat = self._flat_index(values)
+    for combo, row in self.combos.items():
+      ok = np.ones(n, dtype=bool) if self.errors is None else ~self.errors[row, flat]
+      expected = correction.evaluate(*self._arguments(combo, [v[ok] for v in values]))
+      if not np.array_equal(self.values[row, flat[ok]], expected, equal_nan=True):
+        return False
+    return True
+
+
+def _collect(node, axes: dict, strings: dict) -> bool:
+  # collect edges and keys per input of a content node, returning whether it is purely binned
+  if isinstance(node, (int, float)):
+    return True
+  if not isinstance(node, dict):
+    return False
+
+  def edges_of(edges):
+    # uniform binnings are kept as tuples
+    if isinstance(edges, dict):
+      return (edges["n"], edges["low"], edges["high"])
+    return np.asarray(edges, dtype=np.float64)
+
+  nodetype = node.get("nodetype")
+  if nodetype == "binning":
+    axes.setdefault(node["input"], []).append(("bins", edges_of(node["edges"])))
+    children = list(node["content"])
+  elif nodetype == "multibinning":
+    for name, edges in zip(node["inputs"], node["edges"]):
+      axes.setdefault(name, []).append(("bins", edges_of(edges)))
+    children = list(node["content"])
+  elif nodetype == "category":
+    keys = [item["key"] for item in node["content"]]
+    if all(isinstance(key, str) for key in keys):
+      strings.setdefault(node["input"], set()).update(keys)
+    else:
+      axes.setdefault(node["input"], []).append(("keys", keys))
+    children = [item["value"] for item in node["content"]]
+    if node.get("default") is not None:
+      children.append(node["default"])
+  else:
+    # formulas, transforms and random number generators
+    return False
+
+  flow = node.get("flow")
+  if isinstance(flow, dict) or isinstance(flow, (int, float)) and not isinstance(flow, bool):
+    children.append(flow)
+
+  return all(_collect(child, axes, strings) for child in children)
+
+
+def compile_correction(data: dict, correction) -> CorrectionLUT | None:
+  """
+  Compiles the correction described by the schema dictionary *data* into a
+  :py:class:`CorrectionLUT`, using the correctionlib *correction* for evaluation. Returns *None*
+  when the correction is not purely binned, too large, or not reproduced exactly.
+  """
+  name = data["name"]
+  axes, strings = {}, {}
+  if not _collect(data["data"], axes, strings):
+    logger.debug(f"correction {name} is not purely binned")
+    return None
+
+  inputs = [Input(inp["name"], inp["type"]) for inp in data["inputs"]]
+  lut_axes = {}
+  for inp in inputs:
+    if inp.type == "string":
+      continue
+    kinds = {kind for kind, _ in axes.get(inp.name, [])}
+    if not kinds:
+      lut_axes[inp.name] = ConstantAxis()
+    elif kinds == {"bins"}:
+      all_edges = [edges for _, edges in axes[inp.name]]
+      if all(isinstance(edges, tuple) for edges in all_edges) and len(set(all_edges)) == 1:
+        lut_axes[inp.name] = UniformAxis(*all_edges[0], is_int=inp.type == "int")
+      else:
+        edges = np.unique(np.concatenate([
+          np.linspace(edges[1], edges[2], edges[0] + 1) if isinstance(edges, tuple) else edges
+          for edges in all_edges
+        ]))
+        lut_axes[inp.name] = BinAxis(edges, is_int=inp.type == "int")
+    elif kinds == {"keys"}:
+      lut_axes[inp.name] = CategoryAxis(set().union(*(keys for _, keys in axes[inp.name])))
+    else:
+      logger.debug(f"correction {name} mixes binning and categories for input {inp.name}")
+      return None
+
+  n_cells = np.prod([axis.n_cells for axis in lut_axes.values()], dtype=np.int64)
+  combos = list(itertools.product(*(
+    sorted(strings.get(inp.name, {""})) for inp in inputs if inp.type == "string"
+  )))
+  if n_cells * len(combos) > max_cells:
+    logger.debug(f"correction {name} has too many cells for a lookup table ({n_cells * len(combos)})")
+    return None
+
+  free_strings = {inp.name for inp in inputs if inp.type == "string" and inp.name not in strings}
+  lut = CorrectionLUT(name, data.get("version", 0), inputs, lut_axes, combos, free_strings=free_strings)
+  lut.compile(correction)
+  if not lut.validate(correction):
+    logger.warning(f"lookup table of correction {name} does not reproduce correctionlib, skipped")
+    return None
+
+  return lut
+
+
+def load_correction_luts(path: str, cache_dir: str | None = None) -> dict[str, CorrectionLUT | None]:
+  """
+  Returns the lookup tables of all corrections in the (optionally gzipped) correctionlib file at
+  *path*, mapped to *None* for corrections that cannot be compiled. Results are cached as pickle
+  files in *cache_dir*, keyed by the hash of the file content.
+  """
+  with open(path, "rb") as f:
+    content = f.read()
+  if path.endswith(".gz"):
+    content = gzip.decompress(content)
+
+  cache_path = None
+  if cache_dir:
+    file_hash = hashlib.sha256(content).hexdigest()
+    cache_path = os.path.join(os.path.expandvars(cache_dir), f"{file_hash}_v{cache_version}.pkl")
+    if os.path.exists(cache_path):
+      with open(cache_path, "rb") as f:
+        return pickle.load(f)
+
+  correction_set = correctionlib.CorrectionSet.from_string(content.decode("utf-8"))
+  luts = {
+    data["name"]: compile_correction(data, correction_set[data["name"]])
+    for data in json.loads(content)["corrections"]
+  }
+  logger.info(
+    f"compiled {sum(lut is not None for lut in luts.values())} of {len(luts)} corrections in {path} "
+    "into lookup tables",
+  )
+
+  if cache_path:
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+      pickle.dump(luts, f)
+    os.replace(tmp_path, cache_path)
+
+  return luts
+
+
+def correction_lut_or(correction, target, cache_dir: str | None = None):
+  """
+  Returns the lookup table of the correctionlib *correction* stored in the file *target*, or the
+  *correction* itself when it cannot be compiled.
+  """
+  path = target.abspath if hasattr(target, "abspath") else str(target)
+  lut = load_correction_luts(path, cache_dir=cache_dir).get(correction.name)
+  return correction if lut is None else lut
@@ -7,11 +7,11 @@ Column production methods related to higher-level features.
 import functools
 
 from columnflow.production import Producer, producer
-from columnflow.production.categories import category_ids
 from columnflow.production.normalization import normalization_weights
 from columnflow.util import maybe_import
 from columnflow.columnar_util import set_ak_column
 
+from xyh.production.categories import category_ids_bitfield
 from xyh.production.leptons import leading_lepton
 from xyh.production.prepare_objects import prepare_objects
 from xyh.production.utils import lv_mass
@@ -26,7 +26,7 @@ set_ak_column_f32 = functools.partial(set_ak_column, value_type=np.float32)
 
 @producer(
   uses={
-    category_ids, normalization_weights,
+    category_ids_bitfield, normalization_weights,
     prepare_objects, leading_lepton,
     "Jet.{pt,eta,phi,mass,rawFactor,btagDeepFlavB}",
     "Bjet.{pt,eta,phi}",
@@ -34,7 +34,7 @@ set_ak_column_f32 = functools.partial(set_ak_column, value_type=np.float32)
     "process_id"
   },
   produces={
-    category_ids, normalization_weights,
+    category_ids_bitfield, normalization_weights,
     prepare_objects, leading_lepton,
     "event_number", "process_id",
     "mlnu", "mtlnu",
@@ -43,7 +43,7 @@ set_ak_column_f32 = functools.partial(set_ak_column, value_type=np.float32)
 )
 def default(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
   # Build categories
-  events = self[category_ids](events, **kwargs)
+  events = self[category_ids_bitfield](events, **kwargs)
 
   events = self[leading_lepton](events, **kwargs)
   events = self[prepare_objects](events, **kwargs)
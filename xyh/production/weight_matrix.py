@@ -0,0 +1,421 @@
+# coding: utf-8
+
+"""
+Per-event variation matrices of weight families.
+
+Instead of one scalar column per variation (e.g. ``pdf_weight_up``, ``btag_weight_hf_down``, ...),
+all variations of a weight family are stored in a single fixed-width float32 column
+``{family}_matrix`` of shape events × variations, while the nominal weight remains a scalar column
+``{family}``. The order of variations per family is registered in the ``weight_matrices``
+auxiliary entry of the config (see :py:func:`register_weight_matrix`). Shifts refer to slices of the
+matrix through their ``weight_matrix_aliases`` auxiliary entry (see
+:py:func:`add_weight_matrix_aliases`), which the :py:func:`weight_matrix_slices` producer resolves
+into plain columns when histograms are created.
+"""
+
+from __future__ import annotations
+
+import law
+import order as od
+
+from columnflow.production import Producer, producer
+from columnflow.production.cms.btag import btag_weights
+from columnflow.columnar_util import set_ak_column, remove_ak_column, has_ak_column
+from columnflow.util import maybe_import, DotDict
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+logger = law.logger.get_logger(__name__)
+
+
+# named indices of the 9 LHEScaleWeight entries, identical to columnflow's murmuf_weights
+scale_indices = {
+  "mur_down_muf_down": 0,
+  "mur_down_muf_nom": 1,
+  "mur_down_muf_up": 2,
+  "mur_nom_muf_down": 3,
+  "mur_nom_muf_nom": 4,
+  "mur_nom_muf_up": 5,
+  "mur_up_muf_down": 6,
+  "mur_up_muf_nom": 7,
+  "mur_up_muf_up": 8,
+}
+
+# scale variations entering the murf envelope, excluding anti-correlated ones
+scale_envelope_names = [
+  "mur_down_muf_down", "mur_down_muf_nom", "mur_nom_muf_down", "mur_nom_muf_nom",
+  "mur_nom_muf_up", "mur_up_muf_nom", "mur_up_muf_up",
+]
+
+# entries of the single mur and muf variations
+scale_single_names = {
+  "mur_up": "mur_up_muf_nom",
+  "mur_down": "mur_down_muf_nom",
+  "muf_up": "mur_nom_muf_up",
+  "muf_down": "mur_nom_muf_down",
+}
+
+# default variations of the pdf and scale families
+pdf_variations = (
+  ["up", "down"] +
+  [f"member_{i}" for i in range(1, 101)] +
+  ["alphas_up", "alphas_down"]
+)
+murf_variations = (
+  ["mur_up", "mur_down", "muf_up", "muf_down", "murf_envelope_up", "murf_envelope_down"] +
+  list(scale_indices)
+)
+
+
+#
+# registry
+#
+
+def register_weight_matrix(config_inst: od.Config, family: str, variations: list[str]) -> None:
+  """
+  Registers the ordered *variations* of the weight *family* in the ``weight_matrices`` auxiliary
+  entry of *config_inst*. Variation names are the postfixes of the scalar columns they replace,
+  e.g. ``"hf_up"`` for ``btag_weight_hf_up``.
+  """
+  if len(set(variations)) != len(variations):
+    raise ValueError(f"variations of weight matrix {family} are not unique: {variations}")
+  matrices = config_inst.x("weight_matrices", None)
+  if matrices is None:
+    matrices = config_inst.x.weight_matrices = DotDict(enabled=True, families=DotDict())
+  matrices.families[family] = list(variations)
+
+
+def weight_matrix_enabled(config_inst: od.Config) -> bool:
+  return bool(config_inst.x("weight_matrices", {}).get("enabled", False))
+
+
+def weight_matrix_column(family: str) -> str:
+  return f"{family}_matrix"
+
+
+def weight_matrix_variations(config_inst: od.Config, family: str) -> list[str]:
+  families = config_inst.x("weight_matrices", {}).get("families", {})
+  if family not in families:
+    raise KeyError(f"no weight matrix registered for {family} in config {config_inst.name}")
+  return families[family]
+
+
+def weight_matrix_index(config_inst: od.Config, family: str, variation: str) -> int:
+  variations = weight_matrix_variations(config_inst, family)
+  if variation not in variations:
+    raise KeyError(f"no variation {variation} in weight matrix {family}, available: {variations}")
+  return variations.index(variation)
+
+
+def weight_matrix_slice_column(family: str, variation: str) -> str:
+  """
+  Returns the name of the plain column holding the slice of the matrix of *family* for
+  *variation*, identical to the scalar column it replaces, e.g. ``"btag_weight_hf_up"``.
+  """
+  return f"{family}_{variation}"
+
+
+def add_weight_matrix_aliases(
+  config_inst: od.Config,
+  shift_source: str,
+  aliases: dict[str, tuple[str, str]],
+) -> None:
+  """
+  Adds weight matrix aliases to both shifts of *shift_source*, mapping columns to variations of
+  weight matrices. *aliases* maps column names to tuples of a family and a variation name, which
+  can contain the ``{direction}`` of the shift, e.g.
+  ``{"btag_weight": ("btag_weight", "hf_{direction}")}``. Unlike column aliases, they are resolved
+  by the :py:func:`weight_matrix_slices` producer.
+  """
+  for direction in ["up", "down"]:
+    shift = config_inst.get_shift(od.Shift.join_name(shift_source, direction))
+    _aliases = {}
+    for column, (family, variation) in aliases.items():
+      variation = variation.format(direction=direction)
+      # validate the variation
+      weight_matrix_index(config_inst, family, variation)
+      _aliases[column] = (family, variation)
+    shift.set_aux("weight_matrix_aliases", shift.x("weight_matrix_aliases", {})).update(_aliases)
+
+
+#
+# packing and envelopes
+#
+
+def pack_weight_matrix(
+  events: ak.Array,
+  family: str,
+  variations: list[str],
+  remove: bool = True,
+) -> ak.Array:
+  """
+  Stacks the scalar columns ``{family}_{variation}`` of all *variations* into the float32 column
+  ``{family}_matrix`` and, when *remove* is *True*, removes them. Missing columns are filled with
+  ones.
+  """
+  matrix = np.ones((len(events), len(variations)), dtype=np.float32)
+  for i, variation in enumerate(variations):
+    column = f"{family}_{variation}"
+    if not has_ak_column(events, column):
+      logger.debug(f"column {column} missing for weight matrix, filling ones")
+      continue
+    matrix[:, i] = ak.to_numpy(events[column])
+    if remove:
+      events = remove_ak_column(events, column)
+
+  return set_ak_column(events, weight_matrix_column(family), matrix_to_ak(matrix))
+
+
+def matrix_to_ak(matrix: np.ndarray) -> ak.Array:
+  # fixed-width, stored as a fixed size list in parquet
+  return ak.Array(ak.contents.RegularArray(
+    ak.contents.NumpyArray(np.ascontiguousarray(matrix, dtype=np.float32).reshape(-1)),
+    matrix.shape[1],
+    zeros_length=len(matrix),
+  ))
+
+
+def hessian_envelope(members: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+  """
+  Returns the up and down variations of Hessian eigenvector *members* (events × members),
+  normalized to the nominal weight, as one plus and minus their summed squared deviations.
+  """
+  delta = np.sqrt(np.sum((members - 1) ** 2, axis=1))
+  return 1 + delta, 1 - delta
+
+
+def replica_envelope(members: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+  """
+  Returns the up and down variations of MC replica *members* (events × members), normalized to the
+  nominal weight, as one plus and minus half the width of their central 68% interval. For 100
+  members, this is identical to the sorted members 84 and 16 used by columnflow's pdf_weights.
+  """
+  n = members.shape[1]
+  if n == 0:
+    ones = np.ones(len(members), dtype=members.dtype)
+    return ones, ones
+  lo, hi = int(round(0.16 * n)) - 1, int(round(0.84 * n)) - 1
+  part = np.partition(members, [max(lo, 0), max(hi, 0)], axis=1)
+  delta = (part[:, max(hi, 0)] - part[:, max(lo, 0)]) / 2
+  return 1 + delta, 1 - delta
+
+
+def scale_envelope(weights: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+  """
+  Returns the up and down variations of scale *weights* (events × variations) as their maximum
+  and minimum per event.
+  """
+  return weights.max(axis=1), weights.min(axis=1)
+
+
+#
+# producers
+#
+
+@producer(
+  # the family and its producer of scalar variation columns, set via derive
+  family=None,
+  weight_producer=None,
+  mc_only=True,
+)
+def weight_matrix(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
+  """
+  Runs the *weight_producer* and packs its scalar variation columns of the weight *family* into
+  the weight matrix, keeping the nominal column.
+  """
+  events = self[self.weight_producer](events, **kwargs)
+  return pack_weight_matrix(events, self.family, self.variations)
+
+
+@weight_matrix.init
+def weight_matrix_init(self: Producer, **kwargs) -> None:
+  if self.family is None:
+    return
+  self.variations = weight_matrix_variations(self.config_inst, self.family)
+
+  # the scalar columns of the weight producer are only used, not produced
+  self.uses.add(self.weight_producer)
+  self.produces |= {self.family, weight_matrix_column(self.family)}
+
+
+btag_weight_matrix = weight_matrix.derive("btag_weight_matrix", cls_dict={
+  "family": "btag_weight",
+  "weight_producer": btag_weights,
+})
+
+
+@producer(
+  uses={"LHEPdfWeight"},
+  produces={"pdf_weight", "pdf_weight_matrix"},
+  # "replicas" or "hessian"
+  pdf_set_type="replicas",
+  mc_only=True,
+)
+def pdf_weight_matrix(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
+  """
+  Stores all LHEPdfWeight members, normalized to the nominal one, in the ``pdf_weight_matrix`` and
+  computes the ``up`` and ``down`` envelopes over them. Events with 101 weights have no alphas
+  variations, which are set to one, and events with other numbers of weights get ones for all
+  variations.
+  """
+  variations = self.variations
+  matrix = np.ones((len(events), len(variations)), dtype=np.float32)
+  member_idx = [i for i, v in enumerate(variations) if v.startswith("member_")]
+  alphas_idx = [variations.index(v) for v in ("alphas_up", "alphas_down") if v in variations]
+
+  # fill members per number of weights, normalized to the nominal one
+  n_weights = ak.to_numpy(ak.num(events.LHEPdfWeight, axis=1))
+  for n in np.unique(n_weights):
+    if n not in (len(member_idx) + 1, len(member_idx) + len(alphas_idx) + 1):
+      frac = np.mean(n_weights == n) * 100
+      logger.warning(
+        f"unexpected number of {n} LHEPdfWeights in dataset {self.dataset_inst.name}, setting pdf "
+        f"weights to one for these events ({frac:.2f}%)",
+      )
+      continue
+    mask = n_weights == n
+    weights = ak.to_numpy(events.LHEPdfWeight[mask]).astype(np.float32)
+    nominal = np.where(weights[:, :1] == 0, 1, weights[:, :1])
+    weights = weights[:, 1:] / nominal
+    columns = (member_idx + alphas_idx)[:n - 1]
+    matrix[np.ix_(mask, columns)] = weights
+
+  # envelopes
+  if member_idx:
+    up, down = self.envelope(matrix[:, member_idx])
+    matrix[:, variations.index("up")] = up
+    matrix[:, variations.index("down")] = down
+
+  events = set_ak_column(events, "pdf_weight", np.ones(len(events), dtype=np.float32))
+  return set_ak_column(events, "pdf_weight_matrix", matrix_to_ak(matrix))
+
+
+@pdf_weight_matrix.init
+def pdf_weight_matrix_init(self: Producer, **kwargs) -> None:
+  self.variations = weight_matrix_variations(self.config_inst, "pdf_weight")
+  if self.pdf_set_type not in {"replicas", "hessian"}:
+    raise ValueError(f"unknown pdf_set_type {self.pdf_set_type}")
+  self.envelope = replica_envelope if self.pdf_set_type == "replicas" else hessian_envelope
+
+
+pdf_weight_matrix_hessian = pdf_weight_matrix.derive("pdf_weight_matrix_hessian", cls_dict={
+  "pdf_set_type": "hessian",
+})
+
+
+@producer(
+  uses={"LHEScaleWeight"},
+  produces={"mur_weight", "muf_weight", "murf_envelope_weight", "murf_weight_matrix"},
+  mc_only=True,
+)
+def murf_weight_matrix(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
+  """
+  Stores all LHEScaleWeight entries, normalized to the nominal one, in the ``murf_weight_matrix``
+  together with the single mur and muf variations and the murf envelope, computed as the per-event
+  extrema over the correlated variations. Events with 8 weights miss the nominal entry, and
+  events with other numbers of weights get ones for all variations.
+  """
+  variations = self.variations
+  scale = np.ones((len(events), len(scale_indices)), dtype=np.float32)
+
+  n_weights = ak.to_numpy(ak.num(events.LHEScaleWeight, axis=1))
+  for n in np.unique(n_weights):
+    mask = n_weights == n
+    if n == 9:
+      weights = ak.to_numpy(events.LHEScaleWeight[mask]).astype(np.float32)
+      nominal = weights[:, [scale_indices["mur_nom_muf_nom"]]]
+      scale[mask] = weights / np.where(nominal == 0, 1, nominal)
+    elif n == 8:
+      nom = scale_indices["mur_nom_muf_nom"]
+      columns = [i for i in range(len(scale_indices)) if i != nom]
+      scale[np.ix_(mask, columns)] = ak.to_numpy(events.LHEScaleWeight[mask])
+    else:
+      logger.warning(
+        f"unexpected number of {n} LHEScaleWeights in dataset {self.dataset_inst.name}, setting "
+        f"scale weights to one for these events ({np.mean(mask) * 100:.2f}%)",
+      )
+
+  # assemble the matrix from raw entries, single variations and the envelope
+  matrix = np.ones((len(events), len(variations)), dtype=np.float32)
+  for i, variation in enumerate(variations):
+    name = scale_single_names.get(variation, variation)
+    if name in scale_indices:
+      matrix[:, i] = scale[:, scale_indices[name]]
+  up, down = scale_envelope(scale[:, [scale_indices[name] for name in scale_envelope_names]])
+  matrix[:, variations.index("murf_envelope_up")] = up
+  matrix[:, variations.index("murf_envelope_down")] = down
+
+  # nominal weights are included in the LHEWeight
+  ones = np.ones(len(events), dtype=np.float32)
+  for column in ["mur_weight", "muf_weight", "murf_envelope_weight"]:
+    events = set_ak_column(events, column, ones)
+
+  return set_ak_column(events, "murf_weight_matrix", matrix_to_ak(matrix))
+
+
+@murf_weight_matrix.init
+def murf_weight_matrix_init(self: Producer, **kwargs) -> None:
+  self.variations = weight_matrix_variations(self.config_inst, "murf_weight")
+
+
+@producer(
+  uses={btag_weight_matrix, pdf_weight_matrix, murf_weight_matrix},
+  produces={btag_weight_matrix, pdf_weight_matrix, murf_weight_matrix},
+  mc_only=True,
+)
+def weight_matrices(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
+  """
+  Produces the weight matrices of all families. *kwargs* are forwarded to all producers, e.g. the
+  ``jet_mask`` of the b-tag weights.
+  """
+  events = self[btag_weight_matrix](events, **kwargs)
+  events = self[pdf_weight_matrix](events, **kwargs)
+  events = self[murf_weight_matrix](events, **kwargs)
+
+  return events
+
+
+@producer(
+  mc_only=True,
+)
+def weight_matrix_slices(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
+  """
+  Resolves the weight matrix aliases of the shift of the task into plain columns. The columns of
+  the shift are set to the slices of their matrices, and in tasks of the nominal shift, the slices
+  of all aliased variations are additionally stored in the scalar columns they replace, named as
+  in :py:func:`weight_matrix_slice_column`, so that event weights of shifts can be derived from the
+  nominal ones.
+  """
+  for column, (family, index) in self.slices.items():
+    matrix = ak.to_numpy(events[weight_matrix_column(family)])
+    events = set_ak_column(events, column, matrix[:, index])
+
+  return events
+
+
+@weight_matrix_slices.init
+def weight_matrix_slices_init(self: Producer, **kwargs) -> None:
+  self.slices = {}
+
+
+@weight_matrix_slices.post_init
+def weight_matrix_slices_post_init(self: Producer, task: law.Task, **kwargs) -> None:
+  # reset slices of previous tasks, as instances might be shared
+  self.uses -= {weight_matrix_column(family) for family, _ in self.slices.values()}
+  self.produces -= set(self.slices)
+
+  def add_slice(column, family, variation):
+    self.slices[column] = (family, weight_matrix_index(self.config_inst, family, variation))
+
+  self.slices = {}
+  shift_inst = task.local_shift_inst
+  for column, (family, variation) in shift_inst.x("weight_matrix_aliases", {}).items():
+    add_slice(column, family, variation)
+  if shift_inst.is_nominal:
+    for _shift_inst in self.config_inst.shifts:
+      for family, variation in _shift_inst.x("weight_matrix_aliases", {}).values():
+        add_slice(weight_matrix_slice_column(family, variation), family, variation)
+
+  self.uses |= {weight_matrix_column(family) for family, _ in self.slices.values()}
+  self.produces |= set(self.slices)
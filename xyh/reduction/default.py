@@ -0,0 +1,141 @@
+# coding: utf-8
+
+"""
+Reduction methods for XY(bb)H(tt).
+"""
+
+from __future__ import annotations
+
+import law
+
+from columnflow.reduction import Reducer, reducer
+from columnflow.production import Producer
+from columnflow.histogramming import HistProducer
+from columnflow.reduction.default import cf_default
+from columnflow.columnar_util import add_ak_aliases
+from columnflow.util import maybe_import
+
+from xyh.reduction.index_views import index_views
+from xyh.util import find_downstream_columns
+
+ak = maybe_import("awkward")
+
+
+@reducer(
+  uses={cf_default, index_views},
+  produces={cf_default, index_views},
+  check_used_columns=False,
+)
+def default(
+  self: Reducer,
+  events: ak.Array,
+  selection: ak.Array,
+  task: law.Task,
+  **kwargs,
+) -> ak.Array:
+  """
+  Same reduction as *cf_default*, additionally storing the derived collections configured in
+  *index_view_collections* as index views into their source collections.
+  """
+  events = self[cf_default](events, selection, task=task, **kwargs)
+
+  return self[index_views](events, selection, task=task, **kwargs)
+
+
+@reducer(
+  uses={default},
+  produces={default},
+  check_used_columns=False,
+)
+def multi_shift(
+  self: Reducer,
+  events: ak.Array,
+  selection: ak.Array,
+  task: law.Task,
+  **kwargs,
+) -> ak.Array:
+  """
+  Default reduction that consumes the per-shift selection results of selectors that evaluate all
+  selection-dependent shifts in one pass (such as *default_multi_shift*). For such a shift, the
+  selection results stored in the "shifts" field are used and the shift's selection-dependent
+  column aliases are applied before the reduction. Otherwise, this behaves like *default*.
+  """
+  shift_name = task.local_shift_inst.name
+  if shift_name in self.multi_shift_aliases and "shifts" in selection.fields:
+    selection = selection.shifts[shift_name]
+    events = add_ak_aliases(events, self.multi_shift_aliases[shift_name], remove_src=True)
+
+  return self[default](events, selection, task=task, **kwargs)
+
+
+@multi_shift.init
+def multi_shift_init(self: Reducer, **kwargs) -> None:
+  # register all selection-dependent shifts, whose selection might not be a shift of the selector
+  self.multi_shift_aliases = {}
+  for shift_inst in self.config_inst.shifts:
+    if shift_inst.has_tag("selection_dependent"):
+      self.multi_shift_aliases[shift_inst.name] = shift_inst.x("column_aliases_selection_dependent", {})
+      self.shifts.add(shift_inst.name)
+
+
+@multi_shift.post_init
+def multi_shift_post_init(self: Reducer, task: law.Task, **kwargs) -> None:
+  # the updates to used columns are only necessary if the task invokes the reducer
+  if not task.invokes_reducer:
+    return
+
+  shift_name = task.local_shift_inst.name
+  if shift_name not in self.multi_shift_aliases:
+    return
+
+  # read the per-shift selection results (all starting with "shifts." for ReduceEvents to load them
+  # from selection result data, see xyh.columnflow_patches) and the sources of the aliases
+  self.uses.add(f"shifts.{shift_name}.event")
+  for step in task.selector_steps:
+    self.uses.add(f"shifts.{shift_name}.steps.{step}")
+  for src_col, dst_cols in task.collection_map.items():
+    for dst_col in dst_cols:
+      self.uses.add(f"shifts.{shift_name}.objects.{src_col}.{dst_col}")
+  self.uses |= set(self.multi_shift_aliases[shift_name].values())
+
+
+# reduction that only keeps the columns read downstream instead of the keep_columns auxiliary
+minimal_columns = cf_default.derive("minimal_columns", cls_dict={"add_keep_columns": False})
+
+
+@minimal_columns.post_init
+def minimal_columns_post_init(self: Reducer, task: law.Task, **kwargs) -> None:
+  # keep the columns that the default producers, hist producer and ML models of the config, as well
+  # as all its variables read from reduced events; this must happen before the default post_init
+  # that determines the collections to read from the produced columns
+  from columnflow.tasks.framework.mixins import MLModelsMixin
+
+  producer_insts = [
+    Producer.get_cls(name)(inst_dict=self.inst_dict)
+    for name in law.util.make_list(self.config_inst.x("default_producer", None) or [])
+  ]
+  hist_producer_name = self.config_inst.x("default_hist_producer", None)
+  hist_producer_inst = (
+    HistProducer.get_cls(hist_producer_name)(inst_dict=self.inst_dict)
+    if hist_producer_name else None
+  )
+  ml_model_insts = [
+    MLModelsMixin.get_ml_model_inst(name, self.analysis_inst, requested_configs=[self.config_inst.name])
+    for name in law.util.make_list(self.config_inst.x("default_ml_model", None) or [])
+  ]
+
+  columns = find_downstream_columns(
+    self.config_inst,
+    producer_insts=producer_insts,
+    hist_producer_inst=hist_producer_inst,
+    ml_model_insts=ml_model_insts,
+    variable_insts=self.config_inst.variables,
+  )
+  self.produces |= columns
+
+  # columns of collections created from selection masks are read from their source collections
+  if task.invokes_reducer:
+    dst_cols = {dst_col for dst_cols in task.collection_map.values() for dst_col in dst_cols}
+    self.uses |= {route for route in columns if not law.util.multi_match(route[0], dst_cols)}
+
+  super(minimal_columns, self).post_init_func(task=task, **kwargs)
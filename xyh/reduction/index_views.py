@@ -0,0 +1,130 @@
+# coding: utf-8
+
+"""
+Derived object collections stored as index views into their source collection.
+
+Collections like *Bjet* are subsets of the *Jet* collection that is written by the reduction. Instead
+of storing their fields a second time, the reducer *index_views* stores the positions of their
+objects in the reduced source collection below ``index_views.<name>``. Tasks reading reduced events
+rehydrate them into views of the source collection (see xyh.columnflow_patches), which only
+materializes fields when they are accessed.
+
+The mapping of derived to source collections is configured in the ``index_view_collections``
+auxiliary entry of the config.
+"""
+
+from __future__ import annotations
+
+import law
+
+from columnflow.reduction import Reducer, reducer
+from columnflow.reduction.util import create_event_mask
+from columnflow.columnar_util import Route, set_ak_column, remove_ak_column
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+def index_view_positions(src_indices: ak.Array, dst_indices: ak.Array) -> ak.Array:
+  """
+  Return the positions of the object indices *dst_indices* in the object indices *src_indices* of
+  the same event, both referring to the same original collection. All indices of *dst_indices* must
+  be contained in *src_indices*.
+  """
+  src_counts = ak.to_numpy(ak.num(src_indices, axis=1))
+  dst_counts = ak.to_numpy(ak.num(dst_indices, axis=1))
+  src_flat = ak.to_numpy(ak.flatten(src_indices, axis=1)).astype(np.int64)
+  dst_flat = ak.to_numpy(ak.flatten(dst_indices, axis=1)).astype(np.int64)
+
+  # unique keys per event and object index
+  size = max(src_flat.max(initial=-1), dst_flat.max(initial=-1)) + 1
+  src_keys = np.repeat(np.arange(len(src_counts)), src_counts) * size + src_flat
+  dst_keys = np.repeat(np.arange(len(dst_counts)), dst_counts) * size + dst_flat
+
+  # look up destination keys among sorted source keys
+  order = np.argsort(src_keys, kind="stable")
+  found = np.minimum(np.searchsorted(src_keys[order], dst_keys), max(len(order) - 1, 0))
+  if len(dst_keys) and (not len(src_keys) or np.any(src_keys[order][found] != dst_keys)):
+    raise ValueError("objects of index view are not contained in its source collection")
+
+  # global to per-event positions
+  src_offsets = np.zeros(len(src_counts), dtype=np.int64)
+  np.cumsum(src_counts[:-1], out=src_offsets[1:])
+  positions = order[found] - np.repeat(src_offsets, dst_counts)
+
+  return ak.unflatten(positions, dst_counts)
+
+
+def expand_index_view_columns(columns, index_view_collections: dict[str, str]) -> set[Route]:
+  """
+  Return *columns* extended by the source collection columns and stored positions that are needed
+  to rehydrate the derived collections they refer to.
+  """
+  columns = set(map(Route, columns))
+  for route in list(columns):
+    src_name = index_view_collections.get(route[0])
+    if src_name:
+      columns.add(Route([src_name, *route[1:]]))
+      columns.add(Route(f"index_views.{route[0]}"))
+  return columns
+
+
+def rehydrate_index_views(events: ak.Array, index_view_collections: dict[str, str]) -> ak.Array:
+  """
+  Add all derived collections stored as index views in *events* as views of their source
+  collections and remove the stored positions. Events without index views are returned unchanged.
+  """
+  if "index_views" not in events.fields:
+    return events
+
+  for dst_name in events.index_views.fields:
+    src_name = index_view_collections.get(dst_name)
+    if src_name and src_name in events.fields:
+      events = set_ak_column(events, dst_name, events[src_name][events.index_views[dst_name]])
+
+  return remove_ak_column(events, "index_views")
+
+
+@reducer(
+  # object indices are read from the selection results, not from events
+  check_used_columns=False,
+)
+def index_views(self: Reducer, events: ak.Array, selection: ak.Array, task: law.Task, **kwargs) -> ak.Array:
+  """
+  Stores the derived collections in *index_view_collections* as positions into their reduced
+  source collections. To be called on the reduced events, after *cf_default*, with the same
+  *selection*.
+  """
+  event_mask = create_event_mask(selection, task.selector_steps)
+  objects = selection.objects[event_mask]
+
+  # build all views first, as adding jagged fields one by one to a record fails to broadcast
+  views = {
+    dst_name: ak.values_astype(index_view_positions(
+      ak.drop_none(objects[src_name, src_name]),
+      ak.drop_none(objects[src_name, dst_name]),
+    ), np.int16)
+    for dst_name, src_name in self.index_view_collections.items()
+  }
+  if views:
+    events = set_ak_column(events, "index_views", ak.zip(views, depth_limit=1))
+
+  return events
+
+
+@index_views.init
+def index_views_init(self: Reducer, **kwargs) -> None:
+  self.index_view_collections = dict(self.config_inst.x("index_view_collections", {}))
+  self.produces |= {f"index_views.{dst_name}" for dst_name in self.index_view_collections}
+
+
+@index_views.post_init
+def index_views_post_init(self: Reducer, task: law.Task, **kwargs) -> None:
+  # the updates to used columns are only necessary if the task invokes the reducer
+  if not task.invokes_reducer:
+    return
+
+  # read the object indices of the derived and source collections from selection result data
+  for dst_name, src_name in self.index_view_collections.items():
+    self.uses |= {f"objects.{src_name}.{src_name}", f"objects.{src_name}.{dst_name}"}
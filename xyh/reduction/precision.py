@@ -0,0 +1,212 @@
+# coding: utf-8
+
+"""
+Lossy precision policies for columns written to event outputs.
+
+A policy maps column patterns, which are brace-expanded and may contain wildcards, to a precision
+spec. The first matching pattern wins, and columns without a match are stored unchanged.
+
+- ``"float16"``: half-precision floats.
+- ``("mantissa", n)``: floats rounded to *n* mantissa bits, keeping their type. Zstd compresses the
+  trailing zero bits to almost nothing.
+- ``("fixed", step)``: floats rounded to multiples of *step*, keeping their type.
+- ``"int8"``, ``"int16"``, ``"uint8"``, ...: integer downcasting. Values outside the range of the
+  target type raise an exception.
+
+Policies are configured per task family in the ``precision_policy`` auxiliary entry of the config,
+next to ``keep_columns``, and applied at write time in cf.ReduceEvents and cf.ProduceColumns (see
+xyh.columnflow_patches).
+"""
+
+from __future__ import annotations
+
+import law
+import order as od
+
+from columnflow.columnar_util import Route, get_ak_routes, set_ak_column
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+logger = law.logger.get_logger(__name__)
+
+
+def get_precision_policy(config_inst: od.Config, task_family: str) -> dict[str, str | tuple]:
+  """
+  Return the precision policy of *config_inst* for *task_family* with brace-expanded patterns,
+  or an empty dictionary when none is defined.
+  """
+  policy = {}
+  for pattern, spec in config_inst.x("precision_policy", {}).get(task_family, {}).items():
+    for _pattern in law.util.brace_expand(pattern):
+      policy.setdefault(_pattern, spec)
+  return policy
+
+
+def match_precision_spec(route: Route | str, policy: dict[str, str | tuple]) -> str | tuple | None:
+  """
+  Return the spec of the first pattern in *policy* matching the column *route*, or *None*.
+  """
+  column = Route(route).column
+  for pattern, spec in policy.items():
+    if law.util.multi_match(column, [pattern]):
+      return spec
+  return None
+
+
+def reduce_precision(values: np.ndarray, spec: str | tuple) -> np.ndarray:
+  """
+  Return a copy of the flat array *values* with a precision reduced according to *spec*.
+  """
+  name, param = (spec, None) if isinstance(spec, str) else spec
+
+  if name == "mantissa":
+    if values.dtype.kind != "f":
+      raise TypeError(f"mantissa truncation requires floats, got {values.dtype}")
+    int_type = {4: np.uint32, 8: np.uint64}[values.dtype.itemsize]
+    n_drop = np.finfo(values.dtype).nmant - int(param)
+    if n_drop <= 0:
+      return values.copy()
+    # round to nearest, carrying into the exponent, but leave non-finite values untouched
+    bits = values.view(int_type)
+    half, drop_mask = int_type(1 << (n_drop - 1)), int_type((1 << n_drop) - 1)
+    rounded = ((bits + half) & ~drop_mask).view(values.dtype)
+    return np.where(np.isfinite(values), rounded, values)
+
+  if name == "fixed":
+    if values.dtype.kind != "f":
+      raise TypeError(f"fixed-point quantization requires floats, got {values.dtype}")
+    return (np.round(values / param) * param).astype(values.dtype)
+
+  dtype = np.dtype(name)
+  if dtype.kind in "iu" and len(values):
+    info = np.iinfo(dtype)
+    if values.min() < info.min or values.max() > info.max:
+      raise ValueError(
+        f"cannot downcast values in range [{values.min()}, {values.max()}] to {dtype}",
+      )
+  return values.astype(dtype)
+
+
+def _map_flat(arr: ak.Array, func) -> ak.Array:
+  # apply func to the flat buffer of a possibly jagged array, keeping its structure
+  def transform(layout, **kwargs):
+    if layout.is_numpy:
+      return ak.contents.NumpyArray(func(layout.data))
+
+  return ak.transform(transform, arr)
+
+
+def apply_precision_policy(events: ak.Array, policy: dict[str, str | tuple]) -> ak.Array:
+  """
+  Return *events* with the precision of all columns matched by *policy* reduced.
+  """
+  if not policy:
+    return events
+
+  for route in get_ak_routes(events):
+    spec = match_precision_spec(route, policy)
+    if spec is None:
+      continue
+    column = _map_flat(route.apply(events), lambda values: reduce_precision(values, spec))
+    events = set_ak_column(events, route, column)
+
+  return events
+
+
+def _evaluate_variable(events: ak.Array, variable_inst: od.Variable) -> np.ndarray:
+  # evaluate a variable expression like cf.CreateHistograms, flattened and without missing values
+  expr = variable_inst.expression
+  if isinstance(expr, str):
+    values = Route(expr).apply(events, null_value=variable_inst.null_value)
+  else:
+    values = expr(events)
+  values = ak.flatten(ak.Array(values), axis=None)
+  return ak.to_numpy(ak.drop_none(values)).astype(np.float64)
+
+
+class PrecisionValidation(object):
+  """
+  Accumulates the deviations induced by a precision *policy* in the values and histograms of
+  *variable_insts*, evaluated on chunks of full-precision events passed to :py:meth:`add`.
+  """
+
+  def __init__(self, policy: dict[str, str | tuple], variable_insts):
+    super().__init__()
+
+    self.policy = policy
+    self.variable_insts = [
+      variable_inst for variable_inst in variable_insts
+      if variable_inst.expression is not None
+    ]
+
+    # per variable, the maximum absolute and relative value deviation, and the bin contents
+    self.max_abs = dict.fromkeys((v.name for v in self.variable_insts), 0.0)
+    self.max_rel = dict.fromkeys((v.name for v in self.variable_insts), 0.0)
+    self.counts = {}
+    self.n_migrated = dict.fromkeys((v.name for v in self.variable_insts), 0)
+
+    # variables that cannot be evaluated on the events
+    self.skipped = set()
+
+  def add(self, events: ak.Array) -> None:
+    lossy_events = apply_precision_policy(events, self.policy)
+
+    for variable_inst in self.variable_insts:
+      name = variable_inst.name
+      if name in self.skipped:
+        continue
+      try:
+        values = _evaluate_variable(events, variable_inst)
+      except Exception as e:
+        # variables based on columns that are not part of the events
+        logger.debug(f"cannot evaluate variable '{name}' for precision validation: {e}")
+        self.skipped.add(name)
+        continue
+      lossy_values = _evaluate_variable(lossy_events, variable_inst)
+
+      # histograms with flow bins
+      edges = np.asarray(variable_inst.bin_edges)
+      bins = np.searchsorted(edges, values, side="right")
+      lossy_bins = np.searchsorted(edges, lossy_values, side="right")
+      counts = np.bincount(bins, minlength=len(edges) + 1)
+      lossy_counts = np.bincount(lossy_bins, minlength=len(edges) + 1)
+      if name in self.counts:
+        self.counts[name][0] += counts
+        self.counts[name][1] += lossy_counts
+      else:
+        self.counts[name] = [counts, lossy_counts]
+
+      # elementwise comparison, only possible when the number of values is unchanged
+      if len(values) != len(lossy_values):
+        self.n_migrated[name] += int(np.abs(lossy_counts - counts).sum()) // 2
+        continue
+      self.n_migrated[name] += int((bins != lossy_bins).sum())
+      diff = np.abs(lossy_values - values)
+      finite = np.isfinite(diff)
+      if finite.any():
+        self.max_abs[name] = max(self.max_abs[name], float(diff[finite].max()))
+        rel = diff[finite] / np.maximum(np.abs(values[finite]), np.finfo(np.float32).tiny)
+        self.max_rel[name] = max(self.max_rel[name], float(rel.max()))
+
+  def report(self) -> dict[str, dict[str, float]]:
+    """
+    Return, per evaluated variable, the maximum absolute and relative deviation of its values, the
+    number of values that migrated to another bin and the maximum relative deviation of a bin
+    content, including flow bins.
+    """
+    report = {}
+    for variable_inst in self.variable_insts:
+      name = variable_inst.name
+      if name in self.skipped:
+        continue
+      counts, lossy_counts = self.counts.get(name, (np.zeros(1), np.zeros(1)))
+      bin_rel = np.abs(lossy_counts - counts) / np.maximum(counts, 1)
+      report[name] = {
+        "max_abs_deviation": self.max_abs[name],
+        "max_rel_deviation": self.max_rel[name],
+        "n_bin_migrations": self.n_migrated[name],
+        "max_rel_bin_deviation": float(bin_rel.max()),
+      }
+    return report
@@ -0,0 +1,82 @@
+# coding: utf-8
+
+"""
+Benchmark of the compiled delta-R matching in `xyh.util.delta_r_match_multiple` against the
+iterative reference implementation, using synthetic GenJet-like collections.
+
+Usage:
+
+  python -m xyh.scripts.benchmark_delta_r_match --n-events 100000
+"""
+
+from __future__ import annotations
+
+import argparse
+
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+coffea = maybe_import("coffea")
+maybe_import("coffea.nanoevents.methods.nanoaod")
+
+from xyh.util import delta_r_match_multiple, delta_r_match_multiple_iterative, measure, DELTA_R_MATCH_METHODS
+
+
+def synthetic_lvs(n_events: int, mean_num: float, seed: int = 0) -> ak.Array:
+  """
+  Random jagged `PtEtaPhiMLorentzVector` collection with Poisson distributed multiplicities.
+  """
+  rng = np.random.default_rng(seed)
+  counts = rng.poisson(mean_num, n_events)
+  n = counts.sum()
+  fields = {
+    "pt": rng.uniform(20.0, 200.0, n),
+    "eta": rng.uniform(-2.5, 2.5, n),
+    "phi": rng.uniform(-np.pi, np.pi, n),
+    "mass": rng.uniform(0.0, 20.0, n),
+  }
+  return ak.zip(
+    {name: ak.unflatten(values.astype(np.float32), counts) for name, values in fields.items()},
+    with_name="PtEtaPhiMLorentzVector",
+    behavior=coffea.nanoevents.methods.nanoaod.behavior,
+  )
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+  parser.add_argument("--n-events", type=int, default=100000)
+  parser.add_argument("--n-src", type=float, default=4.0, help="mean source multiplicity")
+  parser.add_argument("--n-dst", type=float, default=6.0, help="mean destination multiplicity")
+  parser.add_argument("--max-dr", type=float, default=None)
+  parser.add_argument("--repeat", type=int, default=3)
+  args = parser.parse_args()
+
+  src = synthetic_lvs(args.n_events, args.n_src, seed=1)
+  dst = synthetic_lvs(args.n_events, args.n_dst, seed=2)
+
+  # trigger compilation outside of the measurement
+  for method in DELTA_R_MATCH_METHODS:
+    delta_r_match_multiple(dst[:10], src[:10], max_dr=args.max_dr, method=method)
+
+  ref, ref_time, ref_mem = measure(
+    delta_r_match_multiple_iterative, dst, src, max_dr=args.max_dr, repeat=args.repeat,
+  )
+  print(f"{'iterative':>12}: {ref_time:8.3f} s, peak {ref_mem / 1024**2:8.1f} MB")
+
+  for method in DELTA_R_MATCH_METHODS:
+    (result, _), t, mem = measure(
+      delta_r_match_multiple, dst, src, max_dr=args.max_dr, method=method, repeat=args.repeat,
+    )
+    n_matched = ak.sum(~ak.is_none(result, axis=1))
+    msg = f"{method:>12}: {t:8.3f} s, peak {mem / 1024**2:8.1f} MB, speedup {ref_time / t:6.1f}, {n_matched} matches"
+    if method == "sequential":
+      same = ak.all(ak.fill_none(ref[0].pt == result.pt, True)) and ak.all(
+        ak.is_none(ref[0], axis=1) == ak.is_none(result, axis=1),
+      )
+      msg += f", identical to iterative: {same}"
+    print(msg)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,122 @@
+# coding: utf-8
+
+"""
+Speed and peak-memory comparison of the fused jet lepton cleaning in
+`xyh.calibration.jets.clean_jets_flat` against the jagged reference implementation on a synthetic
+chunk, including a check for bit-identical outputs.
+
+Usage:
+
+  python -m xyh.scripts.benchmark_jet_lepton_cleaner --n-events 100000
+"""
+
+from __future__ import annotations
+
+import argparse
+
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+coffea = maybe_import("coffea")
+maybe_import("coffea.nanoevents.methods.nanoaod")
+
+from xyh.util import measure
+from xyh.calibration.jets import clean_jets_flat, clean_jets_jagged
+
+
+def synthetic_events(n_events: int, seed: int = 0) -> ak.Array:
+  """
+  Random events with Jet, Electron and Muon collections, where a fraction of jets is matched to
+  leptons that are roughly collinear and carry part of the jet energy.
+  """
+  rng = np.random.default_rng(seed)
+
+  def collection(counts, pt_range, **extra):
+    n = counts.sum()
+    fields = {
+      "pt": rng.uniform(*pt_range, n),
+      "eta": rng.uniform(-2.5, 2.5, n),
+      "phi": rng.uniform(-np.pi, np.pi, n),
+      "mass": rng.uniform(0.0, 10.0, n),
+      **extra,
+    }
+    return {
+      name: values.astype(np.float32) if values.dtype.kind == "f" else values
+      for name, values in fields.items()
+    }
+
+  jet_counts = rng.poisson(6, n_events)
+  ele_counts = rng.poisson(0.6, n_events)
+  mu_counts = rng.poisson(0.6, n_events)
+  n_jets = jet_counts.sum()
+  jets = collection(
+    jet_counts, (15.0, 300.0),
+    rawFactor=rng.uniform(0.0, 0.3, n_jets),
+    chEmEF=rng.uniform(0.0, 1.0, n_jets),
+    muEF=rng.uniform(0.0, 1.0, n_jets),
+  )
+  electrons = collection(ele_counts, (5.0, 100.0))
+  muons = collection(mu_counts, (5.0, 100.0))
+  electrons["mass"][:] = 0.000511
+  muons["mass"][:] = 0.1057
+
+  # match leptons to random jets of the same event
+  jet_event = np.repeat(np.arange(n_events), jet_counts)
+  jet_offsets = np.concatenate([[0], np.cumsum(jet_counts)])
+  for name, lep, lep_counts in [("electron", electrons, ele_counts), ("muon", muons, mu_counts)]:
+    idx1 = np.full(n_jets, -1, dtype=np.int32)
+    idx2 = np.full(n_jets, -1, dtype=np.int32)
+    lep_event = np.repeat(np.arange(n_events), lep_counts)
+    lep_local = np.arange(lep_counts.sum()) - np.repeat(np.concatenate([[0], np.cumsum(lep_counts)[:-1]]), lep_counts)
+    has_jet = jet_counts[lep_event] > 0
+    matched = has_jet & (rng.uniform(size=len(lep_event)) < 0.7)
+    jet_idx = jet_offsets[lep_event[matched]] + rng.integers(0, 1 << 30, matched.sum()) % jet_counts[lep_event[matched]]
+    # first lepton per jet goes to slot 1, a second one to slot 2
+    free1 = idx1[jet_idx] < 0
+    idx1[jet_idx[free1]] = lep_local[matched][free1]
+    idx2[jet_idx[~free1]] = lep_local[matched][~free1]
+    # make matched leptons collinear with a fraction of the jet momentum
+    lep["eta"][matched] = jets["eta"][jet_idx] + rng.normal(0, 0.02, matched.sum()).astype(np.float32)
+    lep["phi"][matched] = jets["phi"][jet_idx] + rng.normal(0, 0.02, matched.sum()).astype(np.float32)
+    lep["pt"][matched] = jets["pt"][jet_idx] * rng.uniform(0.05, 0.9, matched.sum()).astype(np.float32)
+    jets[f"{name}Idx1"] = idx1
+    jets[f"{name}Idx2"] = idx2
+  del jet_event
+
+  unflatten = lambda fields, counts: ak.zip({f: ak.unflatten(v, counts) for f, v in fields.items()})
+  return ak.Array({
+    "Jet": unflatten(jets, jet_counts),
+    "Electron": unflatten(electrons, ele_counts),
+    "Muon": unflatten(muons, mu_counts),
+  }, behavior=coffea.nanoevents.methods.nanoaod.behavior)
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+  parser.add_argument("--n-events", type=int, default=100000, help="default: chunked_io_chunk_size")
+  parser.add_argument("--repeat", type=int, default=3)
+  args = parser.parse_args()
+
+  events = synthetic_events(args.n_events)
+
+  # the jagged implementation replaces collections in place, so pass shallow copies
+  copy = lambda: ak.Array(events.layout, behavior=events.behavior)
+  ref, ref_time, ref_mem = measure(lambda: clean_jets_jagged(copy()), repeat=args.repeat)
+  print(f"{'jagged':>8}: {ref_time:8.3f} s, peak {ref_mem / 1024**2:8.1f} MB")
+
+  out, t, mem = measure(lambda: clean_jets_flat(copy()), repeat=args.repeat)
+  print(
+    f"{'flat':>8}: {t:8.3f} s, peak {mem / 1024**2:8.1f} MB, "
+    f"speedup {ref_time / t:5.1f}, memory ratio {ref_mem / mem:5.1f}",
+  )
+
+  for var in ["pt", "eta", "phi", "mass", "rawFactor"]:
+    a = ak.to_numpy(ak.flatten(ref.Jet[var]))
+    b = ak.to_numpy(ak.flatten(out.Jet[var]))
+    same = a.dtype == b.dtype and a.tobytes() == b.tobytes()
+    print(f"Jet.{var}: bit-identical {same}")
+
+
+if __name__ == "__main__":
+  main()
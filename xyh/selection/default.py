@@ -9,9 +9,11 @@ from functools import reduce
 from collections import defaultdict
 from typing import Tuple
 
+import law
+
 from columnflow.util import maybe_import
+from columnflow.columnar_util import add_ak_aliases
 
-from columnflow.selection.stats import increment_stats
 from columnflow.selection import Selector, SelectionResult, selector
 from columnflow.selection.cms.met_filters import met_filters
 from columnflow.selection.cms.json_filter import json_filter
@@ -25,6 +27,9 @@ from columnflow.production.processes import process_ids
 # from xyh.selection.trigger_selection import trigger_selection
 from xyh.selection.lepton_selection import lepton_selection
 from xyh.selection.jet_selection import jet_selection
+from xyh.selection.util import StagedSelection
+from xyh.selection.stats import increment_stats_grouped
+from xyh.production.weight_matrix import weight_matrices, weight_matrix_enabled
 
 
 np = maybe_import("numpy")
@@ -34,19 +39,25 @@ ak = maybe_import("awkward")
 @selector(
   uses={
     process_ids, attach_coffea_behavior,
-    mc_weight, increment_stats,
+    mc_weight, increment_stats_grouped,
     met_filters, json_filter, jet_veto_map,
     lepton_selection, jet_selection, # trigger_selection
   },
   produces={
     process_ids, attach_coffea_behavior,
-    mc_weight, increment_stats,
+    mc_weight, increment_stats_grouped,
     met_filters, json_filter, jet_veto_map,
     lepton_selection, jet_selection, # trigger_selection
   },
   exposed=True,
   check_used_columns=False,
   check_produced_columns=False,
+  # names of steps after which following selectors only run on the events passing them
+  hard_steps=None,
+  # read columns only needed after the hard steps in a second phase, for passing events only
+  two_phase_reading=False,
+  # evaluate the selection for all selection-dependent shifts in the same pass as nominal
+  multi_shift=False,
 )
 def default(
   self: Selector,
@@ -61,24 +72,50 @@ def default(
   # prepare the selection results that are updated at every step
   results = SelectionResult()
 
-  # MET filters and jet veto maps
-  events, met_filters_results = self[met_filters](events, **kwargs)
-  results += met_filters_results
+  # selectors are called through the stage, which skips events failing hard steps
+  stage = StagedSelection(events, hard_steps=self.hard_steps)
 
-  events, jet_veto_results = self[jet_veto_map](events, **kwargs)
-  results += jet_veto_results
+  # MET filters and jet veto maps, the latter after the preselection in case of two-phase reading
+  results += stage(self[met_filters], **kwargs)
+  if not self.two_phase_reading:
+    results += stage(self[jet_veto_map], **kwargs)
 
   # JSON filter (data-only)
   if self.dataset_inst.is_data:
-      events, json_filter_results = self[json_filter](events, **kwargs)
-      results += json_filter_results
+      results += stage(self[json_filter], **kwargs)
 
   # Now analysis specific selections
-  events, results_lepton = self[lepton_selection](events, **kwargs) 
+  results_lepton = stage(self[lepton_selection], **kwargs)
   results += results_lepton
 
-  events, results_jet = self[jet_selection](events, results_lepton, **kwargs)
-  results += results_jet
+  if self.two_phase_reading:
+    stage.load_deferred_columns(kwargs.get("task"))
+    results += stage(self[jet_veto_map], **kwargs)
+
+  results += stage(self[jet_selection], results_lepton, **kwargs)
+
+  events = stage.events
+  stage.update_stats(stats)
+
+  # variations of weights stored per family as matrices (see xyh.production.weight_matrix)
+  if self.dataset_inst.is_mc and self.has_dep(weight_matrices):
+    events = self[weight_matrices](events, jet_mask=results.aux["jet_mask"], **kwargs)
+
+  # reevaluate the jet dependent selectors per selection-dependent shift, taking all other steps
+  # and objects from the nominal results
+  shift_results = {}
+  for shift_name, aliases in self.multi_shift_aliases.items():
+    if not self.dataset_inst.is_mc:
+      break
+    shifted_events = add_ak_aliases(events, aliases, remove_src=False)
+    shifted_results = SelectionResult(
+      steps=dict(results.steps),
+      objects={src: dict(dsts) for src, dsts in results.objects.items()},
+    )
+    shifted_results += self[jet_veto_map](shifted_events, **kwargs)[1]
+    shifted_results += self[jet_selection](shifted_events, results_lepton, **kwargs)[1]
+    shifted_results.event = ak.fill_none(reduce(and_, shifted_results.steps.values()), False)
+    shift_results[shift_name] = shifted_results
 
   # TODO: Implement trigger selection
   # events, results_trig = self[trigger_selection](events, **kwargs)
@@ -91,6 +128,13 @@ def default(
   results.event = reduce(and_, results.steps.values())
   results.event = ak.fill_none(results.event, False)
 
+  # per-shift results as an additional field, consumed by the multi_shift reducer
+  if shift_results:
+    results.other["shifts"] = ak.zip(
+      {shift_name: shifted.to_ak() for shift_name, shifted in shift_results.items()},
+      depth_limit=1,
+    )
+
   weight_map = {
     "num_events": Ellipsis,
     "num_events_selected": results.event,
@@ -107,10 +151,13 @@ def default(
         # per process
         "process": {
             "values": events.process_id,
-            "mask_fn": (lambda v: events.process_id == v),
         },
     }
-  events, results = self[increment_stats](
+  for shift_name, shifted in shift_results.items():
+    weight_map[f"num_events_selected_{shift_name}"] = shifted.event
+    if self.dataset_inst.is_mc:
+      weight_map[f"sum_mc_weight_selected_{shift_name}"] = (events.mc_weight, shifted.event)
+  events, results = self[increment_stats_grouped](
       events,
       results,
       stats,
@@ -121,6 +168,69 @@ def default(
 
   return events, results
 
+
+@default.pre_init
+def default_pre_init(self: Selector) -> None:
+  # let dependencies know that they should not register selection-dependent shifts themselves
+  if self.multi_shift:
+    self.inst_dict["multi_shift_selection"] = True
+
+
+@default.init
+def default_init(self: Selector) -> None:
+  if weight_matrix_enabled(self.config_inst):
+    self.uses.add(weight_matrices)
+    self.produces.add(weight_matrices)
+
+  # column aliases per selection-dependent shift that is evaluated in the same pass
+  self.multi_shift_aliases = {}
+  if not self.multi_shift:
+    return
+
+  for shift_inst in self.config_inst.shifts:
+    if shift_inst.has_tag("selection_dependent"):
+      aliases = shift_inst.x("column_aliases_selection_dependent", {})
+      self.multi_shift_aliases[shift_inst.name] = aliases
+      self.uses |= set(aliases.values())
+
+
+@default.setup
+def default_setup(
+  self: Selector,
+  task: law.Task,
+  reqs: dict,
+  inputs: dict,
+  reader_targets: law.util.InsertableDict,
+  **kwargs,
+) -> None:
+  # columns that are only used after the preselection and can be read in a second phase
+  self.deferred_columns = set()
+  if not self.two_phase_reading:
+    return
+
+  early_columns = set.union(*(
+    self[dep].used_columns
+    for dep in [mc_weight, met_filters, json_filter, lepton_selection, process_ids, increment_stats_grouped]
+  ))
+  late_columns = self[jet_veto_map].used_columns | self[jet_selection].used_columns
+  self.deferred_columns = late_columns - early_columns
+
+
+# variant that only runs selectors on events passing the event filters and the lepton selection
+default_staged = default.derive("default_staged", cls_dict={
+  "hard_steps": ["met_filter", "json", "Lepton"],
+})
+
+# variant that evaluates nominal and all selection-dependent shifts in one pass over the input
+default_multi_shift = default.derive("default_multi_shift", cls_dict={
+  "multi_shift": True,
+})
+
+# staged variant that reads jet columns only for events passing the preselection
+default_two_phase = default_staged.derive("default_two_phase", cls_dict={
+  "two_phase_reading": True,
+})
+
 # @default.init
 # def default_init(self: Selector) -> None:
 #   if not self.config_inst.get_aux("has_categories_sel", False):
@@ -7,13 +7,13 @@ Exemplary selection methods.
 from collections import defaultdict
 
 from columnflow.selection import Selector, SelectionResult, selector
-from columnflow.selection.stats import increment_stats
 from columnflow.columnar_util import sorted_indices_from_mask
 from columnflow.production.processes import process_ids
 from columnflow.production.cms.mc_weight import mc_weight
 from columnflow.util import maybe_import
 
 from xyh.production.example import cutflow_features
+from xyh.selection.stats import increment_stats_grouped
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
@@ -101,7 +101,7 @@ def jet_selection_init(self: Selector) -> None:
     uses={
         # selectors / producers called within _this_ selector
         mc_weight, cutflow_features, process_ids, muon_selection, jet_selection,
-        increment_stats,
+        increment_stats_grouped,
     },
     produces={
         # selectors / producers whose newly created columns should be kept
@@ -156,15 +156,13 @@ def example(
             # per process
             "process": {
                 "values": events.process_id,
-                "mask_fn": (lambda v: events.process_id == v),
             },
             # per jet multiplicity
             "njet": {
                 "values": results.x.n_jets,
-                "mask_fn": (lambda v: results.x.n_jets == v),
             },
         }
-    events, results = self[increment_stats](
+    events, results = self[increment_stats_grouped](
         events,
         results,
         stats,
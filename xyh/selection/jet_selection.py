@@ -17,7 +17,7 @@ from columnflow.columnar_util import set_ak_column, optional_column as optional
 from columnflow.selection import Selector, SelectionResult, selector
 from columnflow.production.cms.jet import jet_id, fatjet_id
 
-from xyh.util import masked_sorted_indices, call_once_on_config, IF_NANO_V12, IF_NANO_geV13
+from xyh.util import masked_sorted_indices, min_delta_r, call_once_on_config, IF_NANO_V12, IF_NANO_geV13
 from xyh.production.jets import jetId_v12 # , fatjetId_v12
 
 np = maybe_import("numpy")
@@ -33,6 +33,8 @@ logger = law.logger.get_logger(__name__)
         "Jet.{pt,eta,phi,mass,jetId}", optional("Jet.puId"),
     },
     exposed=True,
+    # collections of jagged aux arrays in the selection result
+    aux_collections={"jet_mask": "Jet"},
 )
 def jet_selection(
     self: Selector,
@@ -44,9 +46,6 @@ def jet_selection(
 ) -> Tuple[ak.Array, SelectionResult]:
   steps = DotDict()
 
-  # assign local index to all Jets
-  events = set_ak_column(events, "local_index", ak.local_index(events.Jet))
-
   # get correct jet Ids (Jet.TightId and Jet.TightLepVeto)
   if self.has_dep(jetId_v12):
       events = self[jetId_v12](events, **kwargs)
@@ -73,8 +72,7 @@ def jet_selection(
     (events.Jet.pt >= self.jet_pt) &
     (abs(events.Jet.eta) <= 4.7) &
     tight_lep_veto &
-    ak.all(events.Jet.metric_table(electron) > 0.4, axis=2) &
-    ak.all(events.Jet.metric_table(muon) > 0.4, axis=2)
+    (min_delta_r(events.Jet, electron, muon) > 0.4)
   )
   jet_mask = jet_mask_incl & (abs(events.Jet.eta) <= 2.4)
   forward_jet_mask = jet_mask_incl & (abs(events.Jet.eta) > 2.4) & (abs(events.Jet.eta) <= 4.7)
@@ -90,13 +88,15 @@ def jet_selection(
   jet_indices = masked_sorted_indices(jet_mask, events.Jet.pt)
 
   # add jet steps
-  events = set_ak_column(events, "cutflow.n_jet", ak.sum(jet_mask, axis=1))
-  steps["nJet1"] = events.cutflow.n_jet >= 1
-  steps["nJet2"] = events.cutflow.n_jet >= 2
-  steps["nJet3"] = events.cutflow.n_jet >= 3
-  steps["nJet4"] = events.cutflow.n_jet >= 4
+  n_jet = ak.sum(jet_mask, axis=1)
+  if "cutflow.n_jet" in self.produces:
+    events = set_ak_column(events, "cutflow.n_jet", n_jet)
+  steps["nJet1"] = n_jet >= 1
+  steps["nJet2"] = n_jet >= 2
+  steps["nJet3"] = n_jet >= 3
+  steps["nJet4"] = n_jet >= 4
   if self.config_inst.x("n_jet", 0) > 4:
-      steps[f"nJet{self.config_inst.x.n_jet}"] = events.cutflow.n_jet >= self.config_inst.x.n_jet
+      steps[f"nJet{self.config_inst.x.n_jet}"] = n_jet >= self.config_inst.x.n_jet
 
   # define btag mask
   btag_column = self.config_inst.x.btag_column
@@ -145,12 +145,13 @@ def jet_selection_init(self: Selector) -> None:
   # configuration of defaults
   self.jet_pt = self.config_inst.x("jet_pt", 25)
 
-  # Add shift dependencies
-  self.shifts |= {
-    shift_inst.name
-    for shift_inst in self.config_inst.shifts
-    if shift_inst.has_tag(("jec", "jer"))
-  }
+  # Add shift dependencies, unless selection-dependent shifts are evaluated in one pass
+  if not self.inst_dict.get("multi_shift_selection", False):
+    self.shifts |= {
+      shift_inst.name
+      for shift_inst in self.config_inst.shifts
+      if shift_inst.has_tag(("jec", "jer"))
+    }
 
   # add btag requirement
   self.uses.add(f"Jet.{self.config_inst.x.btag_column}")
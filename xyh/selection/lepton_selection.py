@@ -24,6 +24,8 @@ ak = maybe_import("awkward")
     "cutflow.n_mu", "cutflow.n_ele"
   },
   exposed=True,
+  # collections of jagged aux arrays in the selection result
+  aux_collections={"ele_mask": "Electron", "mu_mask": "Muon"},
 )
 def lepton_selection(
   self: Selector,
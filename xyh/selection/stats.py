@@ -0,0 +1,198 @@
+# coding: utf-8
+
+"""
+Selectors for the book keeping of selection statistics of XY(bb)H(tt) selections.
+"""
+
+from __future__ import annotations
+
+import itertools
+from functools import reduce, partial
+from collections import defaultdict
+from operator import and_, getitem as getitem_
+from typing import Callable, Sequence, Tuple
+
+import law
+
+from columnflow.selection import Selector, SelectionResult, selector
+from columnflow.util import maybe_import, DotDict
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+def _nested_defaultdict(dtype: type, depth: int) -> defaultdict:
+  if depth <= 1:
+    return defaultdict(dtype)
+  # partial instead of a lambda, so that stats can be pickled
+  return defaultdict(partial(_nested_defaultdict, dtype, depth - 1))
+
+
+@selector(
+  call_force=True,
+)
+def increment_stats_grouped(
+  self: Selector,
+  events: ak.Array,
+  results: SelectionResult,
+  stats: dict,
+  weight_map: dict[str, ak.Array | tuple[ak.Array, ak.Array]] | None = None,
+  group_map: dict[str, dict[str, ak.Array | Callable]] | None = None,
+  group_combinations: Sequence[tuple[str]] | None = None,
+  skip_func: Callable[[str, list[str]], bool] | None = None,
+  **kwargs,
+) -> Tuple[ak.Array, SelectionResult]:
+  """
+  Drop-in replacement of columnflow's `increment_stats` that fills the same fields in `stats`, but
+  evaluates grouped sums in one pass per weight and group combination.
+
+  Groups in `group_map` that only define per-event `"values"` (no `"mask_fn"`) are converted to
+  integer codes of their unique values. The sums for all values of such groups, and all
+  combinations between them, are then obtained with a single (weighted) `np.bincount` instead of
+  one full-length mask per value and weight. Groups that define a `"mask_fn"`, or whose values are
+  not per-event, are evaluated with their masks as before.
+
+  .. code-block:: python
+
+    group_map = {
+      "process": {"values": events.process_id},  # bincount path
+      "njet": {  # mask path
+        "values": results.x.n_jets,
+        "mask_fn": (lambda v: results.x.n_jets == v),
+      },
+    }
+  """
+  # defaults
+  if weight_map is None:
+    weight_map = {}
+  if group_map is None:
+    group_map = {}
+  group_combinations = list(group_combinations or [])
+  if skip_func is None:
+    skip_func = lambda weight_name, group_names: False
+
+  n_events = len(events)
+
+  # unique values per group, and integer codes per event for groups without a mask function
+  unique_group_values = {}
+  group_codes = {}
+  for group_name, group_data in group_map.items():
+    values = group_data["values"]
+    if "mask_fn" not in group_data and values.ndim == 1 and len(values) == n_events:
+      unique_group_values[group_name], group_codes[group_name] = np.unique(
+        ak.to_numpy(values),
+        return_inverse=True,
+      )
+    else:
+      unique_group_values[group_name] = np.unique(ak.flatten(values, axis=None))
+
+  def group_mask(group_name, index, value):
+    if group_name in group_codes:
+      return group_codes[group_name] == index
+    return ak.to_numpy(group_map[group_name]["mask_fn"](value))
+
+  # treat groups as combinations of a single group
+  for group_name, group_data in list(group_map.items())[::-1]:
+    if group_data.get("combinations_only", False) or (group_name,) in group_combinations:
+      continue
+    group_combinations.insert(0, (group_name,))
+
+  # get and store the weights per entry in the map
+  for weight_name, obj in weight_map.items():
+    # check whether the weight is either a "num" or "sum" field
+    if weight_name.startswith("num"):
+      op = self.NUM
+    elif weight_name.startswith("sum"):
+      op = self.SUM
+    else:
+      raise Exception(
+        f"weight '{weight_name}' starting with unknown operation; should either start with "
+        "'num' or 'sum'",
+      )
+
+    # interpret obj based on the operation to be applied
+    weights = None
+    weight_mask = Ellipsis
+    if isinstance(obj, (tuple, list)):
+      if op == self.NUM:
+        raise Exception(
+          f"weight map entry '{weight_name}' should refer to a mask, but found a sequence: {obj}",
+        )
+      if len(obj) == 1:
+        weights = obj[0]
+      elif len(obj) == 2:
+        weights, weight_mask = obj
+      else:
+        raise Exception(f"cannot interpret as weights and optional mask: '{obj}'")
+    elif op == self.NUM:
+      weight_mask = obj
+    else:  # SUM
+      weights = obj
+
+    # convert to numpy, with an explicit mask when selecting all events
+    if weight_mask is Ellipsis:
+      weight_mask = np.ones(n_events, dtype=bool)
+    else:
+      weight_mask = ak.to_numpy(weight_mask).astype(bool)
+    if weights is not None:
+      weights = ak.to_numpy(weights).astype(np.float64)
+
+    # apply the operation
+    if op == self.NUM:
+      stats[weight_name] += int(weight_mask.sum())
+    else:  # SUM
+      stats[weight_name] += float(weights[weight_mask].sum())
+
+    # per group combination
+    for group_names in group_combinations:
+      # optionally skip
+      if skip_func(weight_name, group_names):
+        continue
+
+      group_key = f"{weight_name}_per_" + "_and_".join(group_names)
+
+      # set the default structures
+      if group_key not in stats:
+        stats[group_key] = _nested_defaultdict(int if op == self.NUM else float, len(group_names))
+
+      shape = tuple(len(unique_group_values[g]) for g in group_names)
+      if all(g in group_codes for g in group_names):
+        # bincount of the combined codes, in the same order as the product of unique values
+        codes = np.ravel_multi_index([group_codes[g][weight_mask] for g in group_names], shape)
+        sums = np.bincount(
+          codes,
+          weights=None if op == self.NUM else weights[weight_mask],
+          minlength=int(np.prod(shape)),
+        )
+      else:
+        sums = np.zeros(int(np.prod(shape)))
+        for i, indices in enumerate(itertools.product(*map(range, shape))):
+          mask = reduce(and_, (
+            group_mask(g, j, unique_group_values[g][j])
+            for g, j in zip(group_names, indices)
+          ), weight_mask)
+          sums[i] = mask.sum() if op == self.NUM else weights[mask].sum()
+
+      # find the innermost dict to perform the in-place item assignment, then increment
+      for values, value_sum in zip(
+        itertools.product(*(unique_group_values[g] for g in group_names)),
+        sums.tolist(),
+      ):
+        str_values = list(map(str, values))
+        innermost_dict = reduce(getitem_, [stats[group_key]] + str_values[:-1])
+        innermost_dict[str_values[-1]] += int(value_sum) if op == self.NUM else value_sum
+
+  return events, results
+
+
+@increment_stats_grouped.setup
+def increment_stats_grouped_setup(
+  self: Selector,
+  task: law.Task,
+  reqs: dict[str, DotDict],
+  inputs: dict,
+  reader_targets: law.util.InsertableDict,
+  **kwargs,
+) -> None:
+  # flags to describe "number" and "sum" fields
+  self.NUM, self.SUM = range(2)
@@ -0,0 +1,238 @@
+# coding: utf-8
+
+"""
+Helpers for XY(bb)H(tt) selections.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+
+import law
+
+from columnflow.selection import Selector, SelectionResult
+from columnflow.columnar_util import Route, get_ak_routes, has_ak_column, set_ak_column
+from columnflow.util import maybe_import
+
+from xyh.util import route_covered
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+logger = law.logger.get_logger(__name__)
+
+
+def scatter_events(
+  arr: ak.Array,
+  mask: np.ndarray,
+  fill=0,
+  counts: np.ndarray | None = None,
+) -> ak.Array:
+  """
+  Scatter a per-event array `arr` that was evaluated on the events selected by the boolean
+  `mask` back to the full shape. Per-event values of skipped events are set to `fill`.
+  Jagged arrays get empty lists for skipped events, unless the full-shape `counts` are given, in
+  which case skipped events get `counts` entries with value `fill`.
+  """
+  arr = ak.Array(arr)
+  n = len(mask)
+
+  if arr.ndim == 1:
+    values = ak.to_numpy(ak.fill_none(arr, fill))
+    full = np.full(n, fill, dtype=values.dtype)
+    full[mask] = values
+    return ak.Array(full)
+
+  values = ak.flatten(arr, axis=1)
+  sub_counts = ak.to_numpy(ak.num(arr, axis=1))
+  if counts is None:
+    full_counts = np.zeros(n, dtype=sub_counts.dtype)
+    full_counts[mask] = sub_counts
+    return ak.unflatten(values, full_counts)
+
+  values = ak.to_numpy(ak.fill_none(values, fill))
+  full = np.full(counts.sum(), fill, dtype=values.dtype)
+  full[np.repeat(mask, counts)] = values
+  return ak.unflatten(full, counts)
+
+
+def take_selection_result(results: SelectionResult, mask: np.ndarray) -> SelectionResult:
+  """
+  Return a new `SelectionResult` whose arrays are restricted to the events selected by `mask`.
+  """
+  take = lambda obj: obj[mask] if isinstance(obj, ak.Array) else obj
+  return SelectionResult(
+    event=None if results.event is None else take(results.event),
+    steps={name: take(step) for name, step in results.steps.items()},
+    objects=law.util.map_struct(take, results.objects.copy(), map_dict=True),
+    aux={name: take(value) for name, value in results.aux.items()},
+  )
+
+
+def scatter_selection_result(
+  results: SelectionResult,
+  mask: np.ndarray,
+  full_events: ak.Array,
+  aux_collections: dict[str, str] | None = None,
+) -> SelectionResult:
+  """
+  Scatter the arrays of a `SelectionResult` obtained on the events selected by `mask` back to the
+  shape of `full_events`. Steps and the event mask are *False* for skipped events, and object
+  indices are empty. Jagged aux arrays get entries for all objects of the collection in
+  `full_events` that `aux_collections` maps them to, filled with zeros.
+  """
+  aux_collections = aux_collections or {}
+
+  def scatter_aux(name, value):
+    if not isinstance(value, ak.Array):
+      return value
+    if value.ndim == 2:
+      if name not in aux_collections:
+        raise ValueError(
+          f"cannot scatter jagged aux array '{name}' of selection result, its collection is not "
+          "defined in aux_collections",
+        )
+      counts = ak.to_numpy(ak.num(full_events[aux_collections[name]], axis=1))
+      return scatter_events(value, mask, counts=counts)
+    return scatter_events(value, mask)
+
+  scatter_bool = lambda arr: scatter_events(arr, mask, fill=False)
+  return SelectionResult(
+    event=None if results.event is None else scatter_bool(results.event),
+    steps={name: scatter_bool(step) for name, step in results.steps.items()},
+    objects=law.util.map_struct(
+      lambda obj: scatter_events(obj, mask) if isinstance(obj, ak.Array) else obj,
+      results.objects.copy(),
+      map_dict=True,
+    ),
+    aux={name: scatter_aux(name, value) for name, value in results.aux.items()},
+  )
+
+
+class StagedSelection(object):
+  """
+  Helper that calls a sequence of selectors in the order of the calls, with early event filtering
+  between them. After a selector returned a step that is listed in `hard_steps`, all following
+  selectors only run on the events that passed it (and all previous hard steps). Their step masks,
+  object indices, aux data and produced columns are scattered back to the full chunk, so that
+  event-level results are identical to running all selectors on all events, and steps of skipped
+  events are *False*. Cutflows that apply steps cumulatively in the order of the calls are
+  therefore unchanged.
+
+  Columns set by the selectors must be declared in their `produces`, and jagged aux arrays of
+  their results must be mapped to the collection they belong to in their `aux_collections`.
+  Without `hard_steps`, all selectors run on the full chunk.
+
+  .. code-block:: python
+
+    stage = StagedSelection(events, hard_steps=["Lepton"])
+    results_lepton = stage(self[lepton_selection], **kwargs)
+    results_jet = stage(self[jet_selection], results_lepton, **kwargs)
+    events = stage.events
+  """
+
+  def __init__(self, events: ak.Array, hard_steps: list[str] | tuple[str] | None = None):
+    super().__init__()
+
+    self.events = events
+    self.hard_steps = list(hard_steps or [])
+    self.mask = np.ones(len(events), dtype=bool)
+
+    # number of events skipped per called selector
+    self.skipped = OrderedDict()
+
+  @property
+  def n_events(self) -> int:
+    return len(self.mask)
+
+  def __call__(self, selector_inst: Selector, *args, **kwargs) -> SelectionResult:
+    n_pass = int(self.mask.sum())
+    self.skipped[selector_inst.cls_name] = self.n_events - n_pass
+
+    if n_pass == self.n_events:
+      events, results = selector_inst(self.events, *args, **kwargs)
+      self._check_columns(selector_inst, events)
+      self.events = events
+    else:
+      args = [
+        take_selection_result(arg, self.mask) if isinstance(arg, SelectionResult) else arg
+        for arg in args
+      ]
+      events, results = selector_inst(self.events[self.mask], *args, **kwargs)
+      self._check_columns(selector_inst, events)
+
+      # scatter produced columns back to the full events
+      for route in selector_inst.produced_columns:
+        if has_ak_column(events, route):
+          self._scatter_column(route, route.apply(events))
+
+      results = scatter_selection_result(
+        results,
+        self.mask,
+        self.events,
+        aux_collections=getattr(selector_inst, "aux_collections", None),
+      )
+
+    # apply hard steps
+    for step_name in self.hard_steps:
+      if step_name in results.steps:
+        self.mask &= ak.to_numpy(ak.fill_none(results.steps[step_name], False))
+
+    return results
+
+  def _check_columns(self, selector_inst: Selector, events: ak.Array) -> None:
+    # columns that are not declared would be lost when the selector runs on a subset of events,
+    # so they are rejected independent of the events passing the hard steps
+    if not self.hard_steps:
+      return
+    undeclared = [
+      str(route) for route in set(get_ak_routes(events)) - set(get_ak_routes(self.events))
+      if not route_covered(route, selector_inst.produced_columns)
+    ]
+    if undeclared:
+      raise ValueError(
+        f"selector {selector_inst.cls_name} sets columns that are not declared in its produces: "
+        f"{', '.join(sorted(undeclared))}",
+      )
+
+  def _scatter_column(self, route: Route, column: ak.Array) -> None:
+    # jagged columns get the structure of their parent collection, if existing
+    counts = None
+    if len(route) > 1 and column.ndim == 2 and has_ak_column(self.events, route[:-1]):
+      counts = ak.to_numpy(ak.num(route[:-1].apply(self.events), axis=1))
+    self.events = set_ak_column(self.events, route, scatter_events(column, self.mask, counts=counts))
+
+  def add_columns(self, columns: ak.Array) -> None:
+    """
+    Add all `columns`, obtained for the events currently passing all hard steps, to the full
+    events. Columns that already exist are not overwritten.
+    """
+    for route in get_ak_routes(columns):
+      if not has_ak_column(self.events, route):
+        self._scatter_column(route, route.apply(columns))
+
+  def load_deferred_columns(self, task) -> None:
+    """
+    Read columns that were deferred by the `task` to a second reading phase for the events
+    currently passing all hard steps and add them to the events. Does nothing when all columns were
+    read in one go.
+    """
+    reader = getattr(task, "deferred_column_reader", None)
+    if reader is None:
+      return
+    self.add_columns(reader(self.mask))
+
+  def update_stats(self, stats: dict) -> None:
+    """
+    Add the number of skipped events per selector to `stats` and log the fraction of work saved.
+    """
+    if not self.hard_steps:
+      return
+
+    skipped_stats = stats.setdefault("staged_selection_skipped_events", {})
+    for name, n_skipped in self.skipped.items():
+      skipped_stats[name] = skipped_stats.get(name, 0) + n_skipped
+      logger.debug(
+        f"staged selection: {name} skipped {n_skipped} / {self.n_events} events "
+        f"({100.0 * n_skipped / max(self.n_events, 1):.1f}% work saved)",
+      )
@@ -3,3 +3,5 @@
 
 # provisioning imports
 import xyh.tasks.base
+import xyh.tasks.columns
+import xyh.tasks.external
@@ -0,0 +1,141 @@
+# coding: utf-8
+
+"""
+Tasks related to the columns stored in reduced events.
+"""
+
+from __future__ import annotations
+
+from collections import defaultdict
+
+import law
+
+from columnflow.tasks.framework.base import Requirements
+from columnflow.tasks.framework.mixins import (
+    CalibratorsMixin, SelectorMixin, ReducerMixin, ProducersMixin, MLModelsMixin, HistProducerMixin,
+)
+from columnflow.tasks.reduction import ProvideReducedEvents
+from columnflow.util import maybe_import, dev_sandbox
+
+from xyh.reduction.index_views import expand_index_view_columns
+from xyh.tasks.base import XYHTask
+from xyh.util import find_downstream_columns, route_covered
+
+pq = maybe_import("pyarrow.parquet")
+
+
+def parquet_column_sizes(path: str) -> dict[str, int]:
+    """
+    Return the compressed sizes in bytes of all columns in the parquet file at *path*, summed over
+    row groups and keyed by their column names in dot format.
+    """
+    sizes = defaultdict(int)
+    metadata = pq.ParquetFile(path).metadata
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        for j in range(row_group.num_columns):
+            column = row_group.column(j)
+            # remove the nesting levels of list columns
+            fields = [f for f in column.path_in_schema.split(".") if f not in ("list", "item", "element")]
+            sizes[".".join(fields)] += column.total_compressed_size
+    return dict(sizes)
+
+
+class _CheckColumnUsage(
+    CalibratorsMixin,
+    SelectorMixin,
+    ReducerMixin,
+    ProducersMixin,
+    MLModelsMixin,
+    HistProducerMixin,
+    law.LocalWorkflow,
+):
+    """
+    Base classes for :py:class:`CheckColumnUsage`.
+    """
+
+
+class CheckColumnUsage(XYHTask, _CheckColumnUsage):
+    """
+    Determines the minimal set of columns that tasks after ReduceEvents read from reduced events,
+    given the producers, ML models and hist producer of the task and all variables of the config,
+    and reports the size of all other columns in the reduced outputs of the dataset. The minimal set
+    can be enforced with the *minimal_columns* reducer.
+    """
+
+    sandbox = dev_sandbox(law.config.get("analysis", "default_columnar_sandbox"))
+
+    # upstream requirements
+    reqs = Requirements(
+        ProvideReducedEvents=ProvideReducedEvents,
+    )
+
+    def create_branch_map(self):
+        # create a dummy branch map so that this task could be run as a single job
+        return {0: None}
+
+    def workflow_requires(self):
+        reqs = super().workflow_requires()
+        reqs["events"] = self.reqs.ProvideReducedEvents.req_different_branching(self, branch=-1)
+        return reqs
+
+    def requires(self):
+        return self.reqs.ProvideReducedEvents.req_different_branching(
+            self,
+            branch=-1,
+            workflow="local",
+        )
+
+    def output(self):
+        return self.target("column_usage.json")
+
+    @law.decorator.notify
+    @law.decorator.log
+    def run(self):
+        inputs = self.input()["collection"]
+
+        # run the setup of all array functions
+        self._array_function_post_init()
+
+        # determine the columns read downstream
+        needed = find_downstream_columns(
+            self.config_inst,
+            producer_insts=self.producer_insts,
+            hist_producer_inst=self.hist_producer_inst,
+            ml_model_insts=self.ml_model_insts,
+            variable_insts=self.config_inst.variables,
+        )
+
+        # derived collections stored as index views are read through their source collections
+        views = self.config_inst.x("index_view_collections", {})
+        needed = {route for route in expand_index_view_columns(needed, views) if route[0] not in views}
+
+        # sum column sizes over all reduced files
+        sizes = defaultdict(int)
+        for inp in self.iter_progress(inputs.targets.values(), len(inputs)):
+            with inp["events"].localize("r") as tmp:
+                for column, size in parquet_column_sizes(tmp.abspath).items():
+                    sizes[column] += size
+
+        kept = {column: size for column, size in sizes.items() if route_covered(column, needed)}
+        removable = {column: size for column, size in sizes.items() if column not in kept}
+        missing = sorted(str(route) for route in needed if not any(route_covered(c, [route]) for c in sizes))
+
+        # report
+        total = max(sum(sizes.values()), 1)
+        self.publish_message(f"{len(removable)} of {len(sizes)} stored columns are not read downstream:")
+        for column, size in sorted(removable.items(), key=lambda tpl: -tpl[1]):
+            self.publish_message(f"  {column}: {law.util.human_bytes(size, fmt=True)} ({100 * size / total:.1f}%)")
+        self.publish_message(
+            f"removable: {law.util.human_bytes(sum(removable.values()), fmt=True)} "
+            f"({100 * sum(removable.values()) / total:.1f}% of {law.util.human_bytes(total, fmt=True)})",
+        )
+        if missing:
+            self.publish_message(f"columns read downstream but not stored: {', '.join(missing)}")
+
+        self.output().dump({
+            "minimal": sorted(map(str, needed)),
+            "kept": dict(sorted(kept.items())),
+            "removable": dict(sorted(removable.items(), key=lambda tpl: -tpl[1])),
+            "missing": missing,
+        }, indent=4, formatter="json")
@@ -0,0 +1,62 @@
+# coding: utf-8
+
+"""
+Tasks to fill the content-addressed store of external files (see xyh.external_store).
+"""
+
+from __future__ import annotations
+
+import luigi
+import law
+
+from columnflow.tasks.framework.base import ConfigTask
+
+from xyh.external_store import ExternalFileStore, flatten_external_files
+from xyh.tasks.base import XYHTask
+
+
+class PrefetchExternalFiles(XYHTask, ConfigTask):
+    """
+    Fetches all external files of the config in parallel into the configured
+    :py:class:`ExternalFileStore` and writes a manifest mapping their keys to stored paths.
+    Subsequent bundling of external files, also in offline mode, is served from the store.
+    """
+
+    single_config = True
+
+    workers = luigi.IntParameter(
+        default=8,
+        significant=False,
+        description="number of parallel fetches; default: 8",
+    )
+    verify = luigi.BoolParameter(
+        default=False,
+        significant=False,
+        description="when True, verifies the hashes of already stored files; default: False",
+    )
+
+    version = None
+
+    def output(self):
+        files_hash = law.util.create_hash(sorted(
+            (key, str(ext_file))
+            for key, ext_file in flatten_external_files(self.config_inst.x.external_files).items()
+        ))
+        return self.target(f"external_files_{files_hash}.json")
+
+    def run(self):
+        store = ExternalFileStore.from_config(self.config_inst)
+        if store is None:
+            raise Exception(
+                f"no external_file_store defined in config {self.config_inst.name}, set "
+                "XYH_EXTERNAL_FILE_STORE to enable it",
+            )
+
+        paths = store.prefetch(
+            self.config_inst.x.external_files,
+            workers=self.workers,
+            verify=self.verify,
+            callback=lambda key, path: self.publish_message(f"stored {key}: {path}"),
+        )
+
+        self.output().dump(paths, indent=4, formatter="json")
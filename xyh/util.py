@@ -9,23 +9,78 @@ from __future__ import annotations
 import re
 import itertools
 import time
+import types
 from typing import Hashable, Iterable, Callable
 from functools import wraps, reduce, partial
 import tracemalloc
+import zlib
 
 import law
 
 from columnflow.types import Any
-from columnflow.columnar_util import ArrayFunction, deferred_column, get_ak_routes
+from columnflow.columnar_util import (
+  ArrayFunction, Route, deferred_column, get_ak_routes, mandatory_coffea_columns,
+)
 from columnflow.util import maybe_import
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
 coffea = maybe_import("coffea")
+numba = maybe_import("numba")
+maybe_import("coffea.nanoevents.methods.nanoaod")
 
 _logger = law.logger.get_logger(__name__)
 
 
+def lazy_njit(func=None, **njit_kwargs):
+  """
+  Parametrized decorator that compiles *func* with `numba.njit` on its first call only, so that
+  modules defining compiled kernels can still be imported in sandboxes without numba. Other lazily
+  compiled kernels called by *func* are resolved to their compiled versions.
+  Can be used with or without parentheses.
+  """
+  if func is None:
+    return partial(lazy_njit, **njit_kwargs)
+
+  compiled = []
+
+  def compile_func():
+    if not compiled:
+      func_globals = dict(func.__globals__)
+      for name in func.__code__.co_names:
+        dep_compile = getattr(func_globals.get(name), "compile", None)
+        if callable(dep_compile):
+          func_globals[name] = dep_compile()
+      _func = types.FunctionType(func.__code__, func_globals, func.__name__, func.__defaults__)
+      compiled.append(numba.njit(**njit_kwargs)(_func))
+    return compiled[0]
+
+  @wraps(func)
+  def inner(*args):
+    return compile_func()(*args)
+
+  inner.compile = compile_func
+  inner.py_func = func
+  return inner
+
+
+def measure(func: Callable, *args, repeat: int = 3, **kwargs) -> tuple[Any, float, int]:
+  """
+  Call *func* with *args* and *kwargs* *repeat* times and return the result of the last call, the
+  minimal runtime in seconds and the maximal peak memory in bytes traced by `tracemalloc`.
+  """
+  runtimes, peaks = [], []
+  for _ in range(max(repeat, 1)):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    result = func(*args, **kwargs)
+    runtimes.append(time.perf_counter() - t0)
+    peaks.append(tracemalloc.get_traced_memory()[1])
+    tracemalloc.stop()
+
+  return result, min(runtimes), max(peaks)
+
+
 def masked_sorted_indices(mask: ak.Array, sort_var: ak.Array, ascending: bool = False) -> ak.Array:
   """
   Helper function to obtain the correct indices of an object mask
@@ -60,6 +115,83 @@ def call_once_on_config(func=None, *, include_hash=False):
   return inner
 
 
+def sample_entry_ranges(
+  n_entries: int,
+  fraction: float,
+  block_size: int = 1000,
+  seed: int = 0,
+  key: str = "",
+) -> tuple[np.ndarray, np.ndarray]:
+  """
+  Return the start and stop entries of a deterministic random subset of blocks of *block_size*
+  entries covering the *fraction* of *n_entries*. The subset only depends on *seed* and *key*, which
+  should identify the sampled file. The number of blocks is rounded stochastically, so that the
+  expected fraction is exact also for files with few blocks. Adjacent blocks are merged.
+  """
+  n_blocks = int(np.ceil(n_entries / block_size))
+  rng = np.random.default_rng([seed, zlib.crc32(key.encode())])
+  n_sampled = min(int(fraction * n_blocks + rng.random()), n_blocks)
+  blocks = np.sort(rng.choice(n_blocks, n_sampled, replace=False))
+
+  starts = blocks * block_size
+  stops = np.minimum(starts + block_size, n_entries)
+  if not n_sampled:
+    return starts, stops
+
+  # merge adjacent blocks
+  gaps = starts[1:] != stops[:-1]
+  return starts[np.concatenate([[True], gaps])], stops[np.concatenate([gaps, [True]])]
+
+
+def route_covered(route: Route | str, routes: Iterable[Route | str]) -> bool:
+  """
+  Return whether the column *route* is covered by any of the *routes*, i.e., whether it matches one
+  of them, possibly containing wildcards, or is nested below one of them.
+  """
+  column = Route(route).column
+  for other in map(str, routes):
+    if law.util.multi_match(column, [other]) or column.startswith(f"{other}."):
+      return True
+  return False
+
+
+def find_downstream_columns(
+  config_inst,
+  producer_insts: Iterable = (),
+  hist_producer_inst=None,
+  ml_model_insts: Iterable = (),
+  variable_insts: Iterable = (),
+  category_id_columns: Iterable[str] = ("category_ids",),
+) -> set[Route]:
+  """
+  Return the columns that tasks after ReduceEvents read from the reduced events, given the
+  *producer_insts*, *hist_producer_inst*, *ml_model_insts* and *variable_insts* of *config_inst*.
+  These are all used columns, including the ones of variable expressions and their ``inputs``, that
+  are not produced by any of the producers or ML models. Routes may contain wildcards.
+  """
+  used = set(map(Route, mandatory_coffea_columns)) | {Route("process_id")}
+  used |= set(map(Route, category_id_columns))
+  produced = set()
+
+  for producer_inst in producer_insts:
+    used |= producer_inst.used_columns
+    produced |= producer_inst.produced_columns
+  for model_inst in ml_model_insts:
+    used |= model_inst.used_columns[config_inst]
+    produced |= model_inst.produced_columns[config_inst]
+  if hist_producer_inst is not None:
+    used |= hist_producer_inst.used_columns
+
+  for variable_inst in variable_insts:
+    # string expressions are routes, possibly with index slices that do not change the column
+    expression = getattr(variable_inst.expression, "expression", variable_inst.expression)
+    if isinstance(expression, str):
+      used.add(Route([field for field in Route(expression).fields if isinstance(field, str)]))
+    used |= set(map(Route, variable_inst.x("inputs", [])))
+
+  return {route for route in used if not route_covered(route, produced)}
+
+
 def ak_extract_fields(arr, fields, **kwargs):
   """
   Build an array containing only certain `fields` of an input array `arr`,
@@ -140,12 +272,15 @@ def delta_r_match(dst_lvs, src_lv, max_dr=None):
   return best_match_dst_lv, dst_lvs
 
 
-def delta_r_match_multiple(dst_lvs, src_lvs, max_dr=None):
+def delta_r_match_multiple_iterative(dst_lvs, src_lvs, max_dr=None):
   """
   Like `delta_r_match`, except source array `src_lvs` can contain more than
   one entry per event. The matching is done sequentially for each entry in
   `src_lvs`, with previous matches being filetered from the destination array
   each time to prevent double counting.
+
+  Reference implementation of the "sequential" method of `delta_r_match_multiple`, kept for
+  validation and benchmarking.
   """
 
   # save the index structure of the supplied source array
@@ -172,6 +307,257 @@ def delta_r_match_multiple(dst_lvs, src_lvs, max_dr=None):
   return result, dst_lvs
 
 
+DELTA_R_MATCH_METHODS = ("sequential", "greedy", "hungarian")
+
+
+@lazy_njit
+def _delta_r_table(src_eta, src_phi, src_valid, dst_eta, dst_phi, dst_valid, max_dr):
+  """
+  Delta-R table between one event's sources and destinations, with invalid pairs set to `inf`.
+  """
+  ns, nd = len(src_eta), len(dst_eta)
+  delta_r = np.full((ns, nd), np.inf)
+  for i in range(ns):
+    if not src_valid[i]:
+      continue
+    for j in range(nd):
+      if not dst_valid[j]:
+        continue
+      dphi = (src_phi[i] - dst_phi[j] + np.pi) % (2 * np.pi) - np.pi
+      dr = np.sqrt((src_eta[i] - dst_eta[j])**2 + dphi**2)
+      if max_dr < 0 or dr < max_dr:
+        delta_r[i, j] = dr
+  return delta_r
+
+
+@lazy_njit
+def _hungarian(cost):
+  """
+  Minimal-cost assignment of rows to columns of a finite *cost* matrix with at most as many rows
+  as columns (Kuhn-Munkres with potentials, O(n^2 m)). Returns the column index per row.
+  """
+  n, m = cost.shape
+  u = np.zeros(n + 1)
+  v = np.zeros(m + 1)
+  p = np.zeros(m + 1, dtype=np.int64)
+  way = np.zeros(m + 1, dtype=np.int64)
+  for i in range(1, n + 1):
+    p[0] = i
+    j0 = 0
+    minv = np.full(m + 1, np.inf)
+    used = np.zeros(m + 1, dtype=np.bool_)
+    while True:
+      used[j0] = True
+      i0 = p[j0]
+      delta = np.inf
+      j1 = 0
+      for j in range(1, m + 1):
+        if not used[j]:
+          cur = cost[i0 - 1, j - 1] - u[i0] - v[j]
+          if cur < minv[j]:
+            minv[j] = cur
+            way[j] = j0
+          if minv[j] < delta:
+            delta = minv[j]
+            j1 = j
+      for j in range(m + 1):
+        if used[j]:
+          u[p[j]] += delta
+          v[j] -= delta
+        else:
+          minv[j] -= delta
+      j0 = j1
+      if p[j0] == 0:
+        break
+    while True:
+      j1 = way[j0]
+      p[j0] = p[j1]
+      j0 = j1
+      if j0 == 0:
+        break
+
+  row_to_col = np.full(n, -1, dtype=np.int64)
+  for j in range(1, m + 1):
+    if p[j] > 0:
+      row_to_col[p[j] - 1] = j - 1
+  return row_to_col
+
+
+@lazy_njit
+def _delta_r_match_kernel(
+  src_offsets, src_eta, src_phi, src_valid,
+  dst_offsets, dst_eta, dst_phi, dst_valid,
+  max_dr, method,
+):
+  """
+  Single pass over all events, matching flat source objects to destination objects. Returns the
+  event-local destination index per source object (-1 if unmatched).
+  """
+  match = np.full(len(src_eta), -1, dtype=np.int64)
+  for ev in range(len(src_offsets) - 1):
+    s0, s1 = src_offsets[ev], src_offsets[ev + 1]
+    d0, d1 = dst_offsets[ev], dst_offsets[ev + 1]
+    ns, nd = s1 - s0, d1 - d0
+    if ns == 0 or nd == 0:
+      continue
+
+    delta_r = _delta_r_table(
+      src_eta[s0:s1], src_phi[s0:s1], src_valid[s0:s1],
+      dst_eta[d0:d1], dst_phi[d0:d1], dst_valid[d0:d1],
+      max_dr,
+    )
+
+    if method == 0:
+      # sequential: each source in order takes its closest remaining destination
+      taken = np.zeros(nd, dtype=np.bool_)
+      for i in range(ns):
+        best, best_dr = -1, np.inf
+        for j in range(nd):
+          if not taken[j] and delta_r[i, j] < best_dr:
+            best, best_dr = j, delta_r[i, j]
+        if best >= 0:
+          match[s0 + i] = best
+          taken[best] = True
+
+    elif method == 1:
+      # greedy: repeatedly assign the globally closest remaining pair
+      row_free = np.ones(ns, dtype=np.bool_)
+      col_free = np.ones(nd, dtype=np.bool_)
+      for _ in range(min(ns, nd)):
+        bi, bj, best_dr = -1, -1, np.inf
+        for i in range(ns):
+          if not row_free[i]:
+            continue
+          for j in range(nd):
+            if col_free[j] and delta_r[i, j] < best_dr:
+              bi, bj, best_dr = i, j, delta_r[i, j]
+        if bi < 0:
+          break
+        match[s0 + bi] = bj
+        row_free[bi] = False
+        col_free[bj] = False
+
+    else:
+      # hungarian: minimal sum of delta-r, forbidden pairs get a cost that exceeds any valid
+      # assignment so that the number of valid matches is maximized first
+      finite = np.isfinite(delta_r)
+      if not finite.any():
+        continue
+      forbidden_cost = np.where(finite, delta_r, 0.0).sum() + 1.0
+      cost = np.where(finite, delta_r, forbidden_cost)
+      if ns <= nd:
+        row_to_col = _hungarian(cost)
+        for i in range(ns):
+          if finite[i, row_to_col[i]]:
+            match[s0 + i] = row_to_col[i]
+      else:
+        col_to_row = _hungarian(cost.T.copy())
+        for j in range(nd):
+          if finite[col_to_row[j], j]:
+            match[s0 + col_to_row[j]] = j
+
+  return match
+
+
+def _flat_eta_phi(lvs):
+  """
+  Return the offsets, flat eta and phi values, and a flat validity mask of a jagged collection.
+  """
+  counts = ak.to_numpy(ak.fill_none(ak.num(lvs, axis=1), 0))
+  offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+  np.cumsum(counts, out=offsets[1:])
+  eta = ak.flatten(lvs.eta, axis=1)
+  valid = ~ak.to_numpy(ak.is_none(eta, axis=0))
+  eta = ak.to_numpy(ak.fill_none(eta, np.nan)).astype(np.float64)
+  phi = ak.to_numpy(ak.fill_none(ak.flatten(lvs.phi, axis=1), np.nan)).astype(np.float64)
+  return offsets, eta, phi, valid
+
+
+def delta_r_match_multiple(dst_lvs, src_lvs, max_dr=None, method="sequential"):
+  """
+  Like `delta_r_match`, except source array `src_lvs` can contain more than
+  one entry per event. Each destination object is matched at most once.
+
+  The matching runs in a single compiled pass over the flat content and offsets
+  of both arrays. The `method` decides how conflicts are resolved:
+
+    - "sequential": each entry in `src_lvs` takes, in order, its closest
+      remaining destination (same result as `delta_r_match_multiple_iterative`)
+    - "greedy": the globally closest remaining src-dst pair per event is
+      matched first
+    - "hungarian": the assignment with the maximal number of matches and the
+      minimal sum of delta-R values per event is chosen
+
+  Returns an array containing the best match in `dst_lvs` for each entry in
+  `src_lvs` (or None), and a view of `dst_lvs` with the matches masked.
+  """
+  if method not in DELTA_R_MATCH_METHODS:
+    raise ValueError(f"unknown delta-R matching method '{method}', expected one of {DELTA_R_MATCH_METHODS}")
+
+  src_offsets, src_eta, src_phi, src_valid = _flat_eta_phi(src_lvs)
+  dst_offsets, dst_eta, dst_phi, dst_valid = _flat_eta_phi(dst_lvs)
+
+  match = _delta_r_match_kernel(
+    src_offsets, src_eta, src_phi, src_valid,
+    dst_offsets, dst_eta, dst_phi, dst_valid,
+    -1.0 if max_dr is None else float(max_dr),
+    DELTA_R_MATCH_METHODS.index(method),
+  )
+
+  # best matches, index-compatible with the source array
+  match_idx = ak.unflatten(match, np.diff(src_offsets))
+  result = dst_lvs[ak.mask(match_idx, match_idx >= 0)]
+
+  # mask matched destinations
+  taken = np.zeros(len(dst_eta), dtype=bool)
+  matched = match >= 0
+  src_event = np.repeat(np.arange(len(src_offsets) - 1), np.diff(src_offsets))
+  taken[dst_offsets[src_event[matched]] + match[matched]] = True
+  dst_lvs = ak.mask(dst_lvs, ak.unflatten(~taken, np.diff(dst_offsets)))
+
+  return result, dst_lvs
+
+
+def min_delta_r(objs: ak.Array, *others: ak.Array) -> ak.Array:
+  """
+  Return the minimal delta-R of each entry in `objs` to any entry of the `others` collections in
+  the same event, or `inf` if there is none.
+
+  Equivalent to reducing `objs.metric_table(other)` with `ak.min` over all `others`, but without
+  building the 3-D jagged tables. All object-other pairs are enumerated as flat index buffers per
+  event, evaluated in a single vectorized `delta_r` call and reduced per object with `reduceat`.
+  In the common case of at most one lepton per event, this is one delta-R per jet.
+  """
+  counts = ak.to_numpy(ak.num(objs, axis=1))
+  obj_event = np.repeat(np.arange(len(counts)), counts)
+  flat_objs = ak.flatten(objs, axis=1)
+  min_dr = np.full(len(flat_objs), np.inf)
+
+  for other in others:
+    other_counts = ak.to_numpy(ak.num(other, axis=1))
+    other_offsets = np.zeros(len(other_counts), dtype=np.int64)
+    np.cumsum(other_counts[:-1], out=other_offsets[1:])
+
+    # flat pairs, grouped by object
+    n_pairs = other_counts[obj_event]
+    obj_idx = np.flatnonzero(n_pairs)
+    if not len(obj_idx):
+      continue
+    n_pairs = n_pairs[obj_idx]
+    pair_starts = np.zeros(len(obj_idx), dtype=np.int64)
+    np.cumsum(n_pairs[:-1], out=pair_starts[1:])
+    pair_obj = np.repeat(obj_idx, n_pairs)
+    pair_other = (
+      np.repeat(other_offsets[obj_event[obj_idx]] - pair_starts, n_pairs) +
+      np.arange(pair_starts[-1] + n_pairs[-1])
+    )
+
+    delta_r = ak.to_numpy(flat_objs[pair_obj].delta_r(ak.flatten(other, axis=1)[pair_other]))
+    min_dr[obj_idx] = np.minimum(min_dr[obj_idx], np.minimum.reduceat(delta_r, pair_starts))
+
+  return ak.unflatten(min_dr, counts)
+
+
 @deferred_column
 def IF_NANO_V12(self: ArrayFunction.DeferredColumn, func: ArrayFunction) -> Any | set[Any]:
   """